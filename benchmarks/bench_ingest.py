@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки пути загрузки и фильтрации мемов.
+Синтетические посты VK в формате wall.get проходят через фильтр текста,
+дедупликацию по подписи, извлечение ключевых слов и загрузку кэша мемов.
+VK API и CDN изображений заменены заглушками, сеть не используется.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_ingest
+    python -m benchmarks.bench_ingest --sizes 1000 10000 --repeat 5
+"""
+import argparse
+import json
+import math
+
+from benchmarks.common import (
+    FakeCdnSession, FakeVkSession, make_memes, make_vk_posts, measure, print_results, setup_environment
+)
+
+setup_environment()
+
+import bot_railway  # noqa: E402
+import recommendation_engine  # noqa: E402
+import vk_utils  # noqa: E402
+from meme_data import filter_suitable_memes, is_suitable_meme  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+POSTS_PER_GROUP = 500  # fetch_vk_memes листает не больше 5 страниц по 100 постов
+
+def reset_collection():
+    """Очищает коллекцию мемов бота перед очередным запуском"""
+    bot_railway.memes_collection = {}
+    bot_railway.rejected_memes = {}
+    bot_railway.unique_meme_signatures = set()
+
+def disable_network_limits():
+    """Убирает ограничение частоты VK API: заглушка отвечает мгновенно"""
+    vk_utils.vk_rate_limiter = vk_utils.TokenBucket(rate=1e9, capacity=1e9)
+
+def bench_filter(memes, repeat=3):
+    """Фильтр текста: по одному мему и пакетом"""
+    return [
+        dict(name="is_suitable_meme", items=len(memes),
+             **measure(lambda: [is_suitable_meme(meme) for meme in memes], len(memes), repeat=repeat)),
+        dict(name="filter_suitable_memes (пакет)", items=len(memes),
+             **measure(lambda: filter_suitable_memes(memes), len(memes), repeat=repeat))
+    ]
+
+def bench_dedup(memes, repeat=3):
+    """Дедупликация по подписи и фильтр кандидатов без проверки изображений"""
+    original_validate = bot_railway.validate_images
+    bot_railway.validate_images = lambda urls: [True] * len(urls)
+    try:
+        result = measure(lambda: bot_railway.process_candidate_batch(memes), len(memes), setup=reset_collection,
+                         repeat=repeat)
+    finally:
+        bot_railway.validate_images = original_validate
+    return [dict(name="дедупликация (process_candidate_batch)", items=len(memes), **result)]
+
+def bench_ingest_pipeline(size, repeat=3):
+    """Полный путь загрузки: заглушка VK (execute) -> фильтр -> проверка заголовков на заглушке CDN"""
+    groups = max(1, math.ceil(size / POSTS_PER_GROUP))
+    posts_by_group = {
+        group_id: make_vk_posts(min(POSTS_PER_GROUP, size - (group_id - 1) * POSTS_PER_GROUP),
+                                group_id=group_id, seed=group_id)
+        for group_id in range(1, groups + 1)
+    }
+    cdn = FakeCdnSession()
+    original_session, original_vk = bot_railway._get_http_session, bot_railway.vk_session
+    bot_railway._get_http_session = lambda: cdn
+    bot_railway.vk_session = FakeVkSession(posts_by_group)
+    try:
+        result = measure(
+            lambda: bot_railway.ingest_vk_groups(list(posts_by_group), POSTS_PER_GROUP),
+            size,
+            setup=reset_collection,
+            repeat=repeat
+        )
+    finally:
+        bot_railway._get_http_session, bot_railway.vk_session = original_session, original_vk
+    return [dict(name="ingest_vk_groups (заглушки VK/CDN)", items=size, **result)]
+
+def bench_keywords(memes, repeat=3):
+    """Извлечение ключевых слов с холодным кэшем"""
+    def clear_cache():
+        recommendation_engine.meme_keywords_cache.clear()
+    return [dict(name="get_meme_keywords (холодный кэш)", items=len(memes),
+                 **measure(lambda: [recommendation_engine.get_meme_keywords(meme) for meme in memes],
+                           len(memes), setup=clear_cache, repeat=repeat))]
+
+def bench_load_cache(memes, repeat=3):
+    """Загрузка и повторная фильтрация кэша мемов"""
+    with open(bot_railway.MEMES_CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump({f"vk_{index}": meme for index, meme in enumerate(memes)}, f, ensure_ascii=False, indent=2)
+    return [dict(name="load_memes_from_cache", items=len(memes),
+                 **measure(bot_railway.load_memes_from_cache, len(memes), setup=reset_collection,
+                           repeat=repeat))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки загрузки и фильтрации мемов")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Количество мемов")
+    parser.add_argument("--repeat", type=int, default=3, help="Количество замеров (берется лучшее время)")
+    parser.add_argument("--skip-pipeline", action="store_true", help="Не запускать полный путь загрузки")
+    args = parser.parse_args()
+
+    disable_network_limits()
+    for size in args.sizes:
+        memes = make_memes(size, seed=size)
+        rows = []
+        rows += bench_filter(memes, args.repeat)
+        rows += bench_dedup(memes, args.repeat)
+        rows += bench_keywords(memes, args.repeat)
+        rows += bench_load_cache(memes, args.repeat)
+        if not args.skip_pipeline:
+            rows += bench_ingest_pipeline(size, args.repeat)
+        print_results(f"=== {size} мемов ===", rows)
+
+if __name__ == "__main__":
+    main()
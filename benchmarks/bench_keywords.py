@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк извлечения ключевых слов.
+Прежняя реализация extract_keywords (re.sub без компиляции, split и фильтр
+стоп-слов) сравнивается с токенизатором на скомпилированном регулярном
+выражении: по одному тексту, со стеммингом и пакетом на весь пакет загрузки.
+Для пакетного API также замеряется вариант с одним проходом регулярного
+выражения по склеенному пакету.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_keywords
+    python -m benchmarks.bench_keywords --sizes 1000 10000 --repeat 5
+"""
+import argparse
+import re
+from typing import List
+
+from benchmarks.common import make_memes, measure, print_results, setup_environment
+
+setup_environment()
+
+import recommendation_engine  # noqa: E402
+from recommendation_engine import (  # noqa: E402
+    MAX_KEYWORDS_PER_MEME, STOP_WORDS, extract_keywords, extract_keywords_batch, get_meme_keywords,
+    get_meme_keywords_batch
+)
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+def legacy_extract_keywords(text: str) -> List[str]:
+    """Прежняя реализация extract_keywords"""
+    if not text:
+        return []
+    text = text.lower()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    words = text.split()
+    keywords = [word for word in words if word not in STOP_WORDS and len(word) > 2]
+    return keywords[:MAX_KEYWORDS_PER_MEME]
+
+_JOINED_TOKEN_PATTERN = re.compile(r'\w+|\x00')
+
+def joined_extract_keywords_batch(texts: List[str]) -> List[List[str]]:
+    """
+    Альтернативный пакетный вариант: тексты склеиваются через разделитель,
+    lower() и регулярное выражение проходят по всему пакету один раз
+    """
+    results = []
+    keywords = []
+    for token in _JOINED_TOKEN_PATTERN.findall("\x00".join(text or "" for text in texts).lower()):
+        if token == "\x00":
+            results.append(keywords[:MAX_KEYWORDS_PER_MEME])
+            keywords = []
+        elif len(token) > 2 and token not in STOP_WORDS:
+            keywords.append(token)
+    results.append(keywords[:MAX_KEYWORDS_PER_MEME])
+    return results
+
+def bench_tokenizer(texts: List[str], repeat: int):
+    """Токенизация текстов: прежняя функция, новая по одному тексту и пакетом"""
+    count = len(texts)
+    legacy = [legacy_extract_keywords(text) for text in texts]
+    if legacy != extract_keywords_batch(texts, stemming=False) or legacy != joined_extract_keywords_batch(texts):
+        raise AssertionError("Результаты нового токенизатора отличаются от прежнего")
+    # Кэш стемминга прогревается при первом запуске, замеряется лучший из repeat
+    return [
+        dict(name="extract_keywords (прежняя)", items=count,
+             **measure(lambda: [legacy_extract_keywords(text) for text in texts], count, repeat=repeat)),
+        dict(name="extract_keywords", items=count,
+             **measure(lambda: [extract_keywords(text, stemming=False) for text in texts], count, repeat=repeat)),
+        dict(name="extract_keywords (стемминг)", items=count,
+             **measure(lambda: [extract_keywords(text, stemming=True) for text in texts], count, repeat=repeat)),
+        dict(name="extract_keywords_batch", items=count,
+             **measure(lambda: extract_keywords_batch(texts, stemming=False), count, repeat=repeat)),
+        dict(name="extract_keywords_batch (стемминг)", items=count,
+             **measure(lambda: extract_keywords_batch(texts, stemming=True), count, repeat=repeat)),
+        dict(name="один проход по склеенному пакету", items=count,
+             **measure(lambda: joined_extract_keywords_batch(texts), count, repeat=repeat))
+    ]
+
+def bench_meme_keywords(memes, repeat: int):
+    """Ключевые слова мемов с холодным кэшем: по одному мему и пакетом"""
+    def clear_cache():
+        recommendation_engine.meme_keywords_cache.clear()
+    return [
+        dict(name="get_meme_keywords (холодный кэш)", items=len(memes),
+             **measure(lambda: [get_meme_keywords(meme) for meme in memes], len(memes),
+                       setup=clear_cache, repeat=repeat)),
+        dict(name="get_meme_keywords_batch (холодный кэш)", items=len(memes),
+             **measure(lambda: get_meme_keywords_batch(memes), len(memes), setup=clear_cache, repeat=repeat))
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк извлечения ключевых слов")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Количество текстов")
+    parser.add_argument("--repeat", type=int, default=3, help="Количество повторов замера")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        memes = make_memes(size, seed=size)
+        texts = [meme["text"] for meme in memes]
+        rows = bench_tokenizer(texts, args.repeat) + bench_meme_keywords(memes, args.repeat)
+        print_results(f"=== {len(texts)} текстов ===", rows)
+
+if __name__ == "__main__":
+    main()
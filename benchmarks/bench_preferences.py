@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки загрузки и сохранения профилей предпочтений пользователей.
+Сравниваются старый формат (JSON со словарями строк) и двоичный формат
+хранилища профилей: время сохранения и загрузки, ленивое декодирование
+профилей и пиковое потребление памяти.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_preferences
+    python -m benchmarks.bench_preferences --users 1000 10000 --keywords 40
+"""
+import argparse
+import json
+import os
+import random
+
+from benchmarks.common import measure, print_results, setup_environment
+
+setup_environment()
+
+from preference_store import ProfileStore  # noqa: E402
+
+DEFAULT_USERS = [1000, 10000]
+VOCABULARY_SIZE = 5000
+MEMES_COUNT = 20000
+JSON_FILE = "bench_preferences.json"
+BINARY_FILE = "bench_preferences.bin"
+
+def make_profiles(users: int, keywords: int, seed: int = 0):
+    """Генерирует профили в старом формате JSON (словари строк)"""
+    rng = random.Random(seed)
+    vocabulary = [f"слово{index}" for index in range(VOCABULARY_SIZE)]
+    profiles = {}
+    for user in range(users):
+        rated = rng.randint(5, 60)
+        profiles[str(100000 + user)] = {
+            "liked_keywords": {word: rng.random() for word in rng.sample(vocabulary, keywords)},
+            "disliked_keywords": {word: rng.random() for word in rng.sample(vocabulary, keywords // 4)},
+            "rated_memes": {f"vk-1_{rng.randrange(MEMES_COUNT)}_0": rng.choice((1, -1)) for _ in range(rated)},
+            "total_ratings": rated
+        }
+    return profiles
+
+def bench_json(profiles):
+    """Старый формат: весь файл JSON целиком"""
+    def save():
+        with open(JSON_FILE, "w", encoding="utf-8") as f:
+            json.dump(profiles, f, ensure_ascii=False)
+
+    def load():
+        with open(JSON_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    users = len(profiles)
+    rows = [dict(name="JSON: сохранение", items=users, **measure(save, users))]
+    rows.append(dict(name="JSON: загрузка", items=users, **measure(load, users)))
+    return rows
+
+def bench_binary(profiles):
+    """Двоичный формат хранилища профилей"""
+    store = ProfileStore()
+    store.load_dicts(profiles)
+    users = len(profiles)
+    user_ids = list(profiles)
+
+    def save():
+        with open(BINARY_FILE, "wb") as f:
+            f.write(store.dump_binary(0))
+
+    def load_index():
+        loaded = ProfileStore()
+        loaded.load_binary(BINARY_FILE)
+        loaded.clear()
+
+    def load_all():
+        loaded = ProfileStore()
+        loaded.load_binary(BINARY_FILE)
+        for user_id in user_ids:
+            loaded.get(user_id)
+        loaded.clear()
+
+    lazy_store = ProfileStore()
+
+    def reset_lazy():
+        lazy_store.load_binary(BINARY_FILE)
+
+    def first_access():
+        for user_id in user_ids:
+            lazy_store.get(user_id)
+
+    rows = [dict(name="двоичный: сохранение", items=users, **measure(save, users))]
+    rows.append(dict(name="двоичный: загрузка индекса", items=users, **measure(load_index, users)))
+    rows.append(dict(name="двоичный: загрузка всех профилей", items=users, **measure(load_all, users)))
+    rows.append(dict(name="двоичный: первое обращение к профилю", items=users,
+                     **measure(first_access, users, setup=reset_lazy)))
+    lazy_store.clear()
+    store.clear()
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки хранения профилей предпочтений")
+    parser.add_argument("--users", type=int, nargs="+", default=DEFAULT_USERS, help="Количество пользователей")
+    parser.add_argument("--keywords", type=int, default=40, help="Понравившихся ключевых слов на пользователя")
+    args = parser.parse_args()
+
+    for users in args.users:
+        profiles = make_profiles(users, args.keywords, seed=users)
+        rows = bench_json(profiles) + bench_binary(profiles)
+        print_results(f"=== {users} пользователей ===", rows)
+        print(f"размер файла: JSON {os.path.getsize(JSON_FILE) / 1024:.0f} КиБ, "
+              f"двоичный {os.path.getsize(BINARY_FILE) / 1024:.0f} КиБ")
+
+if __name__ == "__main__":
+    main()
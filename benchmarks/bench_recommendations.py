@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Офлайн-оценка рекомендаций повторным проигрыванием истории оценок.
+Оценки проигрываются в порядке времени: перед каждой оценкой у recommend_memes
+запрашиваются рекомендации для пользователя, затем оценка применяется
+к его предпочтениям. Выводятся качество рекомендаций (hit rate@k и precision@k
+в сравнении со случайными рекомендациями) и задержка вызова recommend_memes.
+
+Метрики считаются только для запросов, где у пользователя уже достаточно
+оценок для персонализированных рекомендаций:
+    hit rate@k  - доля понравившихся мемов, которые были в top-k перед оценкой
+    precision@k - доля мемов top-k, которые пользователь лайкнет позже
+
+История берется из данных бота (снимок аналитики, rating_history.json или база SQLite
+и кэш мемов)
+или генерируется: у синтетических пользователей есть любимые слова, и мемы
+с ними нравятся чаще остальных.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_recommendations
+    python -m benchmarks.bench_recommendations --users 2000 --ratings 100000 --memes 20000 --query-every 10
+    python -m benchmarks.bench_recommendations --history analytics/snapshot.json --memes-file cached_filtered_memes.json
+    python -m benchmarks.bench_recommendations --history memebot.sqlite3 --memes-file cached_filtered_memes.json
+"""
+import argparse
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+# Пути к файлам истории указываются относительно директории запуска,
+# а бенчмарк работает во временной директории
+LAUNCH_DIR = os.getcwd()
+
+from benchmarks.common import HUMOR_WORDS, make_memes, setup_environment  # noqa: E402
+
+setup_environment()
+
+import recommendation_engine  # noqa: E402
+from meme_data import make_meme_id  # noqa: E402
+from recommendation_engine import (  # noqa: E402
+    MIN_RATINGS_FOR_RECOMMENDATIONS, get_meme_keywords, recommend_memes, user_preferences
+)
+from storage import SQLiteAnalyticsStorage  # noqa: E402
+
+DEFAULT_USERS = 500
+DEFAULT_RATINGS = 20000
+DEFAULT_MEMES = 5000
+HISTORY_DAYS = 30              # Период, на который растягивается синтетическая история
+FAVORITE_SHOWN_SHARE = 0.5     # Доля показов синтетическому пользователю мемов с любимыми словами
+RATING_NOISE = 0.1             # Вероятность оценки вопреки вкусу
+
+# Событие истории: (время, ID пользователя, ID мема, оценка)
+Event = Tuple[int, int, str, int]
+
+def load_history(history_path: str, memes_path: str) -> Tuple[Dict[str, Dict], List[Event]]:
+    """
+    Загружает историю оценок (снимок аналитики, старый rating_history.json
+    или полную историю из базы SQLite) и коллекцию мемов
+    """
+    with open(os.path.join(LAUNCH_DIR, memes_path), "r", encoding="utf-8") as f:
+        collection = json.load(f)
+    history_path = os.path.join(LAUNCH_DIR, history_path)
+    if history_path.endswith((".sqlite3", ".sqlite", ".db")):
+        database = SQLiteAnalyticsStorage(history_path)
+        history = database.rating_history()
+        database.close()
+    else:
+        with open(history_path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        if isinstance(history, dict):
+            history = history["rating_history"]
+    events = [
+        (entry["timestamp"], entry["user_id"], entry["meme_id"], entry["rating"])
+        for entry in history if entry["meme_id"] in collection
+    ]
+    skipped = len(history) - len(events)
+    if skipped:
+        print(f"пропущено {skipped} оценок мемов, которых нет в коллекции")
+    events.sort(key=lambda event: event[0])
+    return collection, events
+
+def make_history(users: int, ratings: int, memes_count: int, seed: int = 0) -> Tuple[Dict[str, Dict], List[Event]]:
+    """
+    Генерирует коллекцию мемов и историю оценок, упорядоченную по времени.
+    У каждого пользователя 1-3 любимых слова: мемы с ними он обычно лайкает, остальные - нет.
+    """
+    rng = random.Random(seed)
+    memes = make_memes(memes_count, seed=seed, duplicate_ratio=0)
+    collection = {make_meme_id(meme): meme for meme in memes}
+    meme_ids = list(collection)
+    memes_by_word = defaultdict(list)
+    for meme_id, meme in collection.items():
+        for word in set(meme["text"].split()) & set(HUMOR_WORDS):
+            memes_by_word[word].append(meme_id)
+
+    favorites = {user_id: set(rng.sample(HUMOR_WORDS, rng.randint(1, 3))) for user_id in range(1, users + 1)}
+    user_ids = list(favorites)
+    started = int(time.time()) - HISTORY_DAYS * 86400
+    step = HISTORY_DAYS * 86400 / max(1, ratings)
+    events = []
+    seen = defaultdict(set)
+    for index in range(ratings):
+        user_id = rng.choice(user_ids)
+        if rng.random() < FAVORITE_SHOWN_SHARE:
+            meme_id = rng.choice(memes_by_word[rng.choice(sorted(favorites[user_id]))] or meme_ids)
+        else:
+            meme_id = rng.choice(meme_ids)
+        if meme_id in seen[user_id]:
+            continue
+        seen[user_id].add(meme_id)
+        liked = bool(favorites[user_id] & set(collection[meme_id]["text"].split()))
+        if rng.random() < RATING_NOISE:
+            liked = not liked
+        events.append((started + int(index * step), user_id, meme_id, 1 if liked else -1))
+    return collection, events
+
+def future_likes_index(events: List[Event]) -> Dict[int, List[Tuple[int, str]]]:
+    """Позиции понравившихся мемов в истории по пользователям"""
+    likes = defaultdict(list)
+    for position, (_, user_id, meme_id, rating) in enumerate(events):
+        if rating > 0:
+            likes[user_id].append((position, meme_id))
+    return likes
+
+def replay(collection: Dict[str, Dict], events: List[Event], k: int, query_every: int,
+           seed: int = 0) -> Dict:
+    """Проигрывает историю и собирает метрики качества и задержки"""
+    rng = random.Random(seed)
+    user_preferences.clear()
+    recommendation_engine.meme_keywords_cache.clear()
+    recommendation_engine.meme_matrix.sync(collection)
+
+    likes = future_likes_index(events)
+    like_cursor = defaultdict(int)   # Сколько лайков пользователя уже проиграно
+    rated = defaultdict(set)
+    ratings_count = defaultdict(int)
+    all_meme_ids = list(collection)
+    latencies = []
+    stats = defaultdict(float)
+
+    for position, (timestamp, user_id, meme_id, rating) in enumerate(events):
+        if position % query_every == 0 and ratings_count[user_id] >= MIN_RATINGS_FOR_RECOMMENDATIONS:
+            started = time.perf_counter()
+            top = recommend_memes(user_id, collection, k, exclude=rated[user_id])
+            latencies.append(time.perf_counter() - started)
+            baseline = []
+            while len(baseline) < k and len(rated[user_id]) + len(baseline) < len(all_meme_ids):
+                candidate = rng.choice(all_meme_ids)
+                if candidate not in rated[user_id] and candidate not in baseline:
+                    baseline.append(candidate)
+
+            future = {liked_id for _, liked_id in likes[user_id][like_cursor[user_id]:]}
+            stats["queries"] += 1
+            stats["precision"] += len(future.intersection(top)) / k
+            stats["baseline_precision"] += len(future.intersection(baseline)) / k
+            if rating > 0:
+                stats["liked_queries"] += 1
+                stats["hits"] += meme_id in top
+                stats["baseline_hits"] += meme_id in baseline
+
+        recommendation_engine._apply_rating(str(user_id), meme_id, get_meme_keywords(collection[meme_id]),
+                                            rating, timestamp)
+        rated[user_id].add(meme_id)
+        ratings_count[user_id] += 1
+        if rating > 0:
+            like_cursor[user_id] += 1
+
+    stats["latencies"] = latencies
+    return stats
+
+def percentile(sorted_values: List[float], share: float) -> float:
+    """Перцентиль по отсортированным значениям (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+def print_report(title: str, stats: Dict, events: int, k: int, elapsed: float):
+    """Печатает метрики качества и задержки"""
+    queries = int(stats["queries"])
+    liked = int(stats["liked_queries"])
+    latencies = sorted(stats["latencies"])
+    print(f"\n{title}")
+    print(f"оценок: {events}, запросов рекомендаций: {queries} (перед лайком: {liked}), время: {elapsed:.1f} с")
+    print(f"{'метрика':<24}{'recommend_memes':>18}{'случайные':>14}")
+    if liked:
+        print(f"{f'hit rate@{k}':<24}{stats['hits'] / liked:>18.4f}{stats['baseline_hits'] / liked:>14.4f}")
+    if queries:
+        print(f"{f'precision@{k}':<24}{stats['precision'] / queries:>18.4f}"
+              f"{stats['baseline_precision'] / queries:>14.4f}")
+    print("задержка recommend_memes, мс: " + ", ".join(
+        f"p{int(share * 100)} {percentile(latencies, share) * 1000:.2f}" for share in (0.5, 0.9, 0.99)
+    ) + f", max {latencies[-1] * 1000 if latencies else 0.0:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-оценка рекомендаций по истории оценок")
+    parser.add_argument("--history", help="Снимок аналитики (analytics/snapshot.json), rating_history.json или база SQLite")
+    parser.add_argument("--memes-file", help="Кэш мемов, на которые ссылается история (cached_filtered_memes.json)")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="Пользователей в синтетической истории")
+    parser.add_argument("--ratings", type=int, default=DEFAULT_RATINGS, help="Оценок в синтетической истории")
+    parser.add_argument("--memes", type=int, default=DEFAULT_MEMES, help="Мемов в синтетической коллекции")
+    parser.add_argument("-k", type=int, default=5, help="Размер списка рекомендаций")
+    parser.add_argument("--query-every", type=int, default=1, help="Запрашивать рекомендации на каждой N-й оценке")
+    parser.add_argument("--seed", type=int, default=0, help="Seed генератора")
+    args = parser.parse_args()
+
+    if args.history:
+        if not args.memes_file:
+            parser.error("для --history нужен --memes-file")
+        collection, events = load_history(args.history, args.memes_file)
+        title = f"=== {args.history}: {len(collection)} мемов ==="
+    else:
+        collection, events = make_history(args.users, args.ratings, args.memes, seed=args.seed)
+        title = f"=== синтетическая история: {args.users} пользователей, {len(collection)} мемов ==="
+
+    started = time.perf_counter()
+    stats = replay(collection, events, args.k, max(1, args.query_every), seed=args.seed)
+    print_report(title, stats, len(events), args.k, time.perf_counter() - started)
+
+if __name__ == "__main__":
+    main()
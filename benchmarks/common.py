@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Общие средства для бенчмарков: изолированное окружение, синтетические посты VK
+в формате wall.get, заглушки VK API и CDN изображений, замер времени и памяти.
+"""
+import atexit
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Callable, Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup_environment() -> str:
+    """
+    Готовит изолированное окружение: модули бота читают и пишут файлы кэшей
+    относительно текущей директории, поэтому бенчмарки работают во временной.
+    Вызывается до импорта модулей бота.
+    """
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    os.environ.setdefault("VK_TOKEN", "benchmark")
+    workdir = tempfile.mkdtemp(prefix="memebot_bench_")
+    os.chdir(workdir)
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    import logging
+    logging.disable(logging.CRITICAL)
+    return workdir
+
+# Слова для синтетических текстов: обычные слова и ключевые слова фильтра
+FILLER_WORDS = (
+    "когда пятница наконец наступила а ты всё ещё сидишь на звонке и думаешь "
+    "о выходных но планы опять поменялись просто понедельник снова утром"
+).split()
+HUMOR_WORDS = ["офис", "коллеги", "начальник", "дедлайн", "кофе", "кот", "мем", "прикол", "лень", "тимлид"]
+NEWS_WORDS = ["новости", "сегодня", "в москве", "президент", "штраф", "пожар"]
+EXCLUDED_WORDS = ["кровь", "наркотики", "труп"]
+
+def make_post_text(rng: random.Random) -> str:
+    """Генерирует текст поста: в основном короткие шутки, часть новостей и длинных постов"""
+    roll = rng.random()
+    if roll < 0.15:
+        # Длинный пост (реклама, лонгрид)
+        return " ".join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(40, 120)))
+    words = [rng.choice(FILLER_WORDS) for _ in range(rng.randint(3, 10))]
+    if roll < 0.25:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(NEWS_WORDS))
+    elif roll < 0.30:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(EXCLUDED_WORDS))
+    if rng.random() < 0.7:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(HUMOR_WORDS))
+    return " ".join(words)[:100]
+
+def make_vk_posts(count: int, group_id: int = 1, seed: int = 0,
+                  duplicate_ratio: float = 0.1, start_post_id: int = 1) -> List[Dict]:
+    """
+    Генерирует посты стены VK в формате ответа wall.get (от новых к старым).
+    Часть постов повторяет текст и картинку более ранних, чтобы проверять дедупликацию.
+    """
+    rng = random.Random(seed)
+    posts = []
+    for index in range(count):
+        post_id = start_post_id + count - index
+        if posts and rng.random() < duplicate_ratio:
+            source = rng.choice(posts)
+            text = source["text"]
+            url = source["attachments"][0]["photo"]["sizes"][-1]["url"]
+        else:
+            text = make_post_text(rng)
+            url = f"https://sun9-{rng.randint(1, 99)}.userapi.com/impg/{group_id}_{post_id}.jpg"
+        posts.append({
+            "id": post_id,
+            "owner_id": -group_id,
+            "date": 1700000000 + post_id,
+            "text": text,
+            "attachments": [{
+                "type": "photo",
+                "photo": {
+                    "id": post_id * 10,
+                    "owner_id": -group_id,
+                    "sizes": [
+                        {"type": "m", "width": 130, "url": url + "?size=130"},
+                        {"type": "x", "width": 604, "url": url}
+                    ]
+                }
+            }]
+        })
+    return posts
+
+def make_memes(count: int, seed: int = 0, duplicate_ratio: float = 0.1) -> List[Dict]:
+    """Генерирует мемы в формате, который возвращает fetch_vk_memes"""
+    from vk_utils import _extract_memes
+    posts = make_vk_posts(count, seed=seed, duplicate_ratio=duplicate_ratio)
+    return _extract_memes(posts, count)
+
+class FakeWall:
+    """Заглушка wall.get поверх заранее сгенерированных постов"""
+
+    def __init__(self, posts_by_group: Dict[int, List[Dict]]):
+        self.posts_by_group = posts_by_group
+        self.calls = 0
+
+    def get(self, owner_id: int, count: int = 20, offset: int = 0, filter: str = "owner", **kwargs) -> Dict:
+        self.calls += 1
+        posts = self.posts_by_group.get(-owner_id, [])
+        return {"count": len(posts), "items": posts[offset:offset + count]}
+
+class FakeVkApi:
+    """Заглушка объекта, который возвращает VkApi.get_api()"""
+
+    def __init__(self, posts_by_group: Dict[int, List[Dict]]):
+        self.wall = FakeWall(posts_by_group)
+        self.execute_calls = 0
+
+    def execute(self, code: str):
+        """Выполняет вызовы API.wall.get из кода VKScript, сформированного vk_utils"""
+        import json
+        import re
+        self.execute_calls += 1
+        calls = re.findall(r"API\.wall\.get\((\{.*?\})\)", code)
+        return [self.wall.get(**json.loads(call)) for call in calls]
+
+class FakeVkSession:
+    """Заглушка vk_api.VkApi без сетевых запросов"""
+
+    def __init__(self, posts_by_group: Dict[int, List[Dict]]):
+        self.api = FakeVkApi(posts_by_group)
+
+    def get_api(self) -> FakeVkApi:
+        return self.api
+
+def make_image_bytes(width: int = 604, height: int = 604) -> bytes:
+    """Создает JPEG-изображение для ответов заглушки CDN"""
+    from PIL import Image
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), (200, 120, 40)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+class FakeCdnResponse:
+    """Ответ заглушки CDN с интерфейсом requests.Response"""
+
+    def __init__(self, content: bytes, status_code: int = 200):
+        self.content = content
+        self.status_code = status_code
+
+    def iter_content(self, chunk_size: int = 4096):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class FakeCdnSession:
+    """Заглушка requests.Session для CDN изображений VK"""
+
+    def __init__(self, content: Optional[bytes] = None):
+        self.content = content if content is not None else make_image_bytes()
+        self.requests = 0
+
+    def get(self, url: str, headers: Optional[Dict] = None, **kwargs) -> FakeCdnResponse:
+        self.requests += 1
+        content = self.content
+        range_header = (headers or {}).get("Range")
+        if range_header:
+            end = int(range_header.split("-")[1])
+            return FakeCdnResponse(content[:end + 1], status_code=206)
+        return FakeCdnResponse(content)
+
+def measure(func: Callable[[], object], items: int, setup: Optional[Callable[[], None]] = None,
+            repeat: int = 3) -> Dict:
+    """
+    Замеряет функцию: лучшее время из repeat запусков и пиковую память
+    (отдельным запуском под tracemalloc, чтобы трассировка не искажала время).
+
+    Returns:
+        Dict: seconds, items_per_second, peak_kib
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": best,
+        "items_per_second": items / best if best > 0 else float("inf"),
+        "peak_kib": peak / 1024
+    }
+
+def print_results(title: str, rows: List[Dict]):
+    """Печатает результаты в виде таблицы"""
+    print(f"\n{title}")
+    print(f"{'бенчмарк':<40}{'N':>9}{'время, с':>12}{'шт/с':>14}{'пик, КиБ':>12}")
+    for row in rows:
+        print(
+            f"{row['name']:<40}{row['items']:>9}{row['seconds']:>12.4f}"
+            f"{row['items_per_second']:>14.0f}{row['peak_kib']:>12.0f}"
+        )
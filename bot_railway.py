@@ -3,6 +3,7 @@
 Улучшенный файл для запуска Telegram-бота на Railway с исправлениями конфликтов Telegram API
 и фильтрацией мемов. Обеспечивает загрузку смешных мемов для 18+.
 """
+import asyncio
 import logging
 import os
 import signal
@@ -11,6 +12,7 @@ import threading
 import time
 import random
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import vk_api
@@ -27,15 +29,22 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, error
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 
 # Импортируем собственные модули
-from meme_data import MEMES, MEME_SOURCES, is_suitable_meme
+from meme_data import MEMES, MEME_SOURCES, is_suitable_meme, filter_suitable_memes, make_meme_id
 from recommendation_engine import (
     update_user_preferences, 
     recommend_memes, 
     get_user_preferences_stats, 
-    analyze_user_history
+    analyze_user_history,
+    forget_meme,
+    meme_keywords_cache,
+    flush_preferences
 )
 import meme_analytics
-from vk_utils import fetch_vk_memes, VK_GROUP_IDS
+from vk_utils import fetch_vk_memes, iter_vk_memes_parallel, iter_vk_memes_batched, commit_group_cursors, save_sync_state, VK_GROUP_IDS
+from image_loader import fetch_image, close_http_client, HTTP_HEADERS
+from image_cache import image_cache
+from telegram_file_cache import get_file_id, remember_file_id, forget_file_id, save_file_ids
+from recommendation_queue import RecommendationQueues
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO,
@@ -66,10 +75,36 @@ MIN_MEMES_COUNT = 10    # Минимальное количество мемов
 MAX_MEMES_TO_FETCH = 100 # Увеличен лимит для загрузки
 CONFLICT_RETRIES = 5    # Увеличено количество попыток при конфликте
 CONFLICT_RETRY_DELAY = 15  # Задержка между попытками (сек)
+# Способ загрузки стен групп (переменная окружения VK_FETCH_MODE):
+# 'execute'  - пакетами до 25 стен в одном запросе VK execute (по умолчанию: меньше всего
+#              запросов к API с его лимитом ~3 запроса/с на токен, поэтому реже ошибки 6)
+# 'parallel' - отдельный запрос wall.get на каждую группу в пуле потоков с ограниченной
+#              очередью (для токенов, которым execute недоступен, и для отладки)
+VK_FETCH_MODE = os.getenv("VK_FETCH_MODE", "execute").lower()
+VALIDATION_WORKERS = 16       # Количество потоков для проверки изображений
+VALIDATION_BATCH_SIZE = 64    # Размер пакета кандидатов для параллельной проверки
+IMAGE_VALIDATION_MODE = "header"  # 'header' - только заголовок файла, 'full' - загрузка и verify() целиком
+IMAGE_HEADER_BYTES = 16384        # Сколько байт читать для проверки заголовка
+MIN_IMAGE_SIDE = 200              # Минимальная ширина и высота изображения мема (пикс.)
+SUPPORTED_IMAGE_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+
+# Пул потоков для проверки изображений и метрики последнего пакета
+validation_executor = ThreadPoolExecutor(max_workers=VALIDATION_WORKERS, thread_name_prefix="image-validate")
+validation_stats = {"images": 0, "seconds": 0.0, "images_per_second": 0.0, "p95_latency": 0.0}
+
+# HTTP-сессии по потокам (keep-alive соединения с CDN VK для каждого потока проверки)
+_http_local = threading.local()
 
 # Флаг для управления процессом обновления
 update_thread_running = False
 
+def get_viewed_memes(user_id: int) -> set:
+    """Возвращает множество мемов, уже показанных пользователю"""
+    return set(user_states.get(user_id, {}).get("viewed_memes", ()))
+
+# Очереди рекомендованных мемов по пользователям (пересчитываются в фоновом потоке)
+recommendation_queues = RecommendationQueues(lambda: memes_collection, get_viewed_memes)
+
 # Инициализация VK API
 vk_token = os.getenv("VK_TOKEN")
 if not vk_token:
@@ -84,12 +119,35 @@ except vk_api.AuthError as e:
     logger.error(f"Ошибка авторизации VK API: {e}")
     sys.exit(1)
 
-def signal_handler(sig, frame):
-    """Обработчик сигнала для корректного завершения работы бота"""
-    logger.info(f"Получен сигнал завершения ({sig}). Завершаем работу бота...")
+def flush_state():
+    """
+    Сбрасывает на диск кэш мемов, накопленные события аналитики и оценки предпочтений.
+    Ничего не останавливает, поэтому после него бот может продолжать работу
+    (например, при повторном запуске polling после конфликта).
+    """
+    save_memes_to_cache()
+    meme_analytics.flush_analytics(force_save=True)
+    flush_preferences()
+
+def save_state_on_exit():
+    """
+    Останавливает обновление мемов и планировщик аналитики, сохраняет кэш мемов,
+    данные аналитики и оценки предпочтений. Вызывается один раз перед выходом.
+    """
     global update_thread_running
     update_thread_running = False
     save_memes_to_cache()
+    meme_analytics.shutdown_analytics()
+    flush_preferences()
+
+def signal_handler(sig, frame):
+    """
+    Обработчик сигнала для корректного завершения работы бота.
+    Действует до запуска polling: run_polling ставит свои обработчики SIGINT/SIGTERM,
+    и после этого состояние сохраняет on_shutdown.
+    """
+    logger.info(f"Получен сигнал завершения ({sig}). Завершаем работу бота...")
+    save_state_on_exit()
     cleanup_lock()
     sys.exit(0)
 
@@ -105,6 +163,8 @@ def save_memes_to_cache():
         logger.info(f"Сохранено {len(rejected_memes)} отклоненных мемов")
     except Exception as e:
         logger.error(f"Ошибка при сохранении мемов в кэш: {e}")
+    save_file_ids()
+    save_sync_state()
 
 def load_memes_from_cache():
     """Загружает мемы из файла кэша, если он существует, и фильтрует их"""
@@ -115,13 +175,15 @@ def load_memes_from_cache():
                 loaded_memes = json.load(f)
                 if loaded_memes and isinstance(loaded_memes, dict):
                     filtered_memes = {}
-                    for meme_id, meme in loaded_memes.items():
+                    # Фильтр текста применяется ко всему кэшу одним пакетом
+                    suitable = filter_suitable_memes(list(loaded_memes.values()))
+                    for (meme_id, meme), meme_suitable in zip(loaded_memes.items(), suitable):
                         signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
                         if signature in unique_meme_signatures:
                             rejected_memes[meme_id] = meme
                             logger.info(f"Мем {meme_id} из кэша отклонён как дубликат")
                             continue
-                        if is_suitable_meme(meme):
+                        if meme_suitable:
                             filtered_memes[meme_id] = meme
                             unique_meme_signatures.add(signature)
                         else:
@@ -142,79 +204,249 @@ def load_memes_from_cache():
         logger.error(f"Ошибка при загрузке мемов из кэша: {e}")
         return False
 
-def validate_image(image_url):
-    """Проверяет доступность и валидность изображения"""
-    try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        response = requests.get(image_url, headers=headers, timeout=5, stream=True)
-        if response.status_code != 200:
+def _get_http_session():
+    """Возвращает HTTP-сессию текущего потока"""
+    session = getattr(_http_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HTTP_HEADERS)
+        _http_local.session = session
+    return session
+
+def _check_image_properties(image_url, img):
+    """Проверяет формат и размеры открытого изображения"""
+    if img.format not in SUPPORTED_IMAGE_FORMATS:
+        logger.warning(f"Неподдерживаемый формат изображения {image_url}: {img.format}")
+        return False
+    width, height = img.size
+    if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+        logger.warning(f"Слишком маленькое изображение {image_url}: {width}x{height}")
+        return False
+    return True
+
+def _validate_image_header(image_url):
+    """
+    Проверяет изображение по первым IMAGE_HEADER_BYTES байтам (Range-запрос с потоковым чтением).
+    
+    Returns:
+        Optional[bool]: Результат проверки или None, если заголовок не удалось разобрать
+    """
+    headers = {"Range": f"bytes=0-{IMAGE_HEADER_BYTES - 1}"}
+    with _get_http_session().get(image_url, headers=headers, timeout=5, stream=True) as response:
+        if response.status_code not in (200, 206):
             logger.warning(f"Изображение недоступно: {image_url}, статус: {response.status_code}")
             return False
+        # Сервер может проигнорировать Range, поэтому дочитываем только нужное количество байт
+        header_data = b""
+        complete = True
+        for chunk in response.iter_content(chunk_size=4096):
+            header_data += chunk
+            if len(header_data) >= IMAGE_HEADER_BYTES:
+                complete = False
+                break
+        # Файл целиком уместился в прочитанные байты (ответ 200 без Range)
+        complete = complete and response.status_code == 200
+    try:
+        # Image.open читает только заголовок, данных пикселей здесь нет
+        img = Image.open(BytesIO(header_data[:IMAGE_HEADER_BYTES]))
+    except Exception as e:
+        logger.debug(f"Не удалось разобрать заголовок изображения {image_url}: {e}")
+        return None
+    if not _check_image_properties(image_url, img):
+        return False
+    if complete:
+        # Небольшое изображение уже загружено полностью: проверяем и кладем в кэш
         try:
-            img_data = BytesIO(response.content)
-            Image.open(img_data).verify()
-            return True
+            Image.open(BytesIO(header_data)).verify()
         except Exception as e:
             logger.error(f"Ошибка проверки изображения {image_url}: {e}")
             return False
+        image_cache.put(image_url, header_data)
+    return True
+
+def _validate_image_full(image_url):
+    """Загружает изображение целиком, проверяет его и сохраняет в дисковый кэш"""
+    response = _get_http_session().get(image_url, timeout=5, stream=True)
+    if response.status_code != 200:
+        logger.warning(f"Изображение недоступно: {image_url}, статус: {response.status_code}")
+        return False
+    try:
+        img = Image.open(BytesIO(response.content))
+        if not _check_image_properties(image_url, img):
+            return False
+        img.verify()
+        image_cache.put(image_url, response.content)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка проверки изображения {image_url}: {e}")
+        return False
+
+def validate_image(image_url):
+    """
+    Проверяет доступность и валидность изображения (с чтением через дисковый кэш).
+    В режиме 'header' загружается только заголовок файла, а полное изображение
+    скачивается при отправке мема (fetch_image кладет его в кэш). Если заголовок
+    разобрать не удалось, изображение проверяется целиком и тоже сохраняется в кэш.
+    """
+    # Изображение из кэша уже проверялось; файл не читается, статистика попаданий не меняется
+    if image_cache.contains(image_url):
+        return True
+    try:
+        if IMAGE_VALIDATION_MODE == "header":
+            result = _validate_image_header(image_url)
+            if result is not None:
+                return result
+        return _validate_image_full(image_url)
     except Exception as e:
         logger.error(f"Ошибка загрузки изображения {image_url}: {e}")
         return False
 
+def validate_images(image_urls):
+    """
+    Параллельно проверяет пакет изображений в пуле потоков.
+    
+    Returns:
+        List[bool]: Результаты проверки в том же порядке, что и image_urls
+    """
+    if not image_urls:
+        return []
+    
+    def timed_validate(image_url):
+        started = time.monotonic()
+        result = validate_image(image_url)
+        return result, time.monotonic() - started
+    
+    started = time.monotonic()
+    results = list(validation_executor.map(timed_validate, image_urls))
+    elapsed = time.monotonic() - started
+    
+    latencies = sorted(latency for _, latency in results)
+    validation_stats["images"] = len(image_urls)
+    validation_stats["seconds"] = elapsed
+    validation_stats["images_per_second"] = len(image_urls) / elapsed if elapsed > 0 else 0.0
+    validation_stats["p95_latency"] = latencies[int(0.95 * (len(latencies) - 1))]
+    logger.info(
+        f"Проверено {len(image_urls)} изображений за {elapsed:.2f}с "
+        f"({validation_stats['images_per_second']:.1f} изобр./с, p95={validation_stats['p95_latency']:.2f}с)"
+    )
+    return [result for result, _ in results]
+
+def process_candidate_batch(memes):
+    """
+    Проверяет пакет мемов-кандидатов и добавляет подходящие в коллекцию.
+    Дешёвые проверки (дубликаты, фильтр текста) выполняются сразу,
+    изображения оставшихся кандидатов проверяются параллельно.
+    
+    Returns:
+        List[str]: Статусы кандидатов: 'added', 'duplicate', 'exists' или 'rejected'
+    """
+    statuses = [None] * len(memes)
+    to_validate = []
+    batch_signatures = set()
+    suitable = filter_suitable_memes(memes)
+    
+    for index, meme in enumerate(memes):
+        meme_id = make_meme_id(meme)
+        signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
+        
+        # Проверка на дубликаты (в том числе внутри пакета)
+        if signature in unique_meme_signatures or signature in batch_signatures:
+            rejected_memes[meme_id] = meme
+            statuses[index] = "duplicate"
+            logger.info(f"Отклонен мем {meme_id} как дубликат, Text={meme.get('text', '')[:50]}")
+            continue
+        
+        if meme_id in memes_collection or meme_id in rejected_memes:
+            statuses[index] = "exists"
+            logger.debug(f"Мем {meme_id} уже существует в коллекции или отклонённых")
+            continue
+        
+        # Неподходящие по тексту мемы отклоняем без загрузки изображения
+        if not suitable[index]:
+            rejected_memes[meme_id] = meme
+            statuses[index] = "rejected"
+            logger.info(f"Отклонен мем {meme_id} как неподходящий, Text={meme.get('text', '')[:50]}")
+            continue
+        
+        batch_signatures.add(signature)
+        to_validate.append((index, meme_id, signature, meme))
+    
+    image_results = validate_images([meme["image_url"] for _, _, _, meme in to_validate])
+    for (index, meme_id, signature, meme), image_valid in zip(to_validate, image_results):
+        if image_valid:
+            memes_collection[meme_id] = meme
+            unique_meme_signatures.add(signature)
+            statuses[index] = "added"
+            logger.info(f"Добавлен мем {meme_id}, Text={meme.get('text', '')[:50]}, Tags={meme.get('tags', [])}")
+        else:
+            rejected_memes[meme_id] = meme
+            statuses[index] = "rejected"
+            logger.info(f"Отклонен мем {meme_id} из-за недоступного изображения, Text={meme.get('text', '')[:50]}")
+    
+    return statuses
+
+def ingest_vk_groups(group_ids, count, incremental=False):
+    """
+    Загружает мемы из нескольких групп (пакетно через execute или параллельно)
+    и проверяет кандидатов по мере поступления. При incremental=True из групп
+    загружаются только посты новее сохранённых курсоров, а курсоры сдвигаются
+    после обработки всех кандидатов (кроме групп, пакет которых упал с ошибкой).
+    
+    Returns:
+        Tuple[int, int, List[Dict]]: количество добавленных, отклонённых мемов и список кандидатов
+    """
+    added = 0
+    rejected = 0
+    candidates = []
+    batch = []
+    cursor_updates = {}
+    failed_groups = set()
+    
+    def flush_batch():
+        nonlocal added, rejected
+        try:
+            statuses = process_candidate_batch([meme for _, meme in batch])
+        except Exception as e:
+            logger.error(f"Ошибка при обработке пакета из {len(batch)} мемов: {e}")
+            rejected += len(batch)
+            failed_groups.update(group_id for group_id, _ in batch)
+            return
+        added += statuses.count("added")
+        rejected += len(statuses) - statuses.count("added")
+    
+    if VK_FETCH_MODE == "parallel":
+        source = iter_vk_memes_parallel(group_ids, count, vk_session, incremental, cursor_updates)
+    else:
+        if VK_FETCH_MODE != "execute":
+            logger.warning(f"Неизвестный VK_FETCH_MODE={VK_FETCH_MODE}, используется execute")
+        source = iter_vk_memes_batched(group_ids, count, vk_session, incremental, cursor_updates)
+    for group_id, meme in source:
+        candidates.append(meme)
+        batch.append((group_id, meme))
+        if len(batch) >= VALIDATION_BATCH_SIZE:
+            flush_batch()
+            batch = []
+    if batch:
+        flush_batch()
+    # Непрочитанные из-за ошибки посты останутся новыми до следующего обновления
+    commit_group_cursors({
+        group_id: cursor for group_id, cursor in cursor_updates.items() if group_id not in failed_groups
+    })
+    return added, rejected, candidates
+
 def init_default_memes():
     """Инициализирует базовый набор мемов из VK API"""
     global memes_collection, rejected_memes, unique_meme_signatures
     logger.info("Инициализация стандартного набора мемов из VK")
-    count_added = 0
-    count_rejected = 0
-    
-    for group_id in VK_GROUP_IDS:
-        try:
-            logger.info(f"Попытка загрузки мемов из группы {group_id}")
-            memes = fetch_vk_memes(group_id, count=MAX_MEMES_TO_FETCH, vk_session=vk_session)
-            logger.info(f"Всего доступно постов в группе {group_id}: {len(memes)}")
-            if not memes:
-                logger.warning(f"Нет мемов в группе {group_id}")
-                continue
-            for meme in memes:
-                meme_id = f"vk_{abs(hash(meme['image_url'] + meme['text']))}"
-                signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
-                
-                # Проверка на дубликаты
-                if signature in unique_meme_signatures:
-                    rejected_memes[meme_id] = meme
-                    count_rejected += 1
-                    logger.info(f"Отклонен мем {meme_id} как дубликат, Text={meme.get('text', '')[:50]}")
-                    continue
-                
-                if meme_id in memes_collection or meme_id in rejected_memes:
-                    count_rejected += 1
-                    logger.info(f"Мем {meme_id} уже существует в коллекции или отклонённых, Text={meme.get('text', '')[:50]}")
-                    continue
-                
-                image_valid = validate_image(meme["image_url"])
-                meme_suitable = is_suitable_meme(meme)
-                if image_valid and meme_suitable:
-                    memes_collection[meme_id] = meme
-                    unique_meme_signatures.add(signature)
-                    count_added += 1
-                    logger.info(f"Добавлен мем {meme_id}, Text={meme.get('text', '')[:50]}, Tags={meme.get('tags', [])}")
-                else:
-                    rejected_memes[meme_id] = meme
-                    count_rejected += 1
-                    logger.info(f"Отклонен мем {meme_id} {'из-за недоступного изображения' if not image_valid else 'как неподходящий'}, Text={meme.get('text', '')[:50]}")
-            time.sleep(random.uniform(2, 3))  # Увеличена задержка для соблюдения лимитов API
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке мемов из группы {group_id}: {e}")
-            continue
+    started = time.monotonic()
+    count_added, count_rejected, memes = ingest_vk_groups(VK_GROUP_IDS, MAX_MEMES_TO_FETCH)
+    logger.info(f"Загрузка из {len(VK_GROUP_IDS)} групп заняла {time.monotonic() - started:.1f}с")
     
     if count_added < MIN_MEMES_COUNT:
         logger.warning(f"Добавлено только {count_added} мемов, меньше {MIN_MEMES_COUNT}. Принудительное добавление...")
         remaining = MIN_MEMES_COUNT - count_added
         for meme in memes[:remaining]:
-            meme_id = f"vk_{abs(hash(meme['image_url'] + meme['text']))}"
+            meme_id = make_meme_id(meme)
             signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
             if signature in unique_meme_signatures:
                 continue
@@ -256,65 +488,75 @@ def update_memes():
         try:
             if len(memes_collection) < MIN_MEMES_COUNT:
                 logger.info(f"Количество мемов ({len(memes_collection)}) меньше минимального {MIN_MEMES_COUNT}. Запускаем обновление...")
-                for group_id in VK_GROUP_IDS:
-                    logger.info(f"Обновление мемов для группы {group_id}")
-                    fetch_and_add_new_memes(group_id, MAX_MEMES_TO_FETCH // len(VK_GROUP_IDS))
-                    time.sleep(random.uniform(2, 3))
+                added, rejected, _ = ingest_vk_groups(VK_GROUP_IDS, MAX_MEMES_TO_FETCH // len(VK_GROUP_IDS))
+                logger.info(f"Добавлено {added} мемов, отклонено {rejected}")
             
             logger.info("Выполняется регулярное обновление мемов...")
-            for group_id in VK_GROUP_IDS:
-                logger.info(f"Регулярное обновление для группы {group_id}")
-                fetch_and_add_new_memes(group_id, 5)
-                time.sleep(random.uniform(2, 3))
+            added, rejected, _ = ingest_vk_groups(VK_GROUP_IDS, 5, incremental=True)
+            logger.info(f"Регулярное обновление: добавлено {added} мемов, отклонено {rejected}")
+            if added:
+                recommendation_queues.refill_all()
             
             save_memes_to_cache()
+            logger.info(f"Статистика кэша изображений: {image_cache.stats()}")
+            logger.info(f"Статистика очередей рекомендаций: {recommendation_queues.stats()}")
+            logger.info(f"Статистика кэша ключевых слов: {meme_keywords_cache.stats()}")
             time.sleep(UPDATE_INTERVAL)
         except Exception as e:
             logger.error(f"Ошибка в процессе обновления мемов: {e}")
             time.sleep(60)
 
 def fetch_and_add_new_memes(group_id, count=10):
-    """Получает новые мемы из VK и добавляет их в коллекцию"""
-    global memes_collection, rejected_memes, unique_meme_signatures
+    """Получает новые (ещё не просмотренные) мемы из VK и добавляет их в коллекцию"""
     logger.info(f"Получение {count} новых мемов из группы {group_id}...")
     new_memes_count = 0
     rejected_count = 0
     try:
-        memes = fetch_vk_memes(group_id, count, vk_session=vk_session)
+        cursor_updates = {}
+        memes = fetch_vk_memes(group_id, count, vk_session=vk_session, incremental=True,
+                               cursor_updates=cursor_updates)
         logger.info(f"Всего доступно постов в группе {group_id} для добавления: {len(memes)}")
-        for meme in memes:
-            meme_id = f"vk_{abs(hash(meme['image_url'] + meme['text']))}"
-            signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
-            
-            # Проверка на дубликаты
-            if signature in unique_meme_signatures:
-                rejected_memes[meme_id] = meme
-                rejected_count += 1
-                logger.info(f"Отклонен мем {meme_id} как дубликат, Text={meme.get('text', '')[:50]}")
-                continue
-            
-            if meme_id in memes_collection or meme_id in rejected_memes:
-                logger.debug(f"Мем {meme_id} уже существует")
-                rejected_count += 1
-                continue
-            
-            image_valid = validate_image(meme["image_url"])
-            meme_suitable = is_suitable_meme(meme)
-            if image_valid and meme_suitable:
-                memes_collection[meme_id] = meme
-                unique_meme_signatures.add(signature)
-                new_memes_count += 1
-                logger.info(f"Добавлен новый мем {meme_id}, Text={meme.get('text', '')[:50]}, Tags={meme.get('tags', [])}")
-            else:
-                rejected_memes[meme_id] = meme
-                rejected_count += 1
-                logger.info(f"Отклонен мем {meme_id} {'из-за недоступного изображения' if not image_valid else 'как неподходящий'}, Text={meme.get('text', '')[:50]}")
+        statuses = process_candidate_batch(memes)
+        new_memes_count = statuses.count("added")
+        rejected_count = len(statuses) - new_memes_count
+        commit_group_cursors(cursor_updates)
     except Exception as e:
         logger.error(f"Ошибка при получении мемов из группы {group_id}: {e}")
     
     logger.info(f"Получено {new_memes_count} новых мемов, отклонено {rejected_count}")
     return new_memes_count
 
+async def send_meme_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, meme_id: str,
+                          image_url: str, caption: str, reply_markup: InlineKeyboardMarkup):
+    """
+    Отправляет изображение мема, по возможности используя сохранённый file_id.
+    Если Telegram отклоняет устаревший file_id, изображение загружается заново.
+    """
+    file_id = get_file_id(meme_id)
+    if file_id:
+        try:
+            message = await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup
+            )
+            logger.info(f"Мем {meme_id} отправлен по сохранённому file_id")
+            return message
+        except error.BadRequest as e:
+            logger.warning(f"Telegram отклонил file_id мема {meme_id}: {e}. Загружаем изображение заново")
+            forget_file_id(meme_id)
+    
+    img_data = await fetch_image(image_url)
+    message = await context.bot.send_photo(
+        chat_id=chat_id,
+        photo=img_data,
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    remember_file_id(meme_id, message)
+    return message
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start. Отправляет первый мем пользователю."""
     user = update.effective_user
@@ -370,15 +612,20 @@ async def send_random_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             return
     
     logger.info(f"Текущее количество мемов: {len(memes_collection)}")
-    viewed_memes = user_states[user_id].get("viewed_memes", [])
-    available_memes = [meme_id for meme_id in memes_collection if meme_id not in viewed_memes]
-    
-    if not available_memes:
-        logger.info(f"Пользователь {user_id} просмотрел все мемы, сбрасываем историю")
-        user_states[user_id]["viewed_memes"] = []
-        available_memes = list(memes_collection.keys())
+    # Следующий мем берется из заранее рассчитанной очереди рекомендаций
+    meme_id = recommendation_queues.pop(user_id)
     
-    meme_id = random.choice(available_memes) if available_memes else None
+    if meme_id is None:
+        # Очередь еще не рассчитана или пуста: показываем случайный непросмотренный мем
+        viewed_memes = user_states[user_id].get("viewed_memes", [])
+        available_memes = [meme_id for meme_id in memes_collection if meme_id not in viewed_memes]
+        
+        if not available_memes:
+            logger.info(f"Пользователь {user_id} просмотрел все мемы, сбрасываем историю")
+            user_states[user_id]["viewed_memes"] = []
+            available_memes = list(memes_collection.keys())
+        
+        meme_id = random.choice(available_memes) if available_memes else None
     
     if meme_id is None:
         logger.warning(f"Мемы не найдены для пользователя {user_id}")
@@ -402,28 +649,14 @@ async def send_random_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     try:
         if image_url:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
-            response = requests.get(image_url, headers=headers, timeout=10, stream=True)
-            if response.status_code == 200:
-                img_data = BytesIO(response.content)
-                try:
-                    Image.open(img_data).verify()
-                    img_data.seek(0)
-                    message = await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=img_data,
-                        caption=text,
-                        reply_markup=reply_markup
-                    )
-                    logger.info(f"Изображение отправлено: {image_url}")
-                except Exception as e:
-                    logger.error(f"Ошибка проверки изображения: {e}")
-                    raise
-            else:
-                logger.warning(f"Не удалось загрузить изображение, статус: {response.status_code}")
-                raise Exception(f"Статус: {response.status_code}")
+            try:
+                message = await send_meme_photo(
+                    context, update.effective_chat.id, meme_id, image_url, text, reply_markup
+                )
+            except Exception as e:
+                logger.error(f"Ошибка проверки изображения: {e}")
+                raise
+            logger.info(f"Изображение отправлено: {image_url}")
         else:
             message = await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -444,6 +677,9 @@ async def send_random_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         logger.error(f"Ошибка при отправке мема {meme_id}: {e}")
         if meme_id in memes_collection:
             rejected_memes[meme_id] = memes_collection.pop(meme_id)
+            forget_file_id(meme_id)
+            recommendation_queues.invalidate_meme(meme_id)
+            forget_meme(meme_id)
             # Удаляем подпись из unique_meme_signatures
             signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
             if signature in unique_meme_signatures:
@@ -477,6 +713,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             try:
                 if meme_id in memes_collection:
                     update_user_preferences(user_id, memes_collection[meme_id], rating)
+                    recommendation_queues.mark_dirty(user_id)
                 else:
                     logger.warning(f"Мем {meme_id} не найден при обновлении предпочтений")
             except Exception as e:
@@ -526,7 +763,9 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     try:
         preferences_stats = get_user_preferences_stats(user_id)
-        history_analysis = analyze_user_history(user_id, memes_collection)
+        # Анализ запускает recommend_memes: считаем его вне цикла событий на копии коллекции,
+        # которую может менять поток обновления мемов
+        history_analysis = await asyncio.to_thread(analyze_user_history, user_id, dict(memes_collection))
         favorite_topics = history_analysis.get("favorite_topics", [])
         topics_str = ", ".join(favorite_topics[:3]) if favorite_topics else "Юмор"
         
@@ -570,6 +809,9 @@ async def report_ad_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         meme = memes_collection[meme_id]
         signature = f"{meme.get('text', '')}|{meme.get('image_url', '')}"
         rejected_memes[meme_id] = memes_collection.pop(meme_id)
+        forget_file_id(meme_id)
+        recommendation_queues.invalidate_meme(meme_id)
+        forget_meme(meme_id)
         if signature in unique_meme_signatures:
             unique_meme_signatures.remove(signature)
         save_memes_to_cache()
@@ -605,7 +847,14 @@ async def recommend_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     try:
-        recommended_memes = recommend_memes(user_id, memes_collection, 1)
+        meme_id = recommendation_queues.pop(user_id)
+        if meme_id is not None:
+            recommended_memes = [meme_id]
+        else:
+            # Очередь еще не рассчитана: считаем рекомендацию вне цикла событий
+            recommended_memes = await asyncio.to_thread(
+                recommend_memes, user_id, dict(memes_collection), 1, get_viewed_memes(user_id)
+            )
         if not recommended_memes:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -639,28 +888,14 @@ async def recommend_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         
         if image_url:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
-            response = requests.get(image_url, headers=headers, timeout=10, stream=True)
-            if response.status_code == 200:
-                img_data = BytesIO(response.content)
-                try:
-                    Image.open(img_data).verify()
-                    img_data.seek(0)
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=img_data,
-                        caption=text,
-                        reply_markup=reply_markup
-                    )
-                    logger.info(f"Рекомендованное изображение отправлено: {image_url}")
-                except Exception as e:
-                    logger.error(f"Ошибка проверки рекомендованного изображения: {e}")
-                    raise
-            else:
-                logger.warning(f"Не удалось загрузить рекомендованное изображение, статус: {response.status_code}")
-                raise Exception(f"Статус: {response.status_code}")
+            try:
+                await send_meme_photo(
+                    context, update.effective_chat.id, meme_id, image_url, text, reply_markup
+                )
+            except Exception as e:
+                logger.error(f"Ошибка проверки рекомендованного изображения: {e}")
+                raise
+            logger.info(f"Рекомендованное изображение отправлено: {image_url}")
         else:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -735,6 +970,15 @@ def cleanup_lock():
     except Exception as e:
         logger.error(f"Ошибка при удалении lock-файла: {e}")
 
+async def on_shutdown(application: Application) -> None:
+    """
+    Освобождает общие ресурсы и сбрасывает состояние на диск при остановке приложения.
+    PTB вызывает его и когда run_polling завершается ошибкой Conflict, поэтому здесь
+    только сброс данных; окончательная остановка - в main после цикла повторных попыток.
+    """
+    await close_http_client()
+    flush_state()
+
 def main():
     """Основная функция для запуска бота"""
     signal.signal(signal.SIGINT, signal_handler)
@@ -765,7 +1009,7 @@ def main():
     update_thread.daemon = True
     update_thread.start()
     
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(on_shutdown).build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("next", next_command))
@@ -779,58 +1023,44 @@ def main():
         logger.error("Не удалось создать lock-файл или бот уже запущен. Завершаем работу.")
         sys.exit(1)
     
-    original_sigterm_handler = signal.getsignal(signal.SIGTERM)
-    original_sigint_handler = signal.getsignal(signal.SIGINT)
-    
-    def cleanup_and_forward(sig, frame):
-        cleanup_lock()
-        if sig == signal.SIGTERM and callable(original_sigterm_handler):
-            try:
-                original_sigterm_handler(sig, frame)
-            except Exception as e:
-                logger.error(f"Ошибка при вызове оригинального SIGTERM обработчика: {e}")
-        elif sig == signal.SIGINT and callable(original_sigint_handler):
+    # Запуск бота с повторными попытками при конфликтах. run_polling ставит свои обработчики
+    # SIGINT/SIGTERM и при каждой остановке вызывает on_shutdown (только сброс данных);
+    # lock-файл удаляется в finally, а окончательная остановка выполняется один раз после всех попыток
+    try:
+        for attempt in range(CONFLICT_RETRIES):
             try:
-                original_sigint_handler(sig, frame)
-            except Exception as e:
-                logger.error(f"Ошибка при вызове оригинального SIGINT обработчика: {e}")
-    
-    signal.signal(signal.SIGTERM, cleanup_and_forward)
-    signal.signal(signal.SIGINT, cleanup_and_forward)
-    
-    # Запуск бота с повторными попытками при конфликтах
-    for attempt in range(CONFLICT_RETRIES):
-        try:
-            logger.info(f"Запуск бота в режиме polling (попытка {attempt + 1}/{CONFLICT_RETRIES})...")
-            application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True,
-                close_loop=False,
-                connect_timeout=30,
-                read_timeout=30
-            )
-            break
-        except telegram.error.Conflict as conflict_error:
-            logger.error(f"Обнаружен конфликт Telegram API: {conflict_error}. Проверяем запущенные экземпляры...")
-            if attempt < CONFLICT_RETRIES - 1:
-                delay = CONFLICT_RETRY_DELAY + random.uniform(0, 5)  # Случайная задержка
-                logger.info(f"Ожидаем {delay:.1f} секунд перед повторной попыткой...")
-                time.sleep(delay)
-                # Проверяем lock-файл перед повторной попыткой
-                if not check_and_create_lock():
-                    logger.error("Другой экземпляр бота всё ещё работает. Завершаем.")
+                logger.info(f"Запуск бота в режиме polling (попытка {attempt + 1}/{CONFLICT_RETRIES})...")
+                application.run_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True,
+                    close_loop=False,
+                    connect_timeout=30,
+                    read_timeout=30
+                )
+                break
+            except telegram.error.Conflict as conflict_error:
+                logger.error(f"Обнаружен конфликт Telegram API: {conflict_error}. Проверяем запущенные экземпляры...")
+                if attempt < CONFLICT_RETRIES - 1:
+                    delay = CONFLICT_RETRY_DELAY + random.uniform(0, 5)  # Случайная задержка
+                    logger.info(f"Ожидаем {delay:.1f} секунд перед повторной попыткой...")
+                    time.sleep(delay)
+                    # Проверяем lock-файл перед повторной попыткой
+                    if not check_and_create_lock():
+                        logger.error("Другой экземпляр бота всё ещё работает. Завершаем.")
+                        cleanup_lock()
+                        sys.exit(1)
+                else:
+                    logger.error("Достигнуто максимальное количество попыток. Завершаем работу.")
                     cleanup_lock()
                     sys.exit(1)
-            else:
-                logger.error("Достигнуто максимальное количество попыток. Завершаем работу.")
+            except Exception as e:
+                logger.error(f"Ошибка при запуске бота: {e}")
                 cleanup_lock()
                 sys.exit(1)
-        except Exception as e:
-            logger.error(f"Ошибка при запуске бота: {e}")
-            cleanup_lock()
-            sys.exit(1)
-        finally:
-            cleanup_lock()
+            finally:
+                cleanup_lock()
+    finally:
+        save_state_on_exit()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Модуль локального дискового кэша изображений мемов.
+Изображения хранятся по ключу SHA-256 от URL, объём кэша ограничен,
+при переполнении удаляются давно не использованные файлы (LRU).
+Запись атомарная, поэтому прерванная загрузка не оставляет битых файлов.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Параметры кэша
+IMAGE_CACHE_DIR = "image_cache"                  # Директория кэша изображений
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024        # Максимальный объём кэша (256 МБ)
+
+class ImageCache:
+    """Дисковый кэш изображений с вытеснением давно не использованных записей"""
+
+    def __init__(self, cache_dir: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # ключ: размер, от старых к новым
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._scan()
+
+    @staticmethod
+    def make_key(image_url: str) -> str:
+        """Возвращает ключ кэша для URL изображения"""
+        return hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        """Путь к файлу записи (с подкаталогом по первым символам ключа)"""
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _scan(self):
+        """Восстанавливает индекс кэша по файлам на диске, упорядочивая их по времени доступа"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    # Остатки прерванной записи
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        if found:
+            logger.info(f"Кэш изображений: найдено {len(found)} файлов, {self._total_bytes} байт")
+        self._evict()
+
+    def contains(self, image_url: str) -> bool:
+        """Проверяет наличие изображения в кэше без чтения файла и без учета в статистике"""
+        key = self.make_key(image_url)
+        with self._lock:
+            return key in self._entries
+
+    def get(self, image_url: str) -> Optional[bytes]:
+        """Возвращает изображение из кэша или None, если его там нет"""
+        key = self.make_key(image_url)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Обновляем время доступа, чтобы порядок LRU сохранялся между перезапусками
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, image_url: str, data: bytes):
+        """Сохраняет изображение в кэш (атомарно) и при необходимости вытесняет старые записи"""
+        if not data or len(data) > self.max_bytes:
+            return
+        key = self.make_key(image_url)
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except Exception as e:
+            logger.error(f"Ошибка при записи изображения в кэш {image_url}: {e}")
+            return
+        with self._lock:
+            old_size = self._entries.pop(key, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        """Удаляет самые старые записи, пока объём кэша превышает лимит"""
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict:
+        """Возвращает статистику использования кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+# Общий кэш изображений процесса
+image_cache = ImageCache()
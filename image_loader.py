@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Модуль асинхронной загрузки изображений мемов.
+Использует общий HTTP-клиент с пулом соединений, keep-alive и ограничением
+числа одновременных запросов к одному хосту, чтобы медленный ответ CDN VK
+не блокировал цикл событий бота.
+"""
+import asyncio
+import logging
+from io import BytesIO
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+try:
+    from PIL import Image
+except ImportError:
+    pass  # PIL может быть недоступен в некоторых средах
+
+from image_cache import image_cache
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Заголовки для запросов к CDN VK
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# Параметры пула соединений
+IMAGE_FETCH_TIMEOUT = 10          # Таймаут загрузки изображения (сек)
+MAX_CONNECTIONS = 50              # Максимум одновременных соединений клиента
+MAX_KEEPALIVE_CONNECTIONS = 20    # Максимум соединений, удерживаемых в пуле
+KEEPALIVE_EXPIRY = 30             # Время жизни простаивающего соединения (сек)
+MAX_CONNECTIONS_PER_HOST = 6      # Максимум одновременных запросов к одному хосту
+
+# Общий клиент и семафоры по хостам (создаются лениво внутри цикла событий)
+_http_client: Optional[httpx.AsyncClient] = None
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий асинхронный HTTP-клиент, создавая его при первом обращении"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            headers=HTTP_HEADERS,
+            timeout=httpx.Timeout(IMAGE_FETCH_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            ),
+            follow_redirects=True
+        )
+        logger.info("Создан общий HTTP-клиент для загрузки изображений")
+    return _http_client
+
+def _get_host_semaphore(url: str) -> asyncio.Semaphore:
+    """Возвращает семафор, ограничивающий число запросов к хосту из URL"""
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+        _host_semaphores[host] = semaphore
+    return semaphore
+
+def _verify_image(img_data: BytesIO):
+    """Проверяет целостность изображения (выполняется вне цикла событий)"""
+    Image.open(img_data).verify()
+    img_data.seek(0)
+
+async def fetch_image(image_url: str) -> BytesIO:
+    """
+    Асинхронно загружает и проверяет изображение мема.
+    Сначала ищет изображение в дисковом кэше, проверенные загрузки сохраняет в него.
+
+    Args:
+        image_url (str): URL изображения
+
+    Returns:
+        BytesIO: Проверенные данные изображения, готовые к отправке
+
+    Raises:
+        Exception: Если изображение недоступно или повреждено
+    """
+    # В кэш попадают только проверенные изображения, повторная проверка не нужна
+    cached = await asyncio.to_thread(image_cache.get, image_url)
+    if cached is not None:
+        return BytesIO(cached)
+
+    client = get_http_client()
+    async with _get_host_semaphore(image_url):
+        response = await client.get(image_url)
+
+    if response.status_code != 200:
+        logger.warning(f"Не удалось загрузить изображение, статус: {response.status_code}")
+        raise Exception(f"Статус: {response.status_code}")
+
+    img_data = BytesIO(response.content)
+    # Проверка PIL нагружает CPU, поэтому выполняем ее в отдельном потоке
+    await asyncio.to_thread(_verify_image, img_data)
+    await asyncio.to_thread(image_cache.put, image_url, response.content)
+    return img_data
+
+async def close_http_client():
+    """Закрывает общий HTTP-клиент при остановке бота"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logger.info("Общий HTTP-клиент для загрузки изображений закрыт")
+    _http_client = None
+    _host_semaphores.clear()
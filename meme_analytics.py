@@ -3,16 +3,32 @@
 Модуль аналитики популярности мемов и статистики взаимодействия пользователей.
 Отслеживает популярные мемы, тенденции в оценках и предоставляет
 инструменты для анализа эффективности рекомендательной системы.
+
+События (просмотры, оценки, сессии) применяются к данным в памяти и копятся
+в хранилище (модуль storage). Планировщик в фоновом потоке записывает их пакетом,
+когда накопилось ANALYTICS_FLUSH_MAX_EVENTS событий или прошло ANALYTICS_FLUSH_INTERVAL
+секунд: в файловом бэкенде - в журнал событий (снимок всех данных сохраняется реже),
+в бэкенде SQLite - в базу вместе с изменившимися счетчиками. При остановке бота
+накопленные события сбрасываются функцией shutdown_analytics.
 """
 
+import atexit
+import heapq
+import itertools
+import math
 import os
 import json
 import time
 import logging
+import threading
 from typing import Dict, List, Tuple, Optional, Any, Union, Set
 from collections import Counter, defaultdict
 import datetime
 
+from storage import (
+    STORAGE_BACKEND, SQLITE_DB_FILE, AnalyticsStorage, JsonAnalyticsStorage, SQLiteAnalyticsStorage
+)
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
@@ -23,6 +39,15 @@ TRENDING_MEMES_FILE = os.path.join(ANALYTICS_DIR, "trending_memes.json")
 RATING_HISTORY_FILE = os.path.join(ANALYTICS_DIR, "rating_history.json")
 USER_ACTIVITY_FILE = os.path.join(ANALYTICS_DIR, "user_activity.json")
 SESSION_STATS_FILE = os.path.join(ANALYTICS_DIR, "session_stats.json")
+# Снимок всех данных аналитики с номером последнего учтенного события (файлы выше читаются,
+# только если снимка еще нет) и журнал событий после снимка
+ANALYTICS_SNAPSHOT_FILE = os.path.join(ANALYTICS_DIR, "snapshot.json")
+ANALYTICS_LOG_FILE = os.path.join(ANALYTICS_DIR, "events.log")
+ANALYTICS_COMPACT_INTERVAL = 300                   # Интервал сохранения снимка аналитики (сек)
+ANALYTICS_COMPACT_LOG_BYTES = 2 * 1024 * 1024      # Размер журнала, при котором снимок сохраняется досрочно
+ANALYTICS_FLUSH_INTERVAL = 5                       # Максимальная задержка записи события на диск (сек)
+ANALYTICS_FLUSH_MAX_EVENTS = 500                   # Столько накопленных событий записываются досрочно
+RATING_HISTORY_LIMIT = 1000                        # Сколько последних оценок хранится в памяти
 
 # Убедимся, что директория для аналитики существует
 if not os.path.exists(ANALYTICS_DIR):
@@ -45,74 +70,541 @@ session_stats = {
 DAY_SECONDS = 86400  # 24 часа в секундах
 HOUR_SECONDS = 3600  # 1 час в секундах
 WEEK_SECONDS = 604800  # 7 дней в секундах
+MONTH_SECONDS = DAY_SECONDS * 30
+REGULAR_USER_MIN_RATINGS = 10  # Постоянные пользователи - с большим числом оценок
+TRENDING_DAYS = 7              # Максимальный период трендов (дней)
+# Ранжирование трендов: "average" - средний дневной скор за период,
+# "wilson" - нижняя граница доверительного интервала Уилсона для доли лайков за период
+# (мем с 2 лайками из 2 не обгоняет мем с 95 из 100)
+TRENDING_SCORING = "average"
+WILSON_Z = 1.96                # Квантиль нормального распределения для интервала Уилсона (95%)
+
+class ActiveUsersWindow:
+    """
+    Число пользователей, активных за последние сутки, неделю и месяц, с точностью до часа.
+    Кольцо часовых корзин: каждый пользователь лежит в корзине часа своей последней
+    активности, а для каждого окна ведется счетчик пользователей в его корзинах.
+    Отметка активности и запрос числа активных - O(1) (со сдвигом окон раз в час),
+    память - по одной записи на пользователя, активного за самое длинное окно.
+    """
+
+    def __init__(self, windows: Tuple[int, ...] = (DAY_SECONDS, WEEK_SECONDS, MONTH_SECONDS)):
+        # Окно в часах: текущий час и предыдущие
+        self.windows = {seconds: seconds // HOUR_SECONDS for seconds in windows}
+        self._span = max(self.windows.values())
+        self._buckets: Dict[int, Set[int]] = {}     # час: пользователи с последней активностью в этот час
+        self._user_hours: Dict[int, int] = {}       # пользователь: час последней активности
+        self._counts = dict.fromkeys(self.windows, 0)
+        self._hour = 0                              # Текущий час
+
+    def rebuild(self, activity: Dict[int, Dict], now: float):
+        """Заполняет окна заново по времени последней активности пользователей"""
+        self._buckets.clear()
+        self._user_hours.clear()
+        self._counts = dict.fromkeys(self.windows, 0)
+        self._hour = int(now) // HOUR_SECONDS
+        for user_id, data in activity.items():
+            self.touch(user_id, data.get("last_active", 0))
+
+    def touch(self, user_id: int, timestamp: float):
+        """Отмечает активность пользователя в момент timestamp"""
+        hour = int(timestamp) // HOUR_SECONDS
+        self._advance(hour)
+        previous = self._user_hours.get(user_id)
+        if previous is not None:
+            if previous >= hour:
+                return
+            self._move(user_id, previous, -1)
+        if hour > self._hour - self._span:
+            self._user_hours[user_id] = hour
+            self._move(user_id, hour, 1)
+
+    def count(self, window: int, now: Optional[float] = None) -> int:
+        """Число пользователей, активных за окно window (сек) на момент now"""
+        self._advance(int(time.time() if now is None else now) // HOUR_SECONDS)
+        return self._counts[window]
+
+    def _move(self, user_id: int, hour: int, delta: int):
+        """Добавляет (delta=1) или убирает (delta=-1) пользователя из корзины часа"""
+        if delta > 0:
+            self._buckets.setdefault(hour, set()).add(user_id)
+        else:
+            bucket = self._buckets.get(hour)
+            if bucket is not None:
+                bucket.discard(user_id)
+                if not bucket:
+                    del self._buckets[hour]
+            del self._user_hours[user_id]
+        for window, hours in self.windows.items():
+            if hour > self._hour - hours:
+                self._counts[window] += delta
+
+    def _advance(self, hour: int):
+        """Сдвигает окна к часу hour: корзины, вышедшие из окна, вычитаются из его счетчика"""
+        if hour <= self._hour:
+            return
+        if hour - self._hour >= self._span:
+            # Все корзины вышли из всех окон
+            self._buckets.clear()
+            self._user_hours.clear()
+            self._counts = dict.fromkeys(self.windows, 0)
+            self._hour = hour
+            return
+        for step in range(self._hour + 1, hour + 1):
+            for window, hours in self.windows.items():
+                bucket = self._buckets.get(step - hours)
+                if bucket:
+                    self._counts[window] -= len(bucket)
+            # Корзина, вышедшая из самого длинного окна, больше не нужна
+            expired = self._buckets.pop(step - self._span, None)
+            if expired:
+                for user_id in expired:
+                    del self._user_hours[user_id]
+        self._hour = hour
+
+def _create_storage() -> AnalyticsStorage:
+    """Создает хранилище аналитики выбранного бэкенда"""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteAnalyticsStorage(SQLITE_DB_FILE)
+    if STORAGE_BACKEND != "json":
+        logger.warning(f"Неизвестный бэкенд хранения {STORAGE_BACKEND}, используются файлы JSON")
+    return _create_json_storage()
+
+def _create_json_storage() -> JsonAnalyticsStorage:
+    return JsonAnalyticsStorage(ANALYTICS_SNAPSHOT_FILE, ANALYTICS_LOG_FILE,
+                                ANALYTICS_COMPACT_INTERVAL, ANALYTICS_COMPACT_LOG_BYTES)
+
+# Блокировка данных аналитики (записывает их на диск фоновый поток)
+analytics_lock = threading.RLock()
+_storage = _create_storage()
+_save_lock = threading.Lock()   # Сохранения выполняются по одному, иначе старый снимок может затереть новый
+_pending_events = 0             # События после последней записи (признак несохраненных изменений)
+_flush_thread = None
+_flush_wakeup = threading.Event()
+_flush_stop = threading.Event()
+
+def _daily_trend_score(likes: int, dislikes: int) -> int:
+    """Дневной скор мема от 0 до 100"""
+    total = likes + dislikes
+    # Формула для расчета тренда: (лайки - дизлайки) / (общее количество)
+    # Это дает нам значение от -1 до 1, которое мы масштабируем до 0-100
+    if total > 0:
+        return int(((likes - dislikes) / total + 1) * 50)
+    return 50  # Нейтральный скор, если нет оценок
+
+def _wilson_lower_bound(likes: int, dislikes: int) -> float:
+    """Нижняя граница интервала Уилсона для доли лайков"""
+    total = likes + dislikes
+    if total == 0:
+        return 0.0
+    share = likes / total
+    z2 = WILSON_Z * WILSON_Z
+    center = share + z2 / (2 * total)
+    spread = WILSON_Z * math.sqrt((share * (1 - share) + z2 / (4 * total)) / total)
+    return (center - spread) / (1 + z2 / total)
+
+class TrendingWindow:
+    """
+    Тренды мемов в скользящем окне дней.
+    Дневные счетчики хранятся в корзинах по дням (словарь trending_memes, формат
+    хранилища не меняется), корзины старше TRENDING_DAYS удаляются при смене дня.
+    Для каждого периода 1..TRENDING_DAYS дней ведутся суммы по мемам и куча
+    для top-k с ленивым удалением устаревших записей: оценка обновляет O(TRENDING_DAYS)
+    сумм без разбора дат, запрос top-k не сортирует все мемы.
+    """
+
+    def __init__(self, days: int = TRENDING_DAYS):
+        self.days = days
+        self.by_day: Dict[str, Dict[str, Dict]] = {}   # дата: мем: {score, likes, dislikes}
+        self._ordinals: Dict[str, int] = {}             # дата: номер дня
+        self._today = 0
+        # Кэш текущего дня: [начало, конец) в unix time, номер дня и дата
+        self._day_cache = (0.0, 0.0, 0, "")
+        # Для периода d: мем -> [сумма дневных скоров, лайки, дизлайки, дней, версия]
+        self._totals: List[Dict[str, List]] = [{} for _ in range(days + 1)]
+        self._heaps: List[List[Tuple]] = [[] for _ in range(days + 1)]
+        self._versions = itertools.count()
+
+    def rebuild(self, by_day: Dict[str, Dict[str, Dict]], now: float):
+        """Строит окно по сохраненным дневным счетчикам (словарь используется без копирования)"""
+        self.by_day = by_day
+        self._ordinals = {}
+        for key in list(by_day):
+            try:
+                self._ordinals[key] = datetime.date.fromisoformat(key).toordinal()
+            except ValueError:
+                logger.warning(f"Пропущен день трендов с некорректной датой {key}")
+                del by_day[key]
+        self._today = self._day_of(now)[0]
+        self._prune()
+        self._rebuild_totals()
+
+    def update(self, meme_id: str, rating: int, now: float):
+        """Учитывает оценку мема в момент now"""
+        ordinal, key = self._day_of(now)
+        if ordinal > self._today:
+            self._today = ordinal
+            self._prune()
+            self._rebuild_totals()
+        age = self._today - ordinal
+        if age > self.days:
+            return
+        day = self.by_day.get(key)
+        if day is None:
+            day = self.by_day[key] = {}
+            self._ordinals[key] = ordinal
+        data = day.get(meme_id)
+        first = data is None
+        if first:
+            data = day[meme_id] = {"score": 0, "likes": 0, "dislikes": 0}
+        like = 1 if rating == 1 else 0
+        dislike = 1 if rating == -1 else 0
+        data["likes"] += like
+        data["dislikes"] += dislike
+        old_score = data["score"]
+        data["score"] = _daily_trend_score(data["likes"], data["dislikes"])
+        # День входит в периоды длиннее его возраста
+        for period in range(age + 1, self.days + 1):
+            total = self._totals[period].get(meme_id)
+            if total is None:
+                total = self._totals[period][meme_id] = [0, 0, 0, 0, 0]
+            total[0] += data["score"] - (0 if first else old_score)
+            total[1] += like
+            total[2] += dislike
+            total[3] += first
+            self._push(period, meme_id, total)
+
+    def top(self, limit: int, days: int, now: float) -> List[Tuple[str, List]]:
+        """Лучшие мемы за days дней: список (ID мема, [сумма скоров, лайки, дизлайки, дней, версия])"""
+        self._advance(now)
+        heap = self._heaps[days]
+        totals = self._totals[days]
+        result = []
+        valid = []
+        while heap and len(result) < limit:
+            entry = heapq.heappop(heap)
+            total = totals.get(entry[2])
+            if total is not None and total[4] == entry[1]:
+                result.append((entry[2], total))
+                valid.append(entry)
+        for entry in valid:
+            heapq.heappush(heap, entry)
+        return result
+
+    def trend_position(self, meme_id: str, now: float) -> Optional[int]:
+        """Место мема в трендах сегодняшнего дня (с 1) или None"""
+        self._advance(now)
+        day = self.by_day.get(self._day_of(now)[1])
+        if not day or meme_id not in day:
+            return None
+        score = day[meme_id]["score"]
+        position = 1
+        # Порядок как при устойчивой сортировке по убыванию скора, без сортировки
+        before = True
+        for other_id, data in day.items():
+            if other_id == meme_id:
+                before = False
+            elif data["score"] > score or (before and data["score"] == score):
+                position += 1
+        return position
+
+    def _advance(self, now: float):
+        """Сдвигает окно к дню момента now"""
+        ordinal = self._day_of(now)[0]
+        if ordinal > self._today:
+            self._today = ordinal
+            self._prune()
+            self._rebuild_totals()
+
+    def _day_of(self, timestamp: float) -> Tuple[int, str]:
+        """Номер дня и дата момента timestamp (границы текущего дня кэшируются)"""
+        start, end, ordinal, key = self._day_cache
+        if start <= timestamp < end:
+            return ordinal, key
+        day = datetime.date.fromtimestamp(timestamp)
+        start = time.mktime(day.timetuple())
+        end = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+        self._day_cache = (start, end, day.toordinal(), day.strftime("%Y-%m-%d"))
+        return self._day_cache[2], self._day_cache[3]
+
+    def _prune(self):
+        """Удаляет дни старше окна (при смене дня)"""
+        for key, ordinal in list(self._ordinals.items()):
+            if self._today - ordinal > self.days:
+                del self._ordinals[key]
+                self.by_day.pop(key, None)
+
+    def _rebuild_totals(self):
+        """Пересчитывает суммы и кучи всех периодов (при загрузке и смене дня)"""
+        self._totals = [{} for _ in range(self.days + 1)]
+        self._heaps = [[] for _ in range(self.days + 1)]
+        for key, memes in self.by_day.items():
+            age = self._today - self._ordinals[key]
+            for period in range(max(age, 0) + 1, self.days + 1):
+                totals = self._totals[period]
+                for meme_id, data in memes.items():
+                    total = totals.get(meme_id)
+                    if total is None:
+                        total = totals[meme_id] = [0, 0, 0, 0, 0]
+                    total[0] += data.get("score", 0)
+                    total[1] += data.get("likes", 0)
+                    total[2] += data.get("dislikes", 0)
+                    total[3] += 1
+        for period in range(1, self.days + 1):
+            heap = self._heaps[period]
+            for meme_id, total in self._totals[period].items():
+                total[4] = next(self._versions)
+                heap.append((-self._rank(total), total[4], meme_id))
+            heapq.heapify(heap)
+
+    def _push(self, period: int, meme_id: str, total: List):
+        """Кладет в кучу периода новую запись мема; прежние записи становятся устаревшими"""
+        total[4] = next(self._versions)
+        heap = self._heaps[period]
+        heapq.heappush(heap, (-self._rank(total), total[4], meme_id))
+        if len(heap) > 2 * len(self._totals[period]) + 64:
+            # Убираем накопившиеся устаревшие записи
+            totals = self._totals[period]
+            heap[:] = [entry for entry in heap if totals[entry[2]][4] == entry[1]]
+            heapq.heapify(heap)
+
+    @staticmethod
+    def _rank(total: List) -> float:
+        """Значение, по которому мем ранжируется в трендах периода"""
+        if TRENDING_SCORING == "wilson":
+            return _wilson_lower_bound(total[1], total[2])
+        return int(total[0] / total[3]) if total[3] else 0
+
+    @staticmethod
+    def trend_score(total: List) -> int:
+        """Скор тренда мема за период от 0 до 100"""
+        if TRENDING_SCORING == "wilson":
+            return int(round(_wilson_lower_bound(total[1], total[2]) * 100))
+        return int(total[0] / total[3]) if total[3] else 0
+
+# Тренды мемов за последние дни (ведутся при каждой оценке)
+trending = TrendingWindow()
+
+# Активные пользователи по окнам и число постоянных пользователей (ведутся при каждом событии)
+active_users = ActiveUsersWindow()
+_regular_users = 0
+
+def _default_user_activity() -> Dict:
+    return {"ratings": 0, "last_active": 0, "sessions": 0}
+
+def _reset_analytics():
+    """Сбрасывает данные аналитики в памяти к пустым значениям"""
+    global popular_memes, trending_memes, rating_history, user_activity, session_stats, _regular_users
+    popular_memes = {}
+    trending_memes = {}
+    rating_history = []
+    user_activity = defaultdict(_default_user_activity)
+    trending.rebuild(trending_memes, time.time())
+    active_users.rebuild({}, time.time())
+    _regular_users = 0
+    session_stats = {
+        "total_sessions": 0,
+        "active_users": 0,
+        "today_ratings": 0,
+        "total_ratings": 0,
+        "last_update": 0
+    }
+
+def _current_state() -> Dict:
+    """Данные аналитики в памяти в виде состояния хранилища (вызывается под блокировкой)"""
+    return {
+        "popular_memes": popular_memes,
+        "trending_memes": trending_memes,
+        "rating_history": rating_history,
+        "user_activity": user_activity,
+        "session_stats": session_stats
+    }
+
+def _set_state(state: Dict):
+    """Заменяет данные аналитики в памяти состоянием из хранилища"""
+    global popular_memes, trending_memes, rating_history, session_stats, _regular_users
+    popular_memes = state["popular_memes"]
+    trending_memes = state["trending_memes"]
+    rating_history = state["rating_history"]
+    session_stats = state["session_stats"]
+    # JSON хранит ключи как строки, ID пользователей - целые числа
+    for user_id, data in state["user_activity"].items():
+        user_activity[int(user_id)] = data
+    trending.rebuild(trending_memes, time.time())
+    active_users.rebuild(user_activity, time.time())
+    _regular_users = sum(1 for data in user_activity.values() if data.get("ratings", 0) > REGULAR_USER_MIN_RATINGS)
 
 def _load_analytics_files():
-    """Загружает данные аналитики из файлов"""
-    global popular_memes, trending_memes, rating_history, user_activity, session_stats
-    
-    try:
-        # Загрузка популярных мемов
-        if os.path.exists(POPULAR_MEMES_FILE):
-            with open(POPULAR_MEMES_FILE, 'r', encoding='utf-8') as f:
-                popular_memes = json.load(f)
-        
-        # Загрузка трендовых мемов
-        if os.path.exists(TRENDING_MEMES_FILE):
-            with open(TRENDING_MEMES_FILE, 'r', encoding='utf-8') as f:
-                trending_memes = json.load(f)
-        
-        # Загрузка истории оценок
-        if os.path.exists(RATING_HISTORY_FILE):
-            with open(RATING_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                rating_history = json.load(f)
-        
-        # Загрузка активности пользователей
-        if os.path.exists(USER_ACTIVITY_FILE):
-            with open(USER_ACTIVITY_FILE, 'r', encoding='utf-8') as f:
-                user_activity_data = json.load(f)
-                # Конвертируем ключи обратно в int, так как JSON хранит ключи как строки
-                user_activity = defaultdict(lambda: {"ratings": 0, "last_active": 0, "sessions": 0})
-                for user_id, data in user_activity_data.items():
-                    user_activity[int(user_id)] = data
-        
-        # Загрузка статистики сессий
-        if os.path.exists(SESSION_STATS_FILE):
-            with open(SESSION_STATS_FILE, 'r', encoding='utf-8') as f:
-                session_stats = json.load(f)
-        
-        logger.info("Аналитические данные успешно загружены")
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке аналитических данных: {e}")
+    """
+    Загружает данные аналитики из хранилища. Если хранилище пустое, данные
+    переносятся из прежнего места: снимка и журнала JSON (при переходе на SQLite)
+    или отдельных файлов старого формата.
+    """
+    with analytics_lock:
+        _reset_analytics()
+        try:
+            state, events = _storage.load(RATING_HISTORY_LIMIT)
+            imported = False
+            if state is None:
+                if not isinstance(_storage, JsonAnalyticsStorage) and (
+                        os.path.exists(ANALYTICS_SNAPSHOT_FILE) or os.path.exists(ANALYTICS_LOG_FILE)):
+                    previous = _create_json_storage()
+                    state, events = previous.load(RATING_HISTORY_LIMIT)
+                    previous.close()
+                    imported = True
+                if state is None:
+                    state = _load_legacy_files()
+                    imported = imported or state is not None
+            if state is not None:
+                _set_state(state)
+            for event in events:
+                _apply_event(event)
+            if events:
+                logger.info(f"Из журнала аналитики восстановлено {len(events)} событий")
+            if imported and not isinstance(_storage, JsonAnalyticsStorage):
+                del rating_history[:-RATING_HISTORY_LIMIT]
+                _storage.import_state(_current_state())
+            logger.info("Аналитические данные успешно загружены")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке аналитических данных: {e}")
+
+def _load_legacy_files() -> Optional[Dict]:
+    """Загружает данные аналитики из отдельных файлов старого формата (None, если файлов нет)"""
+    state = {"popular_memes": {}, "trending_memes": {}, "rating_history": [], "user_activity": {},
+             "session_stats": session_stats}
+    found = False
+    for key, path in (("popular_memes", POPULAR_MEMES_FILE), ("trending_memes", TRENDING_MEMES_FILE),
+                      ("rating_history", RATING_HISTORY_FILE), ("user_activity", USER_ACTIVITY_FILE),
+                      ("session_stats", SESSION_STATS_FILE)):
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                state[key] = json.load(f)
+            found = True
+    return state if found else None
 
 def _save_analytics_files():
-    """Сохраняет данные аналитики в файлы"""
+    """
+    Сохраняет данные аналитики в хранилище. Данные для записи готовятся под
+    блокировкой, а запись на диск идет без нее, чтобы не задерживать обработку событий.
+    """
     try:
-        # Сохранение популярных мемов
-        with open(POPULAR_MEMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(popular_memes, f, ensure_ascii=False)
-        
-        # Сохранение трендовых мемов
-        with open(TRENDING_MEMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(trending_memes, f, ensure_ascii=False)
-        
-        # Сохранение истории оценок (ограничиваем до 1000 последних записей)
-        with open(RATING_HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(rating_history[-1000:], f, ensure_ascii=False)
-        
-        # Сохранение активности пользователей
-        with open(USER_ACTIVITY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(dict(user_activity), f, ensure_ascii=False)
-        
-        # Сохранение статистики сессий
-        with open(SESSION_STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(session_stats, f, ensure_ascii=False)
-        
-        logger.debug("Аналитические данные успешно сохранены")
+        with _save_lock:
+            with analytics_lock:
+                # Старые оценки в истории больше не нужны и в памяти
+                del rating_history[:-RATING_HISTORY_LIMIT]
+                prepared = _storage.prepare_save(_current_state())
+            _storage.write_save(prepared)
+            with analytics_lock:
+                _storage.complete_save(prepared)
     except Exception as e:
         logger.error(f"Ошибка при сохранении аналитических данных: {e}")
 
-# Инициализация - загружаем существующие данные
-_load_analytics_files()
+def flush_analytics(force_save: bool = False):
+    """
+    Записывает накопленные события на диск и сохраняет данные, если хранилище
+    этого требует (или force_save)
+    """
+    global _pending_events
+    with analytics_lock:
+        dirty, _pending_events = _pending_events, 0
+    if dirty or _storage.has_pending():
+        try:
+            _storage.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при записи журнала аналитики: {e}")
+    if force_save or _storage.should_save():
+        _save_analytics_files()
+
+def _record_event(event: Dict):
+    """Применяет событие к данным аналитики и ставит его в очередь записи"""
+    global _pending_events
+    with analytics_lock:
+        _apply_event(event)
+        _storage.append(event)
+        _pending_events += 1
+        overflow = _pending_events >= ANALYTICS_FLUSH_MAX_EVENTS
+    if overflow:
+        # Будим планировщик, не дожидаясь интервала
+        _flush_wakeup.set()
+    _ensure_flush_thread()
+
+def _apply_event(event: Dict):
+    """Применяет событие к данным аналитики (также используется при восстановлении из журнала)"""
+    event_type = event["type"]
+    if event_type == "view":
+        _apply_view(event["meme_id"], event["user_id"], event["timestamp"])
+    elif event_type == "rating":
+        _apply_rating(event["meme_id"], event["user_id"], event["rating"], event["timestamp"])
+    elif event_type == "session":
+        _apply_session(event["user_id"], event["timestamp"])
+    else:
+        logger.warning(f"Неизвестный тип события аналитики: {event_type}")
+
+def _flush_loop():
+    """
+    Фоновый поток-планировщик: записывает накопленные события раз в
+    ANALYTICS_FLUSH_INTERVAL секунд или сразу, когда их накопилось много
+    """
+    while not _flush_stop.is_set():
+        _flush_wakeup.wait(ANALYTICS_FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        if _flush_stop.is_set():
+            break
+        flush_analytics()
+
+def _ensure_flush_thread():
+    """Запускает планировщик записи, если он еще не запущен"""
+    global _flush_thread
+    if _flush_stop.is_set():
+        return
+    if _flush_thread is None or not _flush_thread.is_alive():
+        _flush_thread = threading.Thread(target=_flush_loop, name="analytics-flush", daemon=True)
+        _flush_thread.start()
+
+def shutdown_analytics():
+    """
+    Останавливает планировщик, сохраняет все данные аналитики и закрывает хранилище.
+    Вызывается при завершении бота; повторный вызов ничего не делает.
+    """
+    if _flush_stop.is_set():
+        return
+    _flush_stop.set()
+    _flush_wakeup.set()
+    if _flush_thread is not None and _flush_thread is not threading.current_thread():
+        _flush_thread.join(timeout=ANALYTICS_FLUSH_INTERVAL)
+    flush_analytics(force_save=True)
+    with analytics_lock:
+        _storage.close()
+    logger.info("Данные аналитики сохранены перед завершением")
+
+def get_rating_history(user_id: Optional[int] = None, meme_id: Optional[str] = None,
+                       since: Optional[int] = None, limit: int = 100) -> List[Dict]:
+    """
+    Возвращает последние оценки, при необходимости отфильтрованные
+    
+    Args:
+        user_id (int): Только оценки пользователя
+        meme_id (str): Только оценки мема
+        since (int): Только оценки не раньше этого времени (unix time)
+        limit (int): Максимальное количество оценок
+    
+    Returns:
+        List[Dict]: Оценки в порядке времени. В бэкенде SQLite запрос идет по индексу
+        полной истории, иначе - по последним RATING_HISTORY_LIMIT оценкам в памяти
+    """
+    if _storage.keeps_full_history:
+        # Оценки, еще не записанные в базу, тоже должны попасть в результат
+        if _storage.has_pending():
+            _save_analytics_files()
+        return _storage.rating_history(user_id, meme_id, since, limit)
+    with analytics_lock:
+        result = [
+            entry for entry in rating_history
+            if (user_id is None or entry["user_id"] == user_id)
+            and (meme_id is None or entry["meme_id"] == meme_id)
+            and (since is None or entry["timestamp"] >= since)
+        ]
+    return result[-limit:] if limit else result
 
 def record_meme_view(meme_id: str, user_id: int):
     """
@@ -122,8 +614,10 @@ def record_meme_view(meme_id: str, user_id: int):
         meme_id (str): Идентификатор мема
         user_id (int): Идентификатор пользователя
     """
-    now = time.time()
-    
+    _record_event({"type": "view", "meme_id": meme_id, "user_id": user_id, "timestamp": int(time.time())})
+
+def _apply_view(meme_id: str, user_id: int, now: float):
+    """Учитывает просмотр мема в данных аналитики"""
     # Обновляем статистику популярных мемов
     if meme_id not in popular_memes:
         popular_memes[meme_id] = {
@@ -137,14 +631,10 @@ def record_meme_view(meme_id: str, user_id: int):
     popular_memes[meme_id]["last_interaction"] = int(now)
     
     # Обновляем активность пользователя
-    user_activity[user_id]["last_active"] = int(now)
+    _mark_active(user_id, now)
     
     # Обновляем статистику сессий
-    _update_session_stats()
-    
-    # Периодически сохраняем данные
-    if time.time() % 60 < 1:  # примерно раз в минуту
-        _save_analytics_files()
+    _update_session_stats(now)
 
 def record_meme_rating(meme_id: str, user_id: int, rating: int):
     """
@@ -155,8 +645,12 @@ def record_meme_rating(meme_id: str, user_id: int, rating: int):
         user_id (int): Идентификатор пользователя
         rating (int): Оценка (1 - положительная, -1 - отрицательная)
     """
-    now = time.time()
-    
+    _record_event({"type": "rating", "meme_id": meme_id, "user_id": user_id, "rating": rating,
+                   "timestamp": int(time.time())})
+
+def _apply_rating(meme_id: str, user_id: int, rating: int, now: float):
+    """Учитывает оценку мема в данных аналитики"""
+    global _regular_users
     # Обновляем статистику популярных мемов
     if meme_id not in popular_memes:
         popular_memes[meme_id] = {
@@ -183,18 +677,17 @@ def record_meme_rating(meme_id: str, user_id: int, rating: int):
     
     # Обновляем активность пользователя
     user_activity[user_id]["ratings"] += 1
-    user_activity[user_id]["last_active"] = int(now)
+    if user_activity[user_id]["ratings"] == REGULAR_USER_MIN_RATINGS + 1:
+        _regular_users += 1
+    _mark_active(user_id, now)
     
     # Обновляем статистику сессий
     session_stats["total_ratings"] += 1
     session_stats["today_ratings"] += 1
-    _update_session_stats()
+    _update_session_stats(now)
     
     # Обновляем данные трендов
-    _update_trending_memes(meme_id, rating)
-    
-    # Сохраняем данные после каждой оценки
-    _save_analytics_files()
+    _update_trending_memes(meme_id, rating, now)
 
 def record_user_session(user_id: int):
     """
@@ -203,90 +696,49 @@ def record_user_session(user_id: int):
     Args:
         user_id (int): Идентификатор пользователя
     """
-    now = time.time()
-    
+    _record_event({"type": "session", "user_id": user_id, "timestamp": int(time.time())})
+
+def _apply_session(user_id: int, now: float):
+    """Учитывает сессию пользователя в данных аналитики"""
     # Проверяем, не была ли уже зарегистрирована сессия недавно
     last_active = user_activity[user_id].get("last_active", 0)
     if now - last_active > HOUR_SECONDS:  # Если прошло больше часа с момента последней активности
         user_activity[user_id]["sessions"] += 1
         session_stats["total_sessions"] += 1
     
-    user_activity[user_id]["last_active"] = int(now)
+    _mark_active(user_id, now)
     
     # Обновляем статистику сессий
-    _update_session_stats()
-    
-    # Периодически сохраняем данные
-    if time.time() % 60 < 1:  # примерно раз в минуту
-        _save_analytics_files()
+    _update_session_stats(now)
 
-def _update_session_stats():
-    """Обновляет общую статистику сессий"""
-    now = time.time()
-    
-    # Обновляем счетчик активных пользователей
-    active_users = 0
-    for user_id, data in user_activity.items():
-        if now - data["last_active"] < DAY_SECONDS:
-            active_users += 1
+def _mark_active(user_id: int, now: float):
+    """Обновляет время последней активности пользователя"""
+    user_activity[user_id]["last_active"] = int(now)
+    active_users.touch(user_id, now)
+
+def _update_session_stats(now: Optional[float] = None):
+    """Обновляет общую статистику сессий на момент now"""
+    if now is None:
+        now = time.time()
     
-    session_stats["active_users"] = active_users
+    # Обновляем счетчик активных пользователей (за сутки с точностью до часа)
+    session_stats["active_users"] = active_users.count(DAY_SECONDS, now)
     
     # Сбрасываем счетчик оценок за день, если прошло более 24 часов
     if now - session_stats.get("last_update", 0) > DAY_SECONDS:
         session_stats["today_ratings"] = 0
         session_stats["last_update"] = int(now)
 
-def _update_trending_memes(meme_id: str, rating: int):
+def _update_trending_memes(meme_id: str, rating: int, now: Optional[float] = None):
     """
     Обновляет трендовые мемы на основе новой оценки
     
     Args:
         meme_id (str): Идентификатор мема
         rating (int): Оценка (1 - положительная, -1 - отрицательная)
+        now (float): Время оценки (по умолчанию текущее)
     """
-    now = time.time()
-    today = datetime.datetime.now().strftime("%Y-%m-%d")
-    
-    if today not in trending_memes:
-        trending_memes[today] = {}
-    
-    if meme_id not in trending_memes[today]:
-        trending_memes[today][meme_id] = {
-            "score": 0,
-            "likes": 0,
-            "dislikes": 0
-        }
-    
-    # Обновляем счетчики для конкретного дня
-    if rating == 1:
-        trending_memes[today][meme_id]["likes"] += 1
-    elif rating == -1:
-        trending_memes[today][meme_id]["dislikes"] += 1
-    
-    # Вычисляем score (учитываем и положительные и отрицательные оценки)
-    likes = trending_memes[today][meme_id]["likes"]
-    dislikes = trending_memes[today][meme_id]["dislikes"]
-    total = likes + dislikes
-    
-    # Формула для расчета тренда: (лайки - дизлайки) / (общее количество)
-    # Это дает нам значение от -1 до 1, которое мы масштабируем до 0-100
-    if total > 0:
-        score = ((likes - dislikes) / total + 1) * 50
-    else:
-        score = 50  # Нейтральный скор, если нет оценок
-    
-    trending_memes[today][meme_id]["score"] = int(score)
-    
-    # Очищаем старые записи (старше недели)
-    keys_to_remove = []
-    for date_str in trending_memes.keys():
-        date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d")
-        if (datetime.datetime.now() - date_obj).days > 7:
-            keys_to_remove.append(date_str)
-    
-    for key in keys_to_remove:
-        del trending_memes[key]
+    trending.update(meme_id, rating, time.time() if now is None else now)
 
 def get_popular_memes(limit: int = 10, period: str = "all") -> List[Dict]:
     """
@@ -345,48 +797,21 @@ def get_trending_memes(limit: int = 10, days: int = 1) -> List[Dict]:
     Returns:
         List[Dict]: Список словарей с данными трендовых мемов
     """
-    days = min(max(days, 1), 7)  # Ограничиваем от 1 до 7 дней
-    
-    # Получаем даты для анализа
-    dates = []
-    for i in range(days):
-        date = (datetime.datetime.now() - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
-        dates.append(date)
-    
-    # Собираем данные по мемам за указанные дни
-    meme_trends = defaultdict(lambda: {"score": 0, "likes": 0, "dislikes": 0, "days": 0})
-    
-    for date in dates:
-        if date in trending_memes:
-            for meme_id, data in trending_memes[date].items():
-                meme_trends[meme_id]["score"] += data.get("score", 0)
-                meme_trends[meme_id]["likes"] += data.get("likes", 0)
-                meme_trends[meme_id]["dislikes"] += data.get("dislikes", 0)
-                meme_trends[meme_id]["days"] += 1
-    
-    # Вычисляем средний скор и сортируем
-    for meme_id, data in meme_trends.items():
-        if data["days"] > 0:
-            data["score"] = int(data["score"] / data["days"])
-    
-    sorted_trends = sorted(
-        meme_trends.items(),
-        key=lambda x: x[1]["score"],
-        reverse=True
-    )
-    
-    # Форматируем результат
-    result = []
-    for meme_id, data in sorted_trends[:limit]:
-        result.append({
-            "meme_id": meme_id,
-            "likes": data["likes"],
-            "dislikes": data["dislikes"],
-            "trend_score": data["score"],
-            "days_in_trend": data["days"]
-        })
-    
-    return result
+    days = min(max(days, 1), TRENDING_DAYS)  # Ограничиваем от 1 до 7 дней
+    
+    # Суммы за период ведутся при каждой оценке, здесь берутся только лучшие limit мемов
+    with analytics_lock:
+        top = trending.top(limit, days, time.time())
+        return [
+            {
+                "meme_id": meme_id,
+                "likes": total[1],
+                "dislikes": total[2],
+                "trend_score": trending.trend_score(total),
+                "days_in_trend": total[3]
+            }
+            for meme_id, total in top
+        ]
 
 def get_user_engagement_stats() -> Dict:
     """
@@ -397,28 +822,17 @@ def get_user_engagement_stats() -> Dict:
     """
     now = time.time()
     
-    # Определяем периоды активности
-    day_active = 0
-    week_active = 0
-    month_active = 0
-    regular_users = 0  # Пользователи с >10 оценками
-    
-    for user_id, data in user_activity.items():
-        last_active = data.get("last_active", 0)
-        if now - last_active < DAY_SECONDS:
-            day_active += 1
-        if now - last_active < WEEK_SECONDS:
-            week_active += 1
-        if now - last_active < DAY_SECONDS * 30:
-            month_active += 1
-        if data.get("ratings", 0) > 10:
-            regular_users += 1
+    # Активные пользователи по периодам (с точностью до часа) без обхода всех пользователей
+    with analytics_lock:
+        day_active = active_users.count(DAY_SECONDS, now)
+        week_active = active_users.count(WEEK_SECONDS, now)
+        month_active = active_users.count(MONTH_SECONDS, now)
     
     return {
         "active_today": day_active,
         "active_week": week_active,
         "active_month": month_active,
-        "regular_users": regular_users,
+        "regular_users": _regular_users,  # Пользователи с >10 оценками
         "total_users": len(user_activity),
         "total_ratings": session_stats.get("total_ratings", 0),
         "today_ratings": session_stats.get("today_ratings", 0),
@@ -456,23 +870,9 @@ def get_meme_stats(meme_id: str) -> Dict:
     total_ratings = likes + dislikes
     rating_percentage = (likes / total_ratings * 100) if total_ratings > 0 else 0
     
-    # Определяем позицию в трендах
-    today = datetime.datetime.now().strftime("%Y-%m-%d")
-    trend_position = None
-    
-    if today in trending_memes and meme_id in trending_memes[today]:
-        # Получаем все мемы дня, сортированные по тренду
-        sorted_trends = sorted(
-            trending_memes[today].items(),
-            key=lambda x: x[1]["score"],
-            reverse=True
-        )
-        
-        # Ищем позицию нашего мема
-        for i, (id, _) in enumerate(sorted_trends):
-            if id == meme_id:
-                trend_position = i + 1  # позиция начиная с 1
-                break
+    # Определяем позицию в трендах за сегодня
+    with analytics_lock:
+        trend_position = trending.trend_position(meme_id, time.time())
     
     return {
         "meme_id": meme_id,
@@ -510,4 +910,8 @@ def _calculate_popularity_score(meme_data: Dict) -> float:
     # Умножаем на фактор просмотров чтобы отдавать предпочтение мемам с большим количеством взаимодействий
     adjusted_score = raw_score * (0.5 + 0.5 * view_factor)
     
-    return max(0, min(100, adjusted_score))  # Ограничиваем значениями от 0 до 100
\ No newline at end of file
+    return max(0, min(100, adjusted_score))  # Ограничиваем значениями от 0 до 100
+
+# Инициализация - загружаем существующие данные (после определения функций применения событий)
+_load_analytics_files()
+atexit.register(shutdown_analytics)
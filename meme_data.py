@@ -1,4 +1,8 @@
 # Модуль для работы с данными мемов и их фильтрацией
+import hashlib
+import re
+from bisect import bisect_right
+from typing import Dict, List, Optional
 
 MEMES = []
 MEME_SOURCES = ['VK']
@@ -34,6 +38,136 @@ HUMOR_KEYWORDS = [
     "гениально", "безумие", "хаос", "глупость", "чушь", "бред", "смех", "улыбка"
 ]
 
+# Категории текста мема (в порядке убывания приоритета)
+CATEGORY_EXCLUDED = "excluded"
+CATEGORY_NEWS = "news"
+CATEGORY_HUMOR = "humor"
+_CATEGORY_PRIORITY = {CATEGORY_EXCLUDED: 0, CATEGORY_NEWS: 1, CATEGORY_HUMOR: 2}
+
+# Максимальная длина текста мема: более длинные тексты, скорее всего, не мемы
+MAX_MEME_TEXT_LENGTH = 100
+
+# Разделитель текстов при пакетной классификации (не встречается в ключевых словах)
+_BATCH_SEPARATOR = "\x00"
+
+def _build_trie_pattern(keywords: List[str]) -> str:
+    """
+    Строит регулярное выражение в виде префиксного дерева ключевых слов.
+    Общие префиксы выносятся за скобки, поэтому в каждой позиции текста
+    движок regex проверяет один символ, а не все ключевые слова по очереди.
+    Необязательные продолжения жадные: в позиции находится самое длинное слово.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+def _build_keyword_matcher():
+    """
+    Компилирует все списки ключевых слов в одно регулярное выражение.
+    Поиск перезапускается со следующего символа после начала каждого совпадения,
+    так что проверяются все позиции текста. Чтобы не потерять более короткие
+    слова, начинающиеся в той же позиции, что и найденное, каждое слово
+    наследует категории всех ключевых слов, которые в нём содержатся,
+    и хранит самую приоритетную из них.
+    """
+    keyword_categories = {}
+    for category, keywords in ((CATEGORY_EXCLUDED, EXCLUDED_KEYWORDS),
+                               (CATEGORY_NEWS, NEWS_KEYWORDS),
+                               (CATEGORY_HUMOR, HUMOR_KEYWORDS)):
+        for keyword in keywords:
+            keyword_categories.setdefault(keyword, set()).add(category)
+
+    strongest_category = {}
+    for keyword in keyword_categories:
+        categories = set()
+        for other, other_categories in keyword_categories.items():
+            if other in keyword:
+                categories |= other_categories
+        strongest_category[keyword] = min(categories, key=_CATEGORY_PRIORITY.get)
+
+    return re.compile(_build_trie_pattern(list(keyword_categories))), strongest_category
+
+_KEYWORD_PATTERN, _KEYWORD_CATEGORY = _build_keyword_matcher()
+
+def classify_meme_text(text: str) -> Optional[str]:
+    """
+    Классифицирует текст (в нижнем регистре) за один проход.
+    Returns:
+        Optional[str]: CATEGORY_EXCLUDED, CATEGORY_NEWS, CATEGORY_HUMOR или None
+    """
+    best = None
+    search = _KEYWORD_PATTERN.search
+    match = search(text)
+    while match is not None:
+        category = _KEYWORD_CATEGORY[match.group()]
+        if category == CATEGORY_EXCLUDED:
+            return category
+        if best is None or _CATEGORY_PRIORITY[category] < _CATEGORY_PRIORITY[best]:
+            best = category
+        match = search(text, match.start() + 1)
+    return best
+
+def _classify_texts(texts: List[str]) -> List[Optional[str]]:
+    """Классифицирует тексты (в нижнем регистре) одним проходом по их объединению"""
+    starts = []
+    position = 0
+    for text in texts:
+        starts.append(position)
+        position += len(text) + len(_BATCH_SEPARATOR)
+
+    categories = [None] * len(texts)
+    joined = _BATCH_SEPARATOR.join(texts)
+    search = _KEYWORD_PATTERN.search
+    match = search(joined)
+    while match is not None:
+        index = bisect_right(starts, match.start()) - 1
+        category = _KEYWORD_CATEGORY[match.group()]
+        current = categories[index]
+        if current is None or _CATEGORY_PRIORITY[category] < _CATEGORY_PRIORITY[current]:
+            categories[index] = category
+        if category == CATEGORY_EXCLUDED and index + 1 < len(starts):
+            # Остаток текста уже ничего не изменит, переходим к следующему
+            match = search(joined, starts[index + 1])
+        elif category == CATEGORY_EXCLUDED:
+            break
+        else:
+            match = search(joined, match.start() + 1)
+    return categories
+
+def classify_memes(memes: List[Dict]) -> List[Optional[str]]:
+    """
+    Классифицирует список мемов одним проходом по объединённому тексту.
+    Returns:
+        List[Optional[str]]: Категория текста каждого мема (см. classify_meme_text)
+    """
+    return _classify_texts([meme.get("text", "").lower() for meme in memes])
+
+def make_meme_id(meme: Dict) -> str:
+    """
+    Возвращает стабильный ID мема, одинаковый при любом запуске процесса
+    (в отличие от встроенного hash(), который зависит от PYTHONHASHSEED).
+    Для мемов из VK ID строится по владельцу стены, посту и фотографии,
+    для остальных - по SHA-1 от URL изображения и текста.
+    """
+    owner_id = meme.get("owner_id")
+    post_id = meme.get("post_id")
+    if owner_id is not None and post_id is not None:
+        return f"vk{owner_id}_{post_id}_{meme.get('photo_id') or 0}"
+    digest = hashlib.sha1(f"{meme.get('image_url', '')}\n{meme.get('text', '')}".encode('utf-8')).hexdigest()
+    return f"vk_{digest[:20]}"
+
 def is_suitable_meme(meme):
     """
     Проверяет, подходит ли мем для показа.
@@ -50,26 +184,30 @@ def is_suitable_meme(meme):
     if not text or not image_url:
         return False
 
-    # Исключение нежелательного контента
-    for keyword in EXCLUDED_KEYWORDS:
-        if keyword in text:
-            return False
-
-    # Исключение новостного контента
-    for keyword in NEWS_KEYWORDS:
-        if keyword in text:
-            return False
-
-    # Проверка на наличие юмористического контента (обязательно)
-    has_humor = False
-    for keyword in HUMOR_KEYWORDS:
-        if keyword in text:
-            has_humor = True
-            break
-
     # Дополнительная проверка: мемы часто короткие
     # Если текст длиннее 100 символов, скорее всего, это не мем
-    if len(text) > 100:
+    if len(text) > MAX_MEME_TEXT_LENGTH:
         return False
 
-    return has_humor
+    # Нежелательный и новостной контент исключается, юмористический обязателен
+    return classify_meme_text(text) == CATEGORY_HUMOR
+
+def filter_suitable_memes(memes: List[Dict]) -> List[bool]:
+    """
+    Пакетная версия is_suitable_meme: классифицирует все мемы одним проходом.
+    Returns:
+        List[bool]: Для каждого мема True, если он подходит для показа
+    """
+    # Мемы без текста или изображения и слишком длинные тексты отбрасываются до поиска ключевых слов
+    candidates = []
+    texts = []
+    for index, meme in enumerate(memes):
+        text = meme.get("text", "").lower()
+        if text and meme.get("image_url", "") and len(text) <= MAX_MEME_TEXT_LENGTH:
+            candidates.append(index)
+            texts.append(text)
+
+    result = [False] * len(memes)
+    for index, category in zip(candidates, _classify_texts(texts)):
+        result[index] = category == CATEGORY_HUMOR
+    return result
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Одноразовая миграция сохраненных данных бота на стабильные ID мемов.
+
+Раньше ID мемов строились через встроенный hash() (vk_<hash(url + текст)>
+в коллекции и hash(url) в истории оценок), который меняется при каждом
+перезапуске процесса. Скрипт пересчитывает ID мемов через
+meme_data.make_meme_id и переписывает ключи во всех JSON-хранилищах:
+кэше мемов, отклоненных мемах, file_id Telegram, аналитике (снимок и журнал
+событий или отдельные файлы) и предпочтениях пользователей (снимок JSON
+или двоичный снимок и журнал). Перед перезаписью каждого файла
+сохраняется копия с суффиксом .bak.
+
+Старые ID коллекции сопоставляются с новыми по содержимому мемов из кэша.
+ID мемов в истории оценок (hash(url)) можно восстановить, только если
+скрипт запущен с тем же PYTHONHASHSEED, что и старая версия бота;
+иначе такие записи оставляются как есть (ключевые слова предпочтений
+от ID не зависят и переносятся полностью).
+
+Запуск (бот должен быть остановлен):
+    python migrate_meme_ids.py
+    python migrate_meme_ids.py --dry-run
+    PYTHONHASHSEED=<seed старого бота> python migrate_meme_ids.py
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+from typing import Dict, Tuple
+
+from meme_data import make_meme_id
+from preference_store import ProfileStore
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+# Файлы хранилищ (пути как в соответствующих модулях бота)
+MEMES_CACHE_FILE = "cached_filtered_memes.json"
+REJECTED_CACHE_FILE = "rejected_memes.json"
+FILE_IDS_CACHE_FILE = "telegram_file_ids.json"
+USER_PREFERENCES_FILE = "user_preferences.json"
+USER_PREFERENCES_BINARY_FILE = "user_preferences.bin"
+USER_PREFERENCES_JOURNAL_FILE = "user_preferences.journal"
+ANALYTICS_DIR = "analytics"
+POPULAR_MEMES_FILE = os.path.join(ANALYTICS_DIR, "popular_memes.json")
+TRENDING_MEMES_FILE = os.path.join(ANALYTICS_DIR, "trending_memes.json")
+RATING_HISTORY_FILE = os.path.join(ANALYTICS_DIR, "rating_history.json")
+ANALYTICS_SNAPSHOT_FILE = os.path.join(ANALYTICS_DIR, "snapshot.json")
+ANALYTICS_LOG_FILE = os.path.join(ANALYTICS_DIR, "events.log")
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "memebot.sqlite3")
+
+def _legacy_collection_id(meme: Dict) -> str:
+    """ID мема в коллекции, как его строила старая версия бота"""
+    return f"vk_{abs(hash(meme['image_url'] + meme['text']))}"
+
+def _legacy_preference_id(meme: Dict) -> str:
+    """ID мема в истории оценок, как его строила старая версия бота"""
+    return str(hash(meme['image_url']))
+
+def _load_json(path: str, default):
+    """Загружает JSON-файл или возвращает default, если файла нет"""
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_file(path: str, data, dry_run: bool):
+    """Сохраняет копию файла и атомарно записывает новое содержимое (строку или байты)"""
+    if dry_run:
+        return
+    if os.path.exists(path):
+        shutil.copy2(path, f"{path}.bak")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w', encoding=None if isinstance(data, bytes) else 'utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _merge_counters(target: Dict, source: Dict):
+    """Объединяет счетчики двух записей аналитики, получивших одинаковый ID"""
+    for key, value in source.items():
+        if key in ("last_interaction", "score"):
+            target[key] = max(target.get(key, 0), value)
+        elif isinstance(value, (int, float)):
+            target[key] = target.get(key, 0) + value
+
+def build_id_mapping() -> Tuple[Dict[str, str], Dict[str, Dict]]:
+    """
+    Строит соответствие старых ID новым по мемам из кэша и отклоненных.
+    Returns:
+        Tuple[Dict[str, str], Dict[str, Dict]]: старый ID -> новый ID, мемы по старым ID
+    """
+    memes_by_old_id = {}
+    for path in (MEMES_CACHE_FILE, REJECTED_CACHE_FILE):
+        memes_by_old_id.update(_load_json(path, {}))
+
+    mapping = {}
+    legacy_matches = 0
+    preference_mapping = {}
+    for old_id, meme in memes_by_old_id.items():
+        new_id = make_meme_id(meme)
+        mapping[old_id] = new_id
+        if 'image_url' in meme and 'text' in meme:
+            if _legacy_collection_id(meme) == old_id:
+                legacy_matches += 1
+            preference_mapping.setdefault(_legacy_preference_id(meme), new_id)
+
+    # hash() в этом процессе совпадает со старым ботом только при том же PYTHONHASHSEED
+    if legacy_matches:
+        logger.info(f"PYTHONHASHSEED совпадает со старой версией: ID истории оценок будут перенесены "
+                    f"({legacy_matches} из {len(memes_by_old_id)} ID коллекции воспроизведены)")
+        for old_id, new_id in preference_mapping.items():
+            mapping.setdefault(old_id, new_id)
+    else:
+        logger.warning("Старые ID не воспроизводятся с текущим PYTHONHASHSEED: "
+                       "ID мемов в истории оценок пользователей перенесены не будут")
+    return mapping, memes_by_old_id
+
+def migrate_memes(path: str, mapping: Dict[str, str], dry_run: bool) -> int:
+    """Переписывает ключи словаря мемов (кэш или отклоненные)"""
+    memes = _load_json(path, None)
+    if memes is None:
+        return 0
+    migrated = {}
+    for old_id, meme in memes.items():
+        migrated.setdefault(mapping.get(old_id, old_id), meme)
+    _write_file(path, json.dumps(migrated, ensure_ascii=False, indent=2), dry_run)
+    logger.info(f"{path}: {len(memes)} -> {len(migrated)} мемов")
+    return len(memes) - len(migrated)
+
+def migrate_file_ids(mapping: Dict[str, str], dry_run: bool):
+    """Переписывает ключи кэша file_id Telegram"""
+    file_ids = _load_json(FILE_IDS_CACHE_FILE, None)
+    if file_ids is None:
+        return
+    migrated = {}
+    for old_id, file_id in file_ids.items():
+        migrated.setdefault(mapping.get(old_id, old_id), file_id)
+    _write_file(FILE_IDS_CACHE_FILE, json.dumps(migrated, ensure_ascii=False), dry_run)
+    logger.info(f"{FILE_IDS_CACHE_FILE}: перенесено {len(migrated)} file_id")
+
+def _remap_counters(memes: Dict, mapping: Dict[str, str]) -> Dict:
+    """Переписывает ключи словаря счетчиков мемов, объединяя записи с одинаковым новым ID"""
+    migrated = {}
+    for old_id, data in memes.items():
+        new_id = mapping.get(old_id, old_id)
+        if new_id in migrated:
+            _merge_counters(migrated[new_id], data)
+        else:
+            migrated[new_id] = data
+    return migrated
+
+def _remap_trending(trending: Dict, mapping: Dict[str, str]) -> Dict:
+    """Переписывает ID мемов в трендах по дням"""
+    return {day: _remap_counters(memes, mapping) for day, memes in trending.items()}
+
+def _remap_history(history, mapping: Dict[str, str]):
+    """Переписывает ID мемов в истории оценок"""
+    for entry in history:
+        entry["meme_id"] = mapping.get(entry["meme_id"], entry["meme_id"])
+    return history
+
+def _migrate_log(path: str, mapping: Dict[str, str], dry_run: bool):
+    """Переписывает ID мемов в журнале (JSON по строке), недописанные строки оставляет как есть"""
+    if not os.path.exists(path):
+        return
+    lines = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Недописанная строка остается как есть, ее пропустит загрузка журнала
+                lines.append(line)
+                continue
+            if "meme_id" in entry:
+                entry["meme_id"] = mapping.get(entry["meme_id"], entry["meme_id"])
+            lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+    _write_file(path, "".join(lines), dry_run)
+    logger.info(f"{path}: перенесено {len(lines)} записей журнала")
+
+def migrate_analytics(mapping: Dict[str, str], dry_run: bool):
+    """Переписывает ID мемов в популярных мемах, трендах и истории оценок"""
+    snapshot = _load_json(ANALYTICS_SNAPSHOT_FILE, None)
+    if snapshot is not None:
+        # Снимок новее отдельных файлов: они больше не читаются
+        popular = snapshot["popular_memes"]
+        snapshot["popular_memes"] = _remap_counters(popular, mapping)
+        snapshot["trending_memes"] = _remap_trending(snapshot["trending_memes"], mapping)
+        _remap_history(snapshot["rating_history"], mapping)
+        _write_file(ANALYTICS_SNAPSHOT_FILE, json.dumps(snapshot, ensure_ascii=False), dry_run)
+        logger.info(f"{ANALYTICS_SNAPSHOT_FILE}: {len(popular)} -> {len(snapshot['popular_memes'])} мемов, "
+                    f"перенесено {len(snapshot['rating_history'])} оценок")
+    else:
+        popular = _load_json(POPULAR_MEMES_FILE, None)
+        if popular is not None:
+            migrated = _remap_counters(popular, mapping)
+            _write_file(POPULAR_MEMES_FILE, json.dumps(migrated, ensure_ascii=False), dry_run)
+            logger.info(f"{POPULAR_MEMES_FILE}: {len(popular)} -> {len(migrated)} мемов")
+        
+        trending = _load_json(TRENDING_MEMES_FILE, None)
+        if trending is not None:
+            trending = _remap_trending(trending, mapping)
+            _write_file(TRENDING_MEMES_FILE, json.dumps(trending, ensure_ascii=False), dry_run)
+            logger.info(f"{TRENDING_MEMES_FILE}: перенесены тренды за {len(trending)} дней")
+        
+        history = _load_json(RATING_HISTORY_FILE, None)
+        if history is not None:
+            _remap_history(history, mapping)
+            _write_file(RATING_HISTORY_FILE, json.dumps(history, ensure_ascii=False), dry_run)
+            logger.info(f"{RATING_HISTORY_FILE}: перенесено {len(history)} оценок")
+    
+    _migrate_log(ANALYTICS_LOG_FILE, mapping, dry_run)
+
+def migrate_preferences(mapping: Dict[str, str], dry_run: bool):
+    """Переписывает ID оцененных мемов в снимке предпочтений и журнале оценок"""
+    if os.path.exists(USER_PREFERENCES_BINARY_FILE):
+        # Двоичный снимок новее JSON: ID мемов переименовываются в общем словаре
+        store = ProfileStore()
+        journal_seq = store.load_binary(USER_PREFERENCES_BINARY_FILE)
+        renamed = store.rename_memes(mapping)
+        data = store.dump_binary(journal_seq)
+        users_count = len(store)
+        store.clear()
+        _write_file(USER_PREFERENCES_BINARY_FILE, data, dry_run)
+        logger.info(f"{USER_PREFERENCES_BINARY_FILE}: {users_count} пользователей, переименовано {renamed} ID мемов")
+        snapshot = None
+    else:
+        snapshot = _load_json(USER_PREFERENCES_FILE, None)
+    if snapshot is not None:
+        # Снимок с номером журнала или старый формат (словарь пользователей)
+        users = snapshot["users"] if "users" in snapshot and "journal_seq" in snapshot else snapshot
+        remapped = 0
+        total = 0
+        for user_data in users.values():
+            migrated = {}
+            for old_id, rating in user_data.get("rated_memes", {}).items():
+                total += 1
+                if old_id in mapping:
+                    remapped += 1
+                migrated[mapping.get(old_id, old_id)] = rating
+            user_data["rated_memes"] = migrated
+        _write_file(USER_PREFERENCES_FILE, json.dumps(snapshot, ensure_ascii=False), dry_run)
+        logger.info(f"{USER_PREFERENCES_FILE}: {len(users)} пользователей, перенесено {remapped} из {total} оценок")
+
+    _migrate_log(USER_PREFERENCES_JOURNAL_FILE, mapping, dry_run)
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграция сохраненных данных бота на стабильные ID мемов")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет изменено")
+    args = parser.parse_args()
+
+    mapping, memes_by_old_id = build_id_mapping()
+    changed = sum(1 for old_id in memes_by_old_id if mapping[old_id] != old_id)
+    logger.info(f"Найдено {len(memes_by_old_id)} мемов, изменится {changed} ID")
+    if not changed:
+        logger.info("Миграция не требуется")
+        return
+
+    merged = migrate_memes(MEMES_CACHE_FILE, mapping, args.dry_run)
+    merged += migrate_memes(REJECTED_CACHE_FILE, mapping, args.dry_run)
+    if merged:
+        logger.info(f"Объединено {merged} мемов с одинаковым новым ID")
+    migrate_file_ids(mapping, args.dry_run)
+    migrate_analytics(mapping, args.dry_run)
+    migrate_preferences(mapping, args.dry_run)
+    if os.path.exists(SQLITE_DB_FILE):
+        logger.warning(f"База {SQLITE_DB_FILE} не переносится: запускайте миграцию до перехода на STORAGE_BACKEND=sqlite")
+    logger.info("Миграция завершена" if not args.dry_run else "Пробный запуск завершен, файлы не изменены")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Модуль компактного хранения профилей предпочтений пользователей.
+Ключевые слова и ID мемов интернируются в общие словари (строка -> целое число),
+веса и оценки хранятся в разреженных векторах на массивах array вместо словарей строк.
+Профили сохраняются в двоичный файл с индексом пользователей: при загрузке читаются
+только словари и индекс, профиль пользователя декодируется при первом обращении.
+
+Веса ключевых слов экспоненциально затухают со временем. Затухание ленивое:
+веса хранятся относительно момента decay_base профиля, и при чтении умножаются
+на общий для профиля коэффициент. Не чаще раза в DECAY_REBASE_INTERVAL коэффициент
+применяется к самим весам, а слова с весом ниже порога удаляются из профиля.
+"""
+import mmap
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Формат двоичного файла (все числа little-endian):
+#   заголовок: сигнатура, версия, номер журнала, размеры словарей и число пользователей
+#   словари ключевых слов и ID мемов: длина (H) + строка UTF-8
+#   индекс пользователей: длина (H) + ID пользователя, смещение записи (Q), длина записи (I)
+#   записи профилей: число оценок (I), момент отсчета затухания (d, только с версии 2),
+#   понравившиеся и непонравившиеся ключевые слова (n (I), ID n*I, веса n*f),
+#   оцененные мемы (n (I), ID n*I, оценки n*b)
+PROFILE_FILE_MAGIC = b"MEMEPRF1"
+PROFILE_FILE_VERSION = 2
+_SUPPORTED_VERSIONS = (1, 2)
+_HEADER = struct.Struct("<8sHQIII")
+_STRING_LENGTH = struct.Struct("<H")
+_INDEX_ENTRY = struct.Struct("<QI")
+_COUNT = struct.Struct("<I")
+_TIMESTAMP = struct.Struct("<d")
+
+# Параметры затухания весов по умолчанию
+PREFERENCE_HALF_LIFE = 30 * 86400      # Период полураспада веса ключевого слова (сек), 0 - без затухания
+PREFERENCE_PRUNE_THRESHOLD = 0.01      # Ключевые слова с меньшим весом удаляются из профиля
+DECAY_REBASE_INTERVAL = 86400          # Как часто затухание применяется к самим весам (сек)
+
+WEIGHT_TYPECODE = "f"   # Веса ключевых слов (float32)
+RATING_TYPECODE = "b"   # Оценки мемов (int8)
+ID_TYPECODE = "I"       # ID в словарях (uint32)
+
+_BIG_ENDIAN = sys.byteorder == "big"
+
+class Vocabulary:
+    """Словарь интернирования строк: строка <-> целочисленный ID (выданные ID не меняются)"""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.words: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def intern(self, word: str) -> int:
+        """Возвращает ID строки, добавляя ее в словарь при необходимости"""
+        index = self.ids.get(word)
+        if index is None:
+            index = len(self.words)
+            self.ids[word] = index
+            self.words.append(word)
+        return index
+
+    def lookup(self, word: str) -> Optional[int]:
+        """Возвращает ID строки или None, если ее нет в словаре"""
+        return self.ids.get(word)
+
+    def rename(self, index: int, word: str):
+        """Заменяет строку с заданным ID (новой строки в словаре быть не должно)"""
+        del self.ids[self.words[index]]
+        self.words[index] = word
+        self.ids[word] = index
+
+class SparseVector:
+    """Разреженный вектор: отсортированные ID и значения в массивах array"""
+    __slots__ = ("ids", "values")
+
+    def __init__(self, typecode: str = WEIGHT_TYPECODE, ids: Optional[array] = None,
+                 values: Optional[array] = None):
+        self.ids = ids if ids is not None else array(ID_TYPECODE)
+        self.values = values if values is not None else array(typecode)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, index: int, default=None):
+        """Возвращает значение по ID или default"""
+        position = bisect_left(self.ids, index)
+        if position < len(self.ids) and self.ids[position] == index:
+            return self.values[position]
+        return default
+
+    def add(self, index: int, value):
+        """Прибавляет значение к элементу вектора (создает его при необходимости)"""
+        position = bisect_left(self.ids, index)
+        if position < len(self.ids) and self.ids[position] == index:
+            self.values[position] += value
+        else:
+            self.ids.insert(position, index)
+            self.values.insert(position, value)
+
+    def set(self, index: int, value):
+        """Устанавливает значение элемента вектора"""
+        position = bisect_left(self.ids, index)
+        if position < len(self.ids) and self.ids[position] == index:
+            self.values[position] = value
+        else:
+            self.ids.insert(position, index)
+            self.values.insert(position, value)
+
+    def remove(self, index: int):
+        """Удаляет элемент вектора, если он есть"""
+        position = bisect_left(self.ids, index)
+        if position < len(self.ids) and self.ids[position] == index:
+            del self.ids[position]
+            del self.values[position]
+
+    def items(self) -> Iterable[Tuple[int, float]]:
+        """Пары (ID, значение) в порядке возрастания ID"""
+        return zip(self.ids, self.values)
+
+    def nbytes(self) -> int:
+        """Объем данных вектора в байтах"""
+        return self.ids.itemsize * len(self.ids) + self.values.itemsize * len(self.values)
+
+class UserProfile:
+    """Профиль предпочтений пользователя"""
+    __slots__ = ("liked", "disliked", "rated", "total_ratings", "decay_base")
+
+    def __init__(self, decay_base: float = 0.0):
+        self.liked = SparseVector(WEIGHT_TYPECODE)      # ID ключевого слова -> вес на момент decay_base
+        self.disliked = SparseVector(WEIGHT_TYPECODE)   # ID ключевого слова -> вес на момент decay_base
+        self.rated = SparseVector(RATING_TYPECODE)      # ID мема -> оценка
+        self.total_ratings = 0
+        self.decay_base = decay_base                    # Момент, к которому приведены веса
+
+def _array_bytes(values: array) -> bytes:
+    """Байты массива в порядке little-endian"""
+    if _BIG_ENDIAN:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _read_array(typecode: str, data, offset: int, count: int) -> Tuple[array, int]:
+    """Читает массив из count элементов, возвращает массив и смещение за ним"""
+    values = array(typecode)
+    end = offset + count * values.itemsize
+    values.frombytes(data[offset:end])
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values, end
+
+def _encode_vector(vector: SparseVector) -> bytes:
+    return _COUNT.pack(len(vector)) + _array_bytes(vector.ids) + _array_bytes(vector.values)
+
+def _decode_vector(typecode: str, data, offset: int) -> Tuple[SparseVector, int]:
+    (count,) = _COUNT.unpack_from(data, offset)
+    ids, offset = _read_array(ID_TYPECODE, data, offset + _COUNT.size, count)
+    values, offset = _read_array(typecode, data, offset, count)
+    return SparseVector(typecode, ids, values), offset
+
+def _encode_profile(profile: UserProfile) -> bytes:
+    return b"".join((
+        _COUNT.pack(profile.total_ratings),
+        _TIMESTAMP.pack(profile.decay_base),
+        _encode_vector(profile.liked),
+        _encode_vector(profile.disliked),
+        _encode_vector(profile.rated)
+    ))
+
+def _decode_profile(data, offset: int, version: int, loaded_at: float) -> UserProfile:
+    profile = UserProfile(loaded_at)
+    (profile.total_ratings,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    if version >= 2:
+        (profile.decay_base,) = _TIMESTAMP.unpack_from(data, offset)
+        offset += _TIMESTAMP.size
+    profile.liked, offset = _decode_vector(WEIGHT_TYPECODE, data, offset)
+    profile.disliked, offset = _decode_vector(WEIGHT_TYPECODE, data, offset)
+    profile.rated, offset = _decode_vector(RATING_TYPECODE, data, offset)
+    return profile
+
+def _encode_string(value: str) -> bytes:
+    encoded = value.encode('utf-8')
+    return _STRING_LENGTH.pack(len(encoded)) + encoded
+
+def _decode_string(data, offset: int) -> Tuple[str, int]:
+    (length,) = _STRING_LENGTH.unpack_from(data, offset)
+    offset += _STRING_LENGTH.size
+    return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+class ProfileStore:
+    """
+    Хранилище профилей пользователей с общими словарями ключевых слов и ID мемов.
+    Профили, загруженные из двоичного файла, декодируются при первом обращении.
+    Методы чтения и записи принимают момент времени now (по умолчанию текущий),
+    на который рассчитывается затухание весов.
+    """
+
+    def __init__(self, half_life: float = PREFERENCE_HALF_LIFE,
+                 prune_threshold: float = PREFERENCE_PRUNE_THRESHOLD,
+                 rebase_interval: float = DECAY_REBASE_INTERVAL):
+        self.half_life = half_life
+        self.prune_threshold = prune_threshold
+        self.rebase_interval = rebase_interval
+        self.keywords = Vocabulary()
+        self.memes = Vocabulary()
+        self._profiles: Dict[str, UserProfile] = {}
+        self._lazy: Dict[str, Tuple[int, int]] = {}   # пользователь -> (смещение, длина) записи в файле
+        self._file = None
+        self._mmap = None
+        self._version = PROFILE_FILE_VERSION
+        self._loaded_at = 0.0
+        self._lock = threading.RLock()
+        self.lazy_loads = 0
+        self.pruned_keywords = 0
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._profiles or user_id in self._lazy
+
+    def __len__(self) -> int:
+        return len(self._profiles) + len(self._lazy)
+
+    def user_ids(self) -> List[str]:
+        """ID всех пользователей хранилища"""
+        with self._lock:
+            return list(self._profiles) + list(self._lazy)
+
+    def get(self, user_id: str, now: Optional[float] = None) -> Optional[UserProfile]:
+        """
+        Возвращает профиль пользователя (декодируя его из файла при первом обращении).
+        Если веса профиля давно не приводились к текущему моменту, затухание
+        применяется к ним сейчас, а слишком малые веса удаляются.
+        """
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            with self._lock:
+                location = self._lazy.pop(user_id, None)
+                if location is None:
+                    profile = self._profiles.get(user_id)
+                    if profile is None:
+                        return None
+                else:
+                    profile = _decode_profile(self._mmap, location[0], self._version, self._loaded_at)
+                    self._profiles[user_id] = profile
+                    self.lazy_loads += 1
+        now = time.time() if now is None else now
+        if self.half_life and now - profile.decay_base >= self.rebase_interval:
+            with self._lock:
+                self._rebase(profile, now)
+        return profile
+
+    def get_or_create(self, user_id: str, now: Optional[float] = None) -> UserProfile:
+        """Возвращает профиль пользователя, создавая пустой при необходимости"""
+        with self._lock:
+            profile = self.get(user_id, now)
+            if profile is None:
+                profile = UserProfile(time.time() if now is None else now)
+                self._profiles[user_id] = profile
+            return profile
+
+    def apply_rating(self, user_id: str, meme_id: str, keywords: List[str], rating: int,
+                     now: Optional[float] = None):
+        """Учитывает оценку мема, поставленную в момент now, в профиле пользователя"""
+        now = time.time() if now is None else now
+        with self._lock:
+            profile = self.get_or_create(user_id, now)
+            profile.rated.set(self.memes.intern(meme_id), rating)
+            profile.total_ratings += 1
+            # Вес, зависящий от количества ключевых слов, в единицах момента decay_base
+            weight = 1.0 / max(1, len(keywords)) / self.decay_factor(profile, now)
+            target = profile.liked if rating > 0 else profile.disliked
+            for keyword in keywords:
+                target.add(self.keywords.intern(keyword), weight)
+
+    def decay_factor(self, profile: UserProfile, now: Optional[float] = None) -> float:
+        """Множитель затухания весов профиля на момент now"""
+        if not self.half_life:
+            return 1.0
+        now = time.time() if now is None else now
+        return 0.5 ** ((now - profile.decay_base) / self.half_life)
+
+    def keyword_weights(self, profile: UserProfile, vector: SparseVector,
+                        now: Optional[float] = None) -> Dict[str, float]:
+        """Вектор весов ключевых слов профиля на момент now в виде словаря строк"""
+        words = self.keywords.words
+        factor = self.decay_factor(profile, now)
+        return {words[index]: weight * factor for index, weight in vector.items()}
+
+    def keyword_weight(self, profile: UserProfile, vector: SparseVector, keyword: str,
+                       now: Optional[float] = None) -> float:
+        """Вес ключевого слова в векторе профиля на момент now (0, если слова нет)"""
+        index = self.keywords.lookup(keyword)
+        if index is None:
+            return 0
+        return vector.get(index, 0) * self.decay_factor(profile, now)
+
+    def rated_memes(self, profile: UserProfile) -> Dict[str, int]:
+        """Оценки пользователя в виде словаря ID мема -> оценка"""
+        words = self.memes.words
+        return {words[index]: rating for index, rating in profile.rated.items()}
+
+    def get_rating(self, profile: UserProfile, meme_id: str) -> Optional[int]:
+        """Оценка мема пользователем или None, если мем не оценен"""
+        index = self.memes.lookup(meme_id)
+        return None if index is None else profile.rated.get(index)
+
+    def _rebase(self, profile: UserProfile, now: float):
+        """Применяет затухание к весам профиля и удаляет ключевые слова с малым весом"""
+        factor = self.decay_factor(profile, now)
+        for name in ("liked", "disliked"):
+            vector = getattr(profile, name)
+            ids = array(ID_TYPECODE)
+            values = array(WEIGHT_TYPECODE)
+            for index, weight in vector.items():
+                weight *= factor
+                if weight >= self.prune_threshold:
+                    ids.append(index)
+                    values.append(weight)
+            self.pruned_keywords += len(vector) - len(ids)
+            setattr(profile, name, SparseVector(WEIGHT_TYPECODE, ids, values))
+        profile.decay_base = now
+
+    def clear(self):
+        """Удаляет все профили и словари"""
+        with self._lock:
+            self._close()
+            self._profiles.clear()
+            self._lazy.clear()
+            self.keywords = Vocabulary()
+            self.memes = Vocabulary()
+
+    def load_dicts(self, users: Dict[str, Dict]):
+        """Загружает профили из словарей старого JSON-формата (веса считаются текущими)"""
+        with self._lock:
+            for user_id, user_data in users.items():
+                profile = self.get_or_create(user_id)
+                # Веса добавляются в единицах момента decay_base профиля
+                scale = 1.0 / self.decay_factor(profile)
+                for keyword, weight in user_data.get("liked_keywords", {}).items():
+                    profile.liked.add(self.keywords.intern(keyword), weight * scale)
+                for keyword, weight in user_data.get("disliked_keywords", {}).items():
+                    profile.disliked.add(self.keywords.intern(keyword), weight * scale)
+                for meme_id, rating in user_data.get("rated_memes", {}).items():
+                    profile.rated.set(self.memes.intern(meme_id), rating)
+                profile.total_ratings += user_data.get("total_ratings", 0)
+
+    def export_dicts(self) -> Dict[str, Dict]:
+        """Выгружает все профили в словари старого JSON-формата"""
+        with self._lock:
+            users = {}
+            for user_id in self.user_ids():
+                profile = self.get(user_id)
+                users[user_id] = {
+                    "liked_keywords": self.keyword_weights(profile, profile.liked),
+                    "disliked_keywords": self.keyword_weights(profile, profile.disliked),
+                    "rated_memes": self.rated_memes(profile),
+                    "total_ratings": profile.total_ratings
+                }
+            return users
+
+    def dump_binary(self, journal_seq: int) -> bytes:
+        """
+        Сериализует хранилище в двоичный формат.
+        Еще не декодированные профили копируются из файла без разбора
+        (если файл в текущей версии формата).
+        """
+        with self._lock:
+            records = []
+            index = []
+            position = 0
+            for user_id in self.user_ids():
+                if user_id in self._profiles:
+                    record = _encode_profile(self._profiles[user_id])
+                elif self._version == PROFILE_FILE_VERSION:
+                    offset, length = self._lazy[user_id]
+                    record = self._mmap[offset:offset + length]
+                else:
+                    offset, _ = self._lazy[user_id]
+                    record = _encode_profile(_decode_profile(self._mmap, offset, self._version, self._loaded_at))
+                index.append(_encode_string(user_id) + _INDEX_ENTRY.pack(position, len(record)))
+                records.append(record)
+                position += len(record)
+            return b"".join([
+                _HEADER.pack(PROFILE_FILE_MAGIC, PROFILE_FILE_VERSION, journal_seq,
+                             len(self.keywords), len(self.memes), len(index)),
+                b"".join(_encode_string(word) for word in self.keywords.words),
+                b"".join(_encode_string(word) for word in self.memes.words),
+                b"".join(index),
+                b"".join(records)
+            ])
+
+    def load_binary(self, path: str) -> int:
+        """
+        Загружает словари и индекс пользователей из двоичного файла.
+        Returns:
+            int: Номер последней записи журнала, учтенной в файле
+        """
+        with self._lock:
+            self.clear()
+            journal_seq, keywords, memes, index = self._open(path)
+            for word in keywords:
+                self.keywords.intern(word)
+            for word in memes:
+                self.memes.intern(word)
+            self._lazy.update(index)
+            return journal_seq
+
+    def attach_binary(self, path: str):
+        """
+        Переключает хранилище на только что сохраненный файл: еще не декодированные
+        профили будут читаться из него (словари файла совпадают с текущими или короче).
+        """
+        with self._lock:
+            _, _, _, index = self._open(path)
+            self._lazy = {user_id: location for user_id, location in index.items()
+                          if user_id not in self._profiles}
+
+    def rename_memes(self, mapping: Dict[str, str]) -> int:
+        """
+        Переименовывает ID мемов в словаре (для миграции ID).
+        Если новый ID уже есть в словаре, оценки переносятся в профилях.
+        Returns:
+            int: Количество переименованных ID
+        """
+        with self._lock:
+            merges = {}
+            renamed = 0
+            for old_id, new_id in mapping.items():
+                index = self.memes.lookup(old_id)
+                if index is None or old_id == new_id:
+                    continue
+                existing = self.memes.lookup(new_id)
+                if existing is None:
+                    self.memes.rename(index, new_id)
+                else:
+                    merges[index] = existing
+                renamed += 1
+            if merges:
+                for user_id in self.user_ids():
+                    profile = self.get(user_id)
+                    for old_index, new_index in merges.items():
+                        rating = profile.rated.get(old_index)
+                        if rating is not None:
+                            profile.rated.remove(old_index)
+                            profile.rated.set(new_index, rating)
+            return renamed
+
+    def memory_stats(self) -> Dict:
+        """Статистика хранилища: пользователи, словари и объем векторов загруженных профилей"""
+        with self._lock:
+            vector_bytes = sum(
+                profile.liked.nbytes() + profile.disliked.nbytes() + profile.rated.nbytes()
+                for profile in self._profiles.values()
+            )
+            return {
+                "users": len(self),
+                "loaded_users": len(self._profiles),
+                "keywords": len(self.keywords),
+                "memes": len(self.memes),
+                "vector_bytes": vector_bytes,
+                "lazy_loads": self.lazy_loads,
+                "pruned_keywords": self.pruned_keywords
+            }
+
+    def _open(self, path: str):
+        """Открывает двоичный файл и разбирает его заголовок, словари и индекс"""
+        handle = open(path, 'rb')
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            handle.close()
+            raise
+        try:
+            magic, version, journal_seq, keywords_count, memes_count, users_count = _HEADER.unpack_from(data, 0)
+            if magic != PROFILE_FILE_MAGIC or version not in _SUPPORTED_VERSIONS:
+                raise ValueError(f"Неподдерживаемый формат файла профилей: {magic!r}, версия {version}")
+            offset = _HEADER.size
+            keywords = []
+            for _ in range(keywords_count):
+                word, offset = _decode_string(data, offset)
+                keywords.append(word)
+            memes = []
+            for _ in range(memes_count):
+                word, offset = _decode_string(data, offset)
+                memes.append(word)
+            entries = []
+            for _ in range(users_count):
+                user_id, offset = _decode_string(data, offset)
+                position, length = _INDEX_ENTRY.unpack_from(data, offset)
+                offset += _INDEX_ENTRY.size
+                entries.append((user_id, position, length))
+        except Exception:
+            data.close()
+            handle.close()
+            raise
+        # Записи профилей идут сразу за индексом
+        index = {user_id: (offset + position, length) for user_id, position, length in entries}
+        self._close()
+        self._file, self._mmap = handle, data
+        # В файлах версии 1 нет момента отсчета затухания: веса считаются актуальными на момент загрузки
+        self._version = version
+        self._loaded_at = time.time()
+        return journal_seq, keywords, memes, index
+
+    def _close(self):
+        """Закрывает текущий двоичный файл"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
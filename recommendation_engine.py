@@ -3,14 +3,25 @@
 Модуль рекомендательной системы для персонализированной подборки мемов.
 Анализирует оценки пользователя и рекомендует мемы на основе его предпочтений.
 """
+import atexit
+import heapq
 import logging
 import random
+import hashlib
 import json
 import os
-from collections import defaultdict
+import threading
+import time
 import re
+from collections import OrderedDict
+from functools import lru_cache
+from operator import itemgetter
 from typing import Dict, List, Set, Tuple, Optional, Any
 
+from meme_data import make_meme_id
+from preference_store import ProfileStore
+from storage import create_preference_journal
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,13 +32,110 @@ MIN_RATINGS_FOR_RECOMMENDATIONS = 5  # Минимальное количеств
 MAX_KEYWORDS_PER_MEME = 15          # Максимальное количество ключевых слов для извлечения из мема
 RECOMMENDATION_BOOST = 0.5          # Коэффициент усиления рекомендаций
 SIMILARITY_THRESHOLD = 0.2          # Порог схожести для рекомендаций
-USER_PREFERENCES_FILE = "user_preferences.json"  # Файл для сохранения предпочтений пользователей
+NEUTRAL_SCORE = 0.5                 # Рейтинг мема, о котором ничего не известно
+MINHASH_BANDS = 16                  # Число полос LSH
+MINHASH_ROWS = 2                    # Значений MinHash в полосе (порог кандидатов ~ (1/16)^(1/2) = 0.25)
+LSH_MAX_BUCKET_SCAN = 64            # Сколько мемов просматривается в одной корзине LSH
+MINHASH_PRIME = (1 << 61) - 1       # Модуль универсальных хеш-функций MinHash (простое число Мерсенна)
+MAX_SIMILAR_MEMES = 20              # Сколько ближайших соседей мема учитывается в усилении
+USER_PREFERENCES_FILE = "user_preferences.json"  # Файл предпочтений пользователей в старом формате JSON (только чтение)
+USER_PREFERENCES_BINARY_FILE = "user_preferences.bin"  # Двоичный снимок профилей пользователей
+USER_PREFERENCES_JOURNAL_FILE = "user_preferences.journal"  # Журнал оценок после последнего снимка (файловый бэкенд)
+PREFERENCES_FLUSH_INTERVAL = 5           # Интервал записи журнала на диск (сек)
+PREFERENCES_COMPACT_INTERVAL = 600       # Интервал сохранения полного снимка (сек)
+PREFERENCES_COMPACT_JOURNAL_BYTES = 4 * 1024 * 1024  # Размер журнала, при котором снимок сохраняется досрочно
+KEYWORDS_CACHE_MAX_ENTRIES = 10000       # Максимальное количество мемов в кэше ключевых слов
+KEYWORDS_BATCH_CHUNK = 1000              # По сколько мемов разбирает get_meme_keywords_batch за один вызов
+PREFERENCE_HALF_LIFE_DAYS = 30           # Через сколько дней вес ключевого слова в профиле уменьшается вдвое
+PREFERENCE_PRUNE_THRESHOLD = 0.01        # Ключевые слова с меньшим весом удаляются из профиля
+# Стемминг ключевых слов ("мемы" и "мем" дают один ключ). Включение меняет ключи
+# в профилях пользователей: старые веса со временем затухнут
+KEYWORD_STEMMING = False
+MIN_STEM_LENGTH = 3                      # Минимальная длина основы слова после отсечения окончания
+
+# Профили предпочтений пользователей (интернированные ключевые слова, разреженные векторы весов).
+# Веса затухают лениво: при чтении профиля, без обхода всех пользователей
+user_preferences = ProfileStore(half_life=PREFERENCE_HALF_LIFE_DAYS * 86400,
+                                prune_threshold=PREFERENCE_PRUNE_THRESHOLD)
+
+# Блокировка для изменения предпочтений и очереди записей журнала
+preferences_lock = threading.RLock()
+# Порядок записи журнала и снимка: запись в журнал не может попасть между снимком и очисткой журнала
+_journal_lock = threading.Lock()
+
+# Журнал оценок после последнего снимка (файл или таблица SQLite, см. модуль storage)
+_journal = create_preference_journal(USER_PREFERENCES_JOURNAL_FILE)
+
+# Записи журнала, еще не записанные на диск, и номер последней записи
+_pending_journal = []
+_journal_seq = 0
+_snapshot_seq = 0
+_last_compaction = time.time()
+_flush_thread = None
+_flush_stop = threading.Event()
+
+class KeywordCache:
+    """Кэш ключевых слов мемов ограниченного размера с вытеснением давно не использованных (LRU)"""
+
+    def __init__(self, max_entries: int = KEYWORDS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, List[str]]" = OrderedDict()  # от старых к новым
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, meme_id: str) -> bool:
+        return meme_id in self._entries
+
+    def get(self, meme_id: str) -> Optional[List[str]]:
+        """Возвращает ключевые слова мема или None, если их нет в кэше"""
+        with self._lock:
+            keywords = self._entries.get(meme_id)
+            if keywords is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(meme_id)
+            self.hits += 1
+            return keywords
+
+    def put(self, meme_id: str, keywords: List[str]):
+        """Сохраняет ключевые слова мема, вытесняя самые старые записи при переполнении"""
+        with self._lock:
+            self._entries[meme_id] = keywords
+            self._entries.move_to_end(meme_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, meme_id: str):
+        """Удаляет ключевые слова мема из кэша"""
+        with self._lock:
+            self._entries.pop(meme_id, None)
+
+    def clear(self):
+        """Очищает кэш"""
+        with self._lock:
+            self._entries.clear()
 
-# Словарь для хранения предпочтений пользователей
-user_preferences = {}
+    def stats(self) -> Dict:
+        """Возвращает статистику кэша"""
+        with self._lock:
+            requests_total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests_total, 3) if requests_total else 0.0,
+                "evictions": self.evictions
+            }
 
-# Словарь для кэширования извлеченных ключевых слов мемов
-meme_keywords_cache = {}
+# Кэш извлеченных ключевых слов мемов
+meme_keywords_cache = KeywordCache()
 
 # Стоп-слова для фильтрации при извлечении ключевых слов (русские и английские)
 STOP_WORDS = {
@@ -42,41 +150,199 @@ STOP_WORDS = {
     "ours"
 }
 
+# Токенизатор ключевых слов. Текст разбивается по пробельным символам, и только слова
+# со знаками препинания (не isalnum) дробятся скомпилированным выражением: \w - это
+# символы isalnum и "_", поэтому результат совпадает с заменой [^\w\s] на пробелы и split
+_WORD_PATTERN = re.compile(r'\w+')
+# Сколько слов разбирается сразу: в длинных постах ключевые слова обычно набираются
+# в начале, и остаток текста разбирается, только если их не хватило
+_TOKENIZE_CHUNK_WORDS = 32
+# Стоп-слова, которые не отсеиваются ограничением длины ключевого слова
+_LONG_STOP_WORDS = frozenset(word for word in STOP_WORDS if len(word) > 2)
+
+# Типичные окончания русских существительных, прилагательных и глаголов по длине
+_RUSSIAN_ENDINGS = {
+    4: {"ться", "ющий", "ющая", "ющие"},
+    3: {"ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ете", "ишь", "ите", "ать", "ять",
+        "ить", "еть", "ной", "ных", "ные", "ный"},
+    2: {"ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ом", "ем", "ам", "ям", "ах", "ях", "ов",
+        "ев", "ей", "ию", "ия", "ью", "ых", "их", "ую", "юю", "ет", "ит", "ут", "ют", "ат", "ят", "ть"},
+    1: {"а", "я", "ы", "и", "о", "е", "у", "ю", "ь", "й"},
+}
+
 def load_preferences():
-    """Загружает предпочтения пользователей из файла"""
-    global user_preferences
+    """
+    Загружает предпочтения пользователей: последний снимок из файла
+    и записи журнала, сделанные после него (восстановление после сбоя).
+    Из двоичного снимка читаются только словари и индекс, профили
+    декодируются при первом обращении. Если двоичного снимка еще нет,
+    читается снимок в старом формате JSON.
+    """
+    global _journal_seq, _snapshot_seq
     try:
-        if os.path.exists(USER_PREFERENCES_FILE):
+        if os.path.exists(USER_PREFERENCES_BINARY_FILE):
+            _snapshot_seq = user_preferences.load_binary(USER_PREFERENCES_BINARY_FILE)
+            _journal_seq = _snapshot_seq
+            logger.info(f"Загружен индекс предпочтений для {len(user_preferences)} пользователей")
+        elif os.path.exists(USER_PREFERENCES_FILE):
             with open(USER_PREFERENCES_FILE, 'r', encoding='utf-8') as f:
-                user_preferences = json.load(f)
-                logger.info(f"Загружены предпочтения для {len(user_preferences)} пользователей")
+                snapshot = json.load(f)
+            # Старый формат файла - сразу словарь пользователей
+            user_preferences.clear()
+            if "users" in snapshot and "journal_seq" in snapshot:
+                user_preferences.load_dicts(snapshot["users"])
+                _snapshot_seq = snapshot["journal_seq"]
+            else:
+                user_preferences.load_dicts(snapshot)
+                _snapshot_seq = 0
+            _journal_seq = _snapshot_seq
+            logger.info(f"Загружены предпочтения для {len(user_preferences)} пользователей из JSON")
     except Exception as e:
         logger.error(f"Ошибка при загрузке предпочтений пользователей: {e}")
+    
+    replayed = 0
+    try:
+        for entry in _journal.read():
+            if entry["seq"] <= _snapshot_seq:
+                continue
+            _apply_rating(entry["user_id"], entry["meme_id"], entry["keywords"], entry["rating"],
+                          entry.get("timestamp"))
+            _journal_seq = max(_journal_seq, entry["seq"])
+            replayed += 1
+        if replayed:
+            logger.info(f"Из журнала восстановлено {replayed} оценок")
+    except Exception as e:
+        logger.error(f"Ошибка при чтении журнала предпочтений: {e}")
 
 def save_preferences():
-    """Сохраняет предпочтения пользователей в файл"""
+    """
+    Сохраняет полный двоичный снимок предпочтений пользователей и очищает журнал.
+    Снимок записывается атомарно и хранит номер последней учтенной записи журнала,
+    поэтому сбой между записью снимка и очисткой журнала не приводит к двойному учету.
+    """
+    global _pending_journal, _snapshot_seq, _last_compaction
     try:
-        with open(USER_PREFERENCES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_preferences, f, ensure_ascii=False, indent=2)
-        logger.info(f"Сохранены предпочтения для {len(user_preferences)} пользователей")
+        with _journal_lock:
+            with preferences_lock:
+                # Ожидающие записи уже учтены в снимке
+                _pending_journal = []
+                seq = _journal_seq
+                data = user_preferences.dump_binary(seq)
+                users_count = len(user_preferences)
+            tmp_file = f"{USER_PREFERENCES_BINARY_FILE}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, USER_PREFERENCES_BINARY_FILE)
+            with preferences_lock:
+                # Незагруженные профили дальше читаются из нового файла
+                user_preferences.attach_binary(USER_PREFERENCES_BINARY_FILE)
+            _snapshot_seq = seq
+            # Под _journal_lock журнал содержит только записи с seq <= seq снимка
+            _journal.clear()
+            _last_compaction = time.time()
+        logger.info(f"Сохранены предпочтения для {users_count} пользователей ({len(data)} байт)")
     except Exception as e:
         logger.error(f"Ошибка при сохранении предпочтений пользователей: {e}")
 
-def extract_keywords(text: str) -> List[str]:
-    """Извлекает ключевые слова из текста, удаляя стоп-слова и знаки препинания"""
+def flush_preferences():
+    """Дописывает накопленные оценки в журнал предпочтений"""
+    global _pending_journal
+    with _journal_lock:
+        with preferences_lock:
+            entries, _pending_journal = _pending_journal, []
+        if not entries:
+            return
+        try:
+            _journal.append(entries)
+            logger.debug(f"В журнал предпочтений записано {len(entries)} оценок")
+        except Exception as e:
+            logger.error(f"Ошибка при записи журнала предпочтений: {e}")
+            # Возвращаем записи в очередь, чтобы не потерять их
+            with preferences_lock:
+                _pending_journal = entries + _pending_journal
+
+def _flush_loop():
+    """Фоновый поток: периодически пишет журнал и сохраняет снимок предпочтений"""
+    while not _flush_stop.wait(PREFERENCES_FLUSH_INTERVAL):
+        flush_preferences()
+        journal_size = _journal.size()
+        if journal_size and (journal_size >= PREFERENCES_COMPACT_JOURNAL_BYTES or
+                             time.time() - _last_compaction >= PREFERENCES_COMPACT_INTERVAL):
+            save_preferences()
+
+def _ensure_flush_thread():
+    """Запускает фоновый поток сохранения предпочтений, если он еще не запущен"""
+    global _flush_thread
+    if _flush_thread is None or not _flush_thread.is_alive():
+        _flush_thread = threading.Thread(target=_flush_loop, name="preferences-flush", daemon=True)
+        _flush_thread.start()
+
+def _shutdown_preferences():
+    """Останавливает фоновый поток и сбрасывает оставшиеся оценки на диск"""
+    _flush_stop.set()
+    flush_preferences()
+
+@lru_cache(maxsize=50000)
+def stem_word(word: str) -> str:
+    """Облегченный стемминг русских слов: отсекает самое длинное типичное окончание"""
+    for length in (4, 3, 2, 1):
+        if len(word) - length >= MIN_STEM_LENGTH and word[-length:] in _RUSSIAN_ENDINGS[length]:
+            return word[:-length]
+    return word
+
+def _split_words(words: List[str]) -> List[str]:
+    """Дробит слова со знаками препинания на последовательности символов слова"""
+    if all(map(str.isalnum, words)):
+        return words
+    return [part for word in words for part in ((word,) if word.isalnum() else _WORD_PATTERN.findall(word))]
+
+def _lowered_keywords(text: str, stemming: bool) -> List[str]:
+    """Ключевые слова текста, уже приведенного к нижнему регистру"""
+    words = text.split(None, _TOKENIZE_CHUNK_WORDS)
+    rest = words.pop() if len(words) > _TOKENIZE_CHUNK_WORDS else None
+    keywords = [word for word in _split_words(words) if len(word) > 2 and word not in _LONG_STOP_WORDS]
+    if rest is not None and len(keywords) < MAX_KEYWORDS_PER_MEME:
+        keywords += [word for word in _split_words(rest.split()) if len(word) > 2 and word not in _LONG_STOP_WORDS]
+    keywords = keywords[:MAX_KEYWORDS_PER_MEME]
+    if stemming:
+        return [stem_word(word) for word in keywords]
+    return keywords
+
+def extract_keywords(text: str, stemming: Optional[bool] = None) -> List[str]:
+    """
+    Извлекает ключевые слова из текста, удаляя стоп-слова и знаки препинания.
+    stemming включает стемминг (по умолчанию KEYWORD_STEMMING).
+    """
     if not text:
         return []
-    
-    # Приводим к нижнему регистру и удаляем лишние символы
-    text = text.lower()
-    text = re.sub(r'[^\w\s]', ' ', text)
-    
-    # Разбиваем на слова и удаляем стоп-слова
-    words = text.split()
-    keywords = [word for word in words if word not in STOP_WORDS and len(word) > 2]
-    
-    # Ограничиваем количество ключевых слов
-    return keywords[:MAX_KEYWORDS_PER_MEME]
+    if stemming is None:
+        stemming = KEYWORD_STEMMING
+    return _lowered_keywords(text.lower(), stemming)
+
+def extract_keywords_batch(texts: List[Optional[str]], stemming: Optional[bool] = None) -> List[List[str]]:
+    """
+    Извлекает ключевые слова сразу из всех текстов пакета (например, пакета загрузки).
+    Повторяющиеся тексты пакета (дубликаты постов, одинаковые теги) разбираются один раз.
+    Результат совпадает с extract_keywords для каждого текста.
+    """
+    # Склейка пакета в одну строку для одного прохода оказалась медленнее разбора
+    # по текстам (замеры в benchmarks/bench_keywords.py, см. README)
+    if stemming is None:
+        stemming = KEYWORD_STEMMING
+    parsed: Dict[Optional[str], List[str]] = {}
+    results = []
+    for text in texts:
+        keywords = parsed.get(text)
+        if keywords is None:
+            keywords = parsed[text] = _lowered_keywords(text.lower(), stemming) if text else []
+        results.append(list(keywords))
+    return results
+
+def _get_meme_id(meme: Dict) -> str:
+    """Возвращает идентификатор мема, под которым он хранится в истории оценок и кэше ключевых слов"""
+    return meme.get('id') or make_meme_id(meme)
 
 def get_meme_keywords(meme: Dict) -> List[str]:
     """
@@ -84,38 +350,80 @@ def get_meme_keywords(meme: Dict) -> List[str]:
     Кэширует результаты для улучшения производительности.
     """
     # Создаем уникальный идентификатор мема для кэширования
-    meme_id = meme.get('id', '')
-    if not meme_id and 'image_url' in meme:
-        meme_id = str(hash(meme['image_url']))
+    meme_id = _get_meme_id(meme)
     
     # Если ключевые слова уже в кэше, возвращаем их
-    if meme_id in meme_keywords_cache:
-        return meme_keywords_cache[meme_id]
-    
-    keywords = []
+    cached = meme_keywords_cache.get(meme_id)
+    if cached is not None:
+        return cached
     
-    # Извлекаем ключевые слова из текста
-    if 'text' in meme and meme['text']:
-        text_keywords = extract_keywords(meme['text'])
-        keywords.extend(text_keywords)
-    
-    # Добавляем теги как ключевые слова
-    if 'tags' in meme and isinstance(meme['tags'], list):
-        for tag in meme['tags']:
-            tag_keywords = extract_keywords(tag)
-            keywords.extend(tag_keywords)
-            # Также добавляем сам тег, если он не в стоп-словах
-            if tag.lower() not in STOP_WORDS and len(tag) > 2:
-                keywords.append(tag.lower())
-    
-    # Удаляем дубликаты
-    unique_keywords = list(set(keywords))
+    tags = _get_meme_tags(meme)
+    unique_keywords = _collect_keywords(extract_keywords(meme.get('text')), tags,
+                                        [extract_keywords(tag) for tag in tags])
     
     # Кэшируем результат
-    meme_keywords_cache[meme_id] = unique_keywords
+    meme_keywords_cache.put(meme_id, unique_keywords)
     
     return unique_keywords
 
+def get_meme_keywords_batch(memes: List[Dict]) -> List[List[str]]:
+    """
+    Получает ключевые слова для пакета мемов (например, всех мемов, добавленных в коллекцию).
+    Тексты и теги мемов, которых нет в кэше, разбираются вызовами extract_keywords_batch
+    по KEYWORDS_BATCH_CHUNK мемов.
+    """
+    # Один вызов на весь пакет держит в памяти списки слов всех мемов сразу и на
+    # 100 тыс. мемов оказался медленнее разбора по одному (см. README)
+    results = []
+    for start in range(0, len(memes), KEYWORDS_BATCH_CHUNK):
+        results.extend(_get_meme_keywords_chunk(memes[start:start + KEYWORDS_BATCH_CHUNK]))
+    return results
+
+def _get_meme_keywords_chunk(memes: List[Dict]) -> List[List[str]]:
+    """Ключевые слова для части пакета get_meme_keywords_batch"""
+    results: List[Optional[List[str]]] = [None] * len(memes)
+    missing = []
+    for index, meme in enumerate(memes):
+        meme_id = _get_meme_id(meme)
+        cached = meme_keywords_cache.get(meme_id)
+        if cached is None:
+            missing.append((index, meme_id, _get_meme_tags(meme)))
+        else:
+            results[index] = cached
+    
+    texts = [memes[index].get('text') for index, _, _ in missing]
+    all_tags = [tag for _, _, tags in missing for tag in tags]
+    tokenized = extract_keywords_batch(texts + all_tags)
+    tags_tokenized = iter(tokenized[len(texts):])
+    for (index, meme_id, tags), text_keywords in zip(missing, tokenized):
+        keywords = _collect_keywords(text_keywords, tags, [next(tags_tokenized) for _ in tags])
+        meme_keywords_cache.put(meme_id, keywords)
+        results[index] = keywords
+    return results
+
+def _get_meme_tags(meme: Dict) -> List[str]:
+    """Теги мема (пустой список, если их нет)"""
+    tags = meme.get('tags')
+    return tags if isinstance(tags, list) else []
+
+def _collect_keywords(text_keywords: List[str], tags: List[str], tags_keywords: List[List[str]]) -> List[str]:
+    """Объединяет ключевые слова текста и тегов мема без повторов"""
+    keywords = list(text_keywords)
+    for tag, tag_keywords in zip(tags, tags_keywords):
+        keywords.extend(tag_keywords)
+        # Также добавляем сам тег, если он не в стоп-словах
+        tag = tag.lower()
+        if tag not in STOP_WORDS and len(tag) > 2:
+            keywords.append(tag)
+    
+    # Удаляем дубликаты
+    return list(set(keywords))
+
+def forget_meme(meme_id: str):
+    """Удаляет данные мема, покинувшего коллекцию, из кэша ключевых слов и матрицы рекомендаций"""
+    meme_keywords_cache.invalidate(meme_id)
+    meme_matrix.remove_meme(meme_id)
+
 def calculate_meme_similarity(meme1: Dict, meme2: Dict) -> float:
     """
     Рассчитывает коэффициент сходства между двумя мемами на основе ключевых слов.
@@ -135,6 +443,203 @@ def calculate_meme_similarity(meme1: Dict, meme2: Dict) -> float:
     
     return similarity
 
+# Коэффициенты хеш-функций MinHash; фиксированное зерно дает одинаковые сигнатуры между перезапусками
+_minhash_random = random.Random(0x6d656d65)
+_MINHASH_COEFFICIENTS = [
+    (_minhash_random.randrange(1, MINHASH_PRIME), _minhash_random.randrange(0, MINHASH_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+class MemeKeywordMatrix:
+    """
+    Разреженная бинарная матрица мем × ключевое слово для пакетного расчета рейтингов.
+    Хранится по столбцам: для каждого ключевого слова - мемы коллекции, в которых оно встречается.
+    Рейтинги всех мемов считаются как одно произведение матрицы на вектор весов
+    ключевых слов пользователя: обходятся только столбцы слов из его предпочтений.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.meme_keywords: Dict[str, List[str]] = {}          # Строки: ключ мема в коллекции -> ключевые слова
+        self.postings: Dict[str, Dict[str, None]] = {}         # Столбцы: ключевое слово -> ключи мемов
+        self.keys_by_meme_id: Dict[str, Dict[str, None]] = {}  # ID мема в истории оценок -> ключи мемов
+        self.meme_ids: Dict[str, str] = {}                    # Ключ мема -> ID мема в истории оценок
+        # LSH по сигнатурам MinHash наборов ключевых слов: (полоса, значения) -> ключи мемов
+        self.lsh_buckets: Dict[Tuple, Dict[str, None]] = {}
+        self._keyword_sets: Dict[str, frozenset] = {}
+        self._keyword_hashes: Dict[str, Tuple[int, ...]] = {}
+        # Ближайшие соседи мемов; сбрасываются при любом изменении коллекции
+        self._neighbors: Dict[str, List[Tuple[str, float]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.meme_keywords)
+
+    def add_meme(self, meme_key: str, meme: Dict, keywords: Optional[List[str]] = None):
+        """Добавляет мем в матрицу (строку с его ключевыми словами, если они уже известны)"""
+        if keywords is None:
+            keywords = get_meme_keywords(meme)
+        meme_id = _get_meme_id(meme)
+        with self._lock:
+            if meme_key in self.meme_keywords:
+                self.remove_meme(meme_key)
+            self._neighbors.clear()
+            self.meme_keywords[meme_key] = keywords
+            self.meme_ids[meme_key] = meme_id
+            self.keys_by_meme_id.setdefault(meme_id, {})[meme_key] = None
+            for keyword in keywords:
+                self.postings.setdefault(keyword, {})[meme_key] = None
+            if keywords:
+                self._keyword_sets[meme_key] = frozenset(keywords)
+                for band_key in self._band_keys(keywords):
+                    self.lsh_buckets.setdefault(band_key, {})[meme_key] = None
+
+    def remove_meme(self, meme_key: str):
+        """Удаляет мем из матрицы"""
+        with self._lock:
+            keywords = self.meme_keywords.pop(meme_key, None)
+            if keywords is None:
+                return
+            self._neighbors.clear()
+            for keyword in keywords:
+                column = self.postings.get(keyword)
+                if column is not None:
+                    column.pop(meme_key, None)
+                    if not column:
+                        del self.postings[keyword]
+            if meme_key in self._keyword_sets:
+                for band_key in self._band_keys(self._keyword_sets.pop(meme_key)):
+                    bucket = self.lsh_buckets.get(band_key)
+                    if bucket is not None:
+                        bucket.pop(meme_key, None)
+                        if not bucket:
+                            del self.lsh_buckets[band_key]
+            meme_id = self.meme_ids.pop(meme_key)
+            keys = self.keys_by_meme_id.get(meme_id)
+            if keys is not None:
+                keys.pop(meme_key, None)
+                if not keys:
+                    del self.keys_by_meme_id[meme_id]
+                    # Мем покинул коллекцию: его ключевые слова больше не нужны
+                    meme_keywords_cache.invalidate(meme_id)
+
+    def sync(self, memes_collection: Dict[str, Dict]):
+        """Приводит матрицу в соответствие с коллекцией: обрабатываются только добавленные и удаленные мемы"""
+        with self._lock:
+            removed = self.meme_keywords.keys() - memes_collection.keys()
+            added = memes_collection.keys() - self.meme_keywords.keys()
+            for meme_key in removed:
+                self.remove_meme(meme_key)
+            # Порядок добавления совпадает с порядком коллекции, ключевые слова извлекаются пакетом
+            added_keys = [meme_key for meme_key in memes_collection if meme_key in added]
+            added_memes = [memes_collection[meme_key] for meme_key in added_keys]
+            for meme_key, meme, keywords in zip(added_keys, added_memes, get_meme_keywords_batch(added_memes)):
+                self.add_meme(meme_key, meme, keywords)
+            if removed or added:
+                logger.debug(f"Матрица ключевых слов обновлена: +{len(added)} -{len(removed)}, всего {len(self)}")
+
+    def _keyword_hash(self, keyword: str) -> Tuple[int, ...]:
+        """
+        Значения всех хеш-функций MinHash для ключевого слова (кэшируются по словарю).
+        Функции вида (a * h + b) mod p от 64-битного хеша слова независимы между собой,
+        в отличие от crc32 с разными начальными значениями, которые при равной длине
+        слов дают один и тот же порядок
+        """
+        hashes = self._keyword_hashes.get(keyword)
+        if hashes is None:
+            value = int.from_bytes(hashlib.blake2b(keyword.encode('utf-8'), digest_size=8).digest(), 'little')
+            value %= MINHASH_PRIME
+            hashes = tuple((a * value + b) % MINHASH_PRIME for a, b in _MINHASH_COEFFICIENTS)
+            self._keyword_hashes[keyword] = hashes
+        return hashes
+
+    def _band_keys(self, keywords) -> List[Tuple]:
+        """Сигнатура MinHash набора ключевых слов, разбитая на полосы LSH"""
+        signature = list(map(min, zip(*(self._keyword_hash(keyword) for keyword in keywords))))
+        return [
+            (band,) + tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS])
+            for band in range(MINHASH_BANDS)
+        ]
+
+    def find_similar(self, keywords: List[str], exclude_meme_id: str = "") -> List[Tuple[str, float]]:
+        """
+        Находит мемы коллекции, похожие на набор ключевых слов.
+        Кандидаты берутся из корзин LSH (не больше LSH_MAX_BUCKET_SCAN из каждой),
+        для них считается точный коэффициент Жаккара.
+        Returns:
+            List[Tuple[str, float]]: Не больше MAX_SIMILAR_MEMES самых похожих мемов
+            со сходством выше SIMILARITY_THRESHOLD, по убыванию сходства
+        """
+        if not keywords:
+            return []
+        keyword_set = frozenset(keywords)
+        similar = []
+        with self._lock:
+            candidates = {}
+            for band_key in self._band_keys(keyword_set):
+                bucket = self.lsh_buckets.get(band_key)
+                if bucket:
+                    for scanned, meme_key in enumerate(bucket):
+                        if scanned >= LSH_MAX_BUCKET_SCAN:
+                            break
+                        candidates[meme_key] = None
+            for meme_key in candidates:
+                if self.meme_ids[meme_key] == exclude_meme_id:
+                    continue
+                other = self._keyword_sets[meme_key]
+                similarity = len(keyword_set & other) / len(keyword_set | other)
+                if similarity > SIMILARITY_THRESHOLD:
+                    similar.append((meme_key, similarity))
+        return heapq.nlargest(MAX_SIMILAR_MEMES, similar, key=itemgetter(1))
+
+    def neighbors(self, meme_key: str) -> List[Tuple[str, float]]:
+        """Ближайшие соседи мема коллекции (результат кэшируется до изменения коллекции)"""
+        with self._lock:
+            similar = self._neighbors.get(meme_key)
+            if similar is None:
+                similar = self.find_similar(self.meme_keywords.get(meme_key, []), self.meme_ids.get(meme_key, ""))
+                self._neighbors[meme_key] = similar
+            return similar
+
+    def similarity_boosts(self, rated_memes: Dict[str, int]) -> Dict[str, float]:
+        """
+        Усиление рейтинга мемов, похожих на понравившиеся пользователю.
+        Обходятся только ближайшие соседи понравившихся мемов из корзин LSH,
+        поэтому стоимость зависит от числа оценок, но не от размера коллекции.
+        Returns:
+            Dict[str, float]: Ключ мема -> усиление
+        """
+        boosts = {}
+        with self._lock:
+            for meme_id, rating in rated_memes.items():
+                # Учитываем только положительно оцененные мемы, которые есть в коллекции
+                if rating <= 0:
+                    continue
+                for liked_key in self.keys_by_meme_id.get(meme_id, ()):
+                    for meme_key, similarity in self.neighbors(liked_key):
+                        boosts[meme_key] = boosts.get(meme_key, 0) + similarity * RECOMMENDATION_BOOST
+        return boosts
+
+    def score(self, liked_keywords: Dict[str, float], disliked_keywords: Dict[str, float]) -> Dict[str, float]:
+        """
+        Умножает матрицу на вектор весов пользователя (понравившиеся минус непонравившиеся).
+        Returns:
+            Dict[str, float]: Ключ мема -> суммарный вес; мемы без общих слов с предпочтениями не попадают
+        """
+        totals = {}
+        with self._lock:
+            for weights, sign in ((liked_keywords, 1.0), (disliked_keywords, -1.0)):
+                for keyword, weight in weights.items():
+                    column = self.postings.get(keyword)
+                    if not column:
+                        continue
+                    weight *= sign
+                    for meme_key in column:
+                        totals[meme_key] = totals.get(meme_key, 0) + weight
+        return totals
+
+# Матрица ключевых слов мемов коллекции бота
+meme_matrix = MemeKeywordMatrix()
+
 def update_user_preferences(user_id: int, meme: Dict, rating: int):
     """
     Обновляет предпочтения пользователя на основе оцененного мема.
@@ -144,43 +649,54 @@ def update_user_preferences(user_id: int, meme: Dict, rating: int):
         meme (Dict): Данные мема
         rating (int): Оценка (1 - положительная, -1 - отрицательная)
     """
+    global _journal_seq
     # Преобразуем ID пользователя в строку для JSON
     user_id_str = str(user_id)
     
-    # Инициализируем предпочтения пользователя, если их еще нет
-    if user_id_str not in user_preferences:
-        user_preferences[user_id_str] = {
-            "liked_keywords": defaultdict(float),
-            "disliked_keywords": defaultdict(float),
-            "rated_memes": {},
-            "total_ratings": 0
-        }
-    
     # Добавляем мем в историю оцененных
-    meme_id = meme.get('id', '')
-    if not meme_id and 'image_url' in meme:
-        meme_id = str(hash(meme['image_url']))
-    
-    user_preferences[user_id_str]["rated_memes"][meme_id] = rating
-    user_preferences[user_id_str]["total_ratings"] += 1
+    meme_id = _get_meme_id(meme)
     
     # Получаем ключевые слова мема
     keywords = get_meme_keywords(meme)
     
-    # Обновляем статистику ключевых слов
-    weight = 1.0 / max(1, len(keywords))  # Вес, зависящий от количества ключевых слов
-    
-    if rating > 0:
-        # Положительная оценка
-        for keyword in keywords:
-            user_preferences[user_id_str]["liked_keywords"][keyword] += weight
-    else:
-        # Отрицательная оценка
-        for keyword in keywords:
-            user_preferences[user_id_str]["disliked_keywords"][keyword] += weight
-    
-    # Сохраняем обновленные предпочтения
-    save_preferences()
+    timestamp = int(time.time())
+    with preferences_lock:
+        _apply_rating(user_id_str, meme_id, keywords, rating, timestamp)
+        # Оценка попадает в журнал фоновым потоком, здесь только постановка в очередь
+        _journal_seq += 1
+        _pending_journal.append({
+            "seq": _journal_seq,
+            "user_id": user_id_str,
+            "meme_id": meme_id,
+            "keywords": keywords,
+            "rating": rating,
+            "timestamp": timestamp
+        })
+    _ensure_flush_thread()
+
+def _apply_rating(user_id_str: str, meme_id: str, keywords: List[str], rating: int,
+                  timestamp: Optional[float] = None):
+    """
+    Применяет оценку к предпочтениям пользователя (также используется при восстановлении из журнала).
+    Вес оценки затухает от момента timestamp, когда она была поставлена.
+    """
+    user_preferences.apply_rating(user_id_str, meme_id, keywords, rating, timestamp)
+
+def _get_user_data(user_id_str: str) -> Optional[Dict]:
+    """
+    Возвращает копию предпочтений пользователя в виде словарей строк
+    (liked_keywords, disliked_keywords, rated_memes, total_ratings) или None
+    """
+    with preferences_lock:
+        profile = user_preferences.get(user_id_str)
+        if profile is None:
+            return None
+        return {
+            "liked_keywords": user_preferences.keyword_weights(profile, profile.liked),
+            "disliked_keywords": user_preferences.keyword_weights(profile, profile.disliked),
+            "rated_memes": user_preferences.rated_memes(profile),
+            "total_ratings": profile.total_ratings
+        }
 
 def get_recommendation_score(user_id: int, meme: Dict) -> float:
     """
@@ -195,37 +711,34 @@ def get_recommendation_score(user_id: int, meme: Dict) -> float:
         float: Рейтинг рекомендации (чем выше, тем лучше)
     """
     user_id_str = str(user_id)
-    
-    # Если нет предпочтений пользователя или недостаточно оценок, возвращаем нейтральный рейтинг
-    if (user_id_str not in user_preferences or 
-        user_preferences[user_id_str]["total_ratings"] < MIN_RATINGS_FOR_RECOMMENDATIONS):
-        return 0.5  # Нейтральный рейтинг
-    
-    # Проверяем, не оценил ли пользователь этот мем ранее
-    meme_id = meme.get('id', '')
-    if not meme_id and 'image_url' in meme:
-        meme_id = str(hash(meme['image_url']))
-    
-    rated_memes = user_preferences[user_id_str]["rated_memes"]
-    if meme_id in rated_memes:
-        # Если мем был оценен положительно, даем высокий рейтинг для повторного показа
-        # Если отрицательно - низкий рейтинг
-        return 0.9 if rated_memes[meme_id] > 0 else 0.1
-    
-    # Получаем ключевые слова мема
+    meme_id = _get_meme_id(meme)
+    # Ключевые слова мема не зависят от профиля и считаются без блокировки
     keywords = get_meme_keywords(meme)
+    meme_keys = meme_matrix.keys_by_meme_id.get(meme_id)
     
-    # Если нет ключевых слов, возвращаем нейтральный рейтинг
-    if not keywords:
-        return 0.5
-    
-    # Получаем данные пользовательских предпочтений
-    liked_keywords = user_preferences[user_id_str]["liked_keywords"]
-    disliked_keywords = user_preferences[user_id_str]["disliked_keywords"]
-    
-    # Рассчитываем рейтинги на основе ключевых слов
-    like_score = sum(liked_keywords.get(keyword, 0) for keyword in keywords)
-    dislike_score = sum(disliked_keywords.get(keyword, 0) for keyword in keywords)
+    # Профиль меняется при оценках и сохранении снимка, поэтому читаем его под блокировкой
+    with preferences_lock:
+        profile = user_preferences.get(user_id_str)
+        
+        # Если нет предпочтений пользователя или недостаточно оценок, возвращаем нейтральный рейтинг
+        if profile is None or profile.total_ratings < MIN_RATINGS_FOR_RECOMMENDATIONS:
+            return 0.5  # Нейтральный рейтинг
+        
+        # Проверяем, не оценил ли пользователь этот мем ранее
+        rating = user_preferences.get_rating(profile, meme_id)
+        if rating is not None:
+            # Если мем был оценен положительно, даем высокий рейтинг для повторного показа
+            # Если отрицательно - низкий рейтинг
+            return 0.9 if rating > 0 else 0.1
+        
+        # Если нет ключевых слов, возвращаем нейтральный рейтинг
+        if not keywords:
+            return 0.5
+        
+        # Рассчитываем рейтинги на основе ключевых слов
+        like_score = sum(user_preferences.keyword_weight(profile, profile.liked, keyword) for keyword in keywords)
+        dislike_score = sum(user_preferences.keyword_weight(profile, profile.disliked, keyword) for keyword in keywords)
+        rated_memes = user_preferences.rated_memes(profile) if meme_keys else None
     
     # Нормализуем и комбинируем рейтинги
     total_score = like_score - dislike_score
@@ -233,25 +746,9 @@ def get_recommendation_score(user_id: int, meme: Dict) -> float:
     # Проверяем схожесть с ранее понравившимися мемами
     similarity_boost = 0
     
-    # Перебираем ранее оцененные мемы пользователя
-    for rated_meme_id, rating in rated_memes.items():
-        # Рассматриваем только положительно оцененные мемы
-        if rating <= 0:
-            continue
-        
-        # Находим мем в коллекции по ID
-        # Если мема нет в коллекции, пропускаем
-        # В реальной системе здесь нужно будет доработать поиск мема по ID
-        try:
-            # Здесь предполагается, что можно получить мем по ID из какой-то коллекции
-            # Так как у нас нет прямого доступа к коллекции здесь, данный блок будет реализован позже
-            # rated_meme = get_meme_by_id(rated_meme_id)
-            # similarity = calculate_meme_similarity(meme, rated_meme)
-            # if similarity > SIMILARITY_THRESHOLD:
-            #     similarity_boost += similarity * RECOMMENDATION_BOOST
-            pass
-        except:
-            continue
+    # Усиление от понравившихся мемов коллекции, среди ближайших соседей которых есть этот мем
+    if meme_keys:
+        similarity_boost = meme_matrix.similarity_boosts(rated_memes).get(next(iter(meme_keys)), 0)
     
     # Преобразуем итоговый рейтинг в диапазон [0,1]
     final_score = 0.5 + (total_score + similarity_boost) * 0.1
@@ -259,7 +756,8 @@ def get_recommendation_score(user_id: int, meme: Dict) -> float:
     
     return final_score
 
-def recommend_memes(user_id: int, memes_collection: Dict[str, Dict], count: int = 5) -> List[str]:
+def recommend_memes(user_id: int, memes_collection: Dict[str, Dict], count: int = 5,
+                    exclude: Optional[Set[str]] = None) -> List[str]:
     """
     Рекомендует мемы для пользователя на основе его предпочтений.
     
@@ -267,30 +765,64 @@ def recommend_memes(user_id: int, memes_collection: Dict[str, Dict], count: int
         user_id (int): ID пользователя
         memes_collection (Dict): Коллекция доступных мемов
         count (int): Количество мемов для рекомендации
+        exclude (Set[str]): ID мемов, которые не нужно рекомендовать (например, уже просмотренные)
     
     Returns:
         List[str]: Список ID рекомендованных мемов
     """
     user_id_str = str(user_id)
+    exclude = exclude or set()
+    # Рекомендации могут считаться в фоновом потоке, поэтому работаем с копией предпочтений
+    user_data = _get_user_data(user_id_str)
     
     # Если у пользователя недостаточно оценок, возвращаем случайные мемы
-    if (user_id_str not in user_preferences or 
-        user_preferences[user_id_str]["total_ratings"] < MIN_RATINGS_FOR_RECOMMENDATIONS):
+    if user_data is None or user_data["total_ratings"] < MIN_RATINGS_FOR_RECOMMENDATIONS:
         logger.info(f"Недостаточно оценок для персонализированных рекомендаций пользователю {user_id}")
-        return random.sample(list(memes_collection.keys()), min(count, len(memes_collection)))
-    
-    # Вычисляем рейтинги рекомендаций для всех мемов
-    recommendation_scores = {}
-    
-    for meme_id, meme in memes_collection.items():
-        score = get_recommendation_score(user_id, meme)
-        recommendation_scores[meme_id] = score
-    
-    # Сортируем мемы по рейтингу (от высокого к низкому)
-    sorted_memes = sorted(recommendation_scores.items(), key=lambda x: x[1], reverse=True)
+        available = [meme_id for meme_id in memes_collection if meme_id not in exclude]
+        return random.sample(available, min(count, len(available)))
+    
+    # Рейтинги всех мемов одним произведением матрицы на вектор предпочтений
+    # плюс усиление для соседей понравившихся мемов. Формула та же, что в
+    # get_recommendation_score; остальные мемы получают нейтральный рейтинг
+    meme_matrix.sync(memes_collection)
+    totals = meme_matrix.score(user_data["liked_keywords"], user_data["disliked_keywords"])
+    for meme_key, boost in meme_matrix.similarity_boosts(user_data["rated_memes"]).items():
+        totals[meme_key] = totals.get(meme_key, 0) + boost
+    recommendation_scores = {
+        meme_key: max(0, min(1, NEUTRAL_SCORE + total * 0.1))
+        for meme_key, total in totals.items()
+    }
     
-    # Выбираем топ-N мемов
-    recommended_meme_ids = [meme_id for meme_id, score in sorted_memes[:count]]
+    # Ранее оцененные мемы: высокий рейтинг для понравившихся, низкий для остальных
+    for meme_id, rating in user_data["rated_memes"].items():
+        for meme_key in meme_matrix.keys_by_meme_id.get(meme_id, ()):
+            recommendation_scores[meme_key] = 0.9 if rating > 0 else 0.1
+    
+    # Топ-N без полной сортировки: сначала мемы с рейтингом выше нейтрального,
+    # затем нейтральные в порядке коллекции, затем остальные
+    recommended_meme_ids = [
+        meme_key for meme_key, score in heapq.nlargest(
+            count,
+            ((meme_key, score) for meme_key, score in recommendation_scores.items()
+             if score > NEUTRAL_SCORE and meme_key in memes_collection and meme_key not in exclude),
+            key=itemgetter(1)
+        )
+    ]
+    if len(recommended_meme_ids) < count:
+        for meme_key in memes_collection:
+            if meme_key not in exclude and recommendation_scores.get(meme_key, NEUTRAL_SCORE) == NEUTRAL_SCORE:
+                recommended_meme_ids.append(meme_key)
+                if len(recommended_meme_ids) >= count:
+                    break
+    if len(recommended_meme_ids) < count:
+        recommended_meme_ids += [
+            meme_key for meme_key, score in heapq.nlargest(
+                count - len(recommended_meme_ids),
+                ((meme_key, score) for meme_key, score in recommendation_scores.items()
+                 if score < NEUTRAL_SCORE and meme_key in memes_collection and meme_key not in exclude),
+                key=itemgetter(1)
+            )
+        ]
     
     logger.info(f"Сгенерированы персонализированные рекомендации для пользователя {user_id}")
     return recommended_meme_ids
@@ -306,8 +838,9 @@ def get_user_preferences_stats(user_id: int) -> Dict:
         Dict: Статистика предпочтений
     """
     user_id_str = str(user_id)
+    user_data = _get_user_data(user_id_str)
     
-    if user_id_str not in user_preferences:
+    if user_data is None:
         return {
             "total_ratings": 0,
             "liked_memes": 0,
@@ -317,7 +850,6 @@ def get_user_preferences_stats(user_id: int) -> Dict:
         }
     
     # Собираем статистику
-    user_data = user_preferences[user_id_str]
     rated_memes = user_data["rated_memes"]
     liked_memes = sum(1 for rating in rated_memes.values() if rating > 0)
     disliked_memes = sum(1 for rating in rated_memes.values() if rating < 0)
@@ -346,15 +878,14 @@ def analyze_user_history(user_id: int, memes_collection: Dict[str, Dict]) -> Dic
         Dict: Результаты анализа
     """
     user_id_str = str(user_id)
+    user_data = _get_user_data(user_id_str)
     
-    if user_id_str not in user_preferences:
+    if user_data is None:
         return {
             "message": "Недостаточно данных для анализа",
             "recommendations": []
         }
     
-    user_data = user_preferences[user_id_str]
-    
     # Если недостаточно оценок, возвращаем базовое сообщение
     if user_data["total_ratings"] < MIN_RATINGS_FOR_RECOMMENDATIONS:
         return {
@@ -380,4 +911,5 @@ def analyze_user_history(user_id: int, memes_collection: Dict[str, Dict]) -> Dic
     }
 
 # Инициализация модуля при импорте
-load_preferences()
\ No newline at end of file
+load_preferences()
+atexit.register(_shutdown_preferences)
\ No newline at end of file
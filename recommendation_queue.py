@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Модуль очередей рекомендаций.
+Для каждого пользователя хранится заранее рассчитанная очередь ID мемов,
+упорядоченная по рейтингу рекомендаций. Оценки пользователя, загрузка новых
+мемов и удаление мемов помечают затронутые очереди устаревшими, а фоновый поток
+пересчитывает очередь при следующем обращении пользователя к ней. Команды бота
+только забирают из очереди следующий мем.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Iterable, Optional, Set
+
+from recommendation_engine import recommend_memes
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Параметры очередей
+RECOMMENDATION_QUEUE_SIZE = 20      # Максимальная длина очереди пользователя
+RECOMMENDATION_REFILL_AT = 5        # Очередь пересчитывается, когда в ней остается столько мемов
+MAX_QUEUED_USERS = 1000             # Сколько пользователей хранят очередь (давно неактивные вытесняются)
+
+class RecommendationQueues:
+    """Очереди рекомендованных мемов по пользователям с фоновым пересчетом"""
+
+    def __init__(self, get_collection: Callable[[], Dict[str, Dict]],
+                 get_excluded: Callable[[int], Set[str]],
+                 queue_size: int = RECOMMENDATION_QUEUE_SIZE,
+                 refill_at: int = RECOMMENDATION_REFILL_AT,
+                 max_users: int = MAX_QUEUED_USERS):
+        """
+        Args:
+            get_collection: Возвращает текущую коллекцию мемов
+            get_excluded: Возвращает ID мемов, которые пользователю уже показаны
+        """
+        self.get_collection = get_collection
+        self.get_excluded = get_excluded
+        self.queue_size = queue_size
+        self.refill_at = refill_at
+        self.max_users = max_users
+        self._queues: "OrderedDict[int, Deque[str]]" = OrderedDict()  # от давно активных к недавним
+        self._pending: "OrderedDict[int, None]" = OrderedDict()       # пользователи, ожидающие пересчета
+        self._dirty: Set[int] = set()                                 # устаревшие очереди, пересчитываются при обращении
+        self._meme_users: Dict[str, Set[int]] = {}                    # обратный индекс: мем -> пользователи с ним в очереди
+        self._condition = threading.Condition()
+        self._worker = None
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_seconds = 0.0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def pop(self, user_id: int) -> Optional[str]:
+        """
+        Забирает следующий рекомендованный мем из очереди пользователя.
+        Мемы, удаленные из коллекции после расчета очереди, пропускаются.
+        Устаревшая очередь отдает мем, но сразу ставится на пересчет.
+        Returns:
+            Optional[str]: ID мема или None, если очередь пуста (тогда пересчет уже запрошен)
+        """
+        collection = self.get_collection()
+        meme_id = None
+        with self._condition:
+            queue = self._queues.get(user_id)
+            if queue is not None:
+                self._queues.move_to_end(user_id)
+                while queue:
+                    candidate = queue.popleft()
+                    self._unindex(user_id, (candidate,))
+                    if candidate in collection:
+                        meme_id = candidate
+                        break
+            if meme_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            if queue is None or len(queue) <= self.refill_at or user_id in self._dirty:
+                self._request(user_id)
+        return meme_id
+
+    def request_refill(self, user_id: int):
+        """Сразу запрашивает пересчет очереди пользователя"""
+        with self._condition:
+            self._request(user_id)
+
+    def mark_dirty(self, user_id: int):
+        """Помечает очередь пользователя устаревшей (например, после новой оценки)"""
+        with self._condition:
+            if user_id in self._queues:
+                self._dirty.add(user_id)
+
+    def refill_all(self):
+        """Помечает устаревшими очереди всех пользователей (например, после загрузки новых мемов)"""
+        with self._condition:
+            self._dirty.update(self._queues)
+
+    def invalidate_meme(self, meme_id: str):
+        """Удаляет мем из очередей, где он есть (например, после жалобы на него)"""
+        with self._condition:
+            for user_id in self._meme_users.pop(meme_id, ()):
+                queue = self._queues.get(user_id)
+                if queue is None:
+                    continue
+                try:
+                    queue.remove(meme_id)
+                    self.invalidations += 1
+                except ValueError:
+                    pass
+                # Очередь стала короче: дополняем ее при следующем обращении
+                self._dirty.add(user_id)
+
+    def stats(self) -> Dict:
+        """Возвращает статистику очередей"""
+        with self._condition:
+            requests_total = self.hits + self.misses
+            return {
+                "users": len(self._queues),
+                "pending": len(self._pending),
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests_total, 3) if requests_total else 0.0,
+                "refills": self.refills,
+                "avg_refill_ms": round(self.refill_seconds * 1000 / self.refills, 1) if self.refills else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions
+            }
+
+    def _index(self, user_id: int, meme_ids: Iterable[str]):
+        """Добавляет мемы очереди пользователя в обратный индекс (вызывается под блокировкой)"""
+        for meme_id in meme_ids:
+            self._meme_users.setdefault(meme_id, set()).add(user_id)
+
+    def _unindex(self, user_id: int, meme_ids: Iterable[str]):
+        """Убирает мемы очереди пользователя из обратного индекса (вызывается под блокировкой)"""
+        for meme_id in meme_ids:
+            users = self._meme_users.get(meme_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._meme_users[meme_id]
+
+    def _request(self, user_id: int):
+        """Ставит пользователя в очередь на пересчет (вызывается под блокировкой)"""
+        self._pending[user_id] = None
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="recommendation-queues", daemon=True)
+            self._worker.start()
+        self._condition.notify()
+
+    def _run(self):
+        """Фоновый поток: пересчитывает очереди пользователей по запросам"""
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                user_id, _ = self._pending.popitem(last=False)
+            try:
+                self._refill(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка при пересчете очереди рекомендаций пользователя {user_id}: {e}")
+
+    def _refill(self, user_id: int):
+        """Рассчитывает очередь пользователя и заменяет ею текущую"""
+        started = time.perf_counter()
+        with self._condition:
+            # Изменения после этого момента снова пометят очередь устаревшей
+            self._dirty.discard(user_id)
+        # Копия коллекции: ее может менять поток обновления мемов
+        collection = dict(self.get_collection())
+        ranked = recommend_memes(user_id, collection, self.queue_size, exclude=self.get_excluded(user_id))
+        # Пока шел расчет, пользователь мог посмотреть еще мемы
+        excluded = self.get_excluded(user_id)
+        queue = deque((meme_id for meme_id in ranked if meme_id not in excluded), maxlen=self.queue_size)
+        elapsed = time.perf_counter() - started
+        with self._condition:
+            old_queue = self._queues.get(user_id)
+            if old_queue is not None:
+                self._unindex(user_id, old_queue)
+            self._queues[user_id] = queue
+            self._queues.move_to_end(user_id)
+            self._index(user_id, queue)
+            while len(self._queues) > self.max_users:
+                evicted_user, evicted_queue = self._queues.popitem(last=False)
+                self._unindex(evicted_user, evicted_queue)
+                self._dirty.discard(evicted_user)
+                self.evictions += 1
+            self.refills += 1
+            self.refill_seconds += elapsed
+        logger.debug(f"Очередь рекомендаций пользователя {user_id} пересчитана за {elapsed * 1000:.1f} мс: {len(queue)} мемов")
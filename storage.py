@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+"""
+Модуль хранилищ данных аналитики и журнала оценок предпочтений.
+
+Бэкенд выбирается переменной окружения STORAGE_BACKEND:
+    json   - снимок JSON и журналы JSON Lines в файлах рядом с ботом (по умолчанию)
+    sqlite - база SQLite в режиме WAL (файл SQLITE_DB_FILE) с индексированными
+             таблицами оценок, просмотров, счетчиков мемов и активности пользователей.
+             Полная история оценок и просмотров хранится в базе, а не в памяти.
+
+Ограничения: в бэкенде json история оценок - только последние
+RATING_HISTORY_LIMIT (1000) оценок из meme_analytics. В обоих бэкендах
+двоичный снимок профилей предпочтений (user_preferences.bin) остается файлом;
+в базу SQLite пишется только журнал оценок после снимка.
+
+Агрегаты аналитики (счетчики мемов, активность пользователей, тренды) по-прежнему
+ведутся в памяти модулем meme_analytics; хранилище отвечает за их сохранение и
+восстановление. События копятся в хранилище и записываются на диск пакетами,
+когда их сбрасывает планировщик meme_analytics. Сохранение идет в три шага: prepare_save под блокировкой данных
+аналитики (быстрый снимок нужных данных), write_save без нее (запись на диск)
+и complete_save снова под блокировкой.
+"""
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()   # "json" или "sqlite"
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "memebot.sqlite3")
+SQLITE_BUSY_TIMEOUT = 5.0           # Ожидание блокировки базы другим соединением (сек)
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ratings (
+    id INTEGER PRIMARY KEY,
+    meme_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    rating INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ratings_meme ON ratings (meme_id, timestamp);
+CREATE INDEX IF NOT EXISTS ratings_user ON ratings (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS ratings_time ON ratings (timestamp);
+
+CREATE TABLE IF NOT EXISTS views (
+    id INTEGER PRIMARY KEY,
+    meme_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS views_meme ON views (meme_id, timestamp);
+CREATE INDEX IF NOT EXISTS views_user ON views (user_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS meme_counters (
+    meme_id TEXT PRIMARY KEY,
+    views INTEGER NOT NULL,
+    likes INTEGER NOT NULL,
+    dislikes INTEGER NOT NULL,
+    last_interaction INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user_activity (
+    user_id INTEGER PRIMARY KEY,
+    ratings INTEGER NOT NULL,
+    sessions INTEGER NOT NULL,
+    last_active INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_activity_last_active ON user_activity (last_active);
+
+CREATE TABLE IF NOT EXISTS trending (
+    day TEXT NOT NULL,
+    meme_id TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    likes INTEGER NOT NULL,
+    dislikes INTEGER NOT NULL,
+    PRIMARY KEY (day, meme_id)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS preference_journal (
+    seq INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    meme_id TEXT NOT NULL,
+    keywords TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+"""
+
+def connect_sqlite(path: str = SQLITE_DB_FILE) -> sqlite3.Connection:
+    """Открывает базу SQLite в режиме WAL и создает таблицы, если их нет"""
+    connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL NORMAL не теряет целостность при сбое, только последние транзакции
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SQLITE_SCHEMA)
+    return connection
+
+def _day_of(timestamp: float) -> str:
+    """Дата события в формате ключей трендов"""
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+def _last_byte(path: str) -> bytes:
+    """Последний байт файла"""
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1)
+
+def _read_json_lines(path: str, description: str) -> Iterator[Dict]:
+    """Читает записи журнала JSON Lines, пропуская недописанные строки"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Недописанная строка после аварийного завершения
+                logger.warning(f"Пропущена поврежденная запись журнала {description}")
+
+# --- Журнал оценок предпочтений ---
+
+class PreferenceJournal(ABC):
+    """Журнал оценок предпочтений, сделанных после последнего снимка профилей"""
+
+    @abstractmethod
+    def append(self, entries: List[Dict]):
+        """Дописывает записи в журнал (надежно, до возврата)"""
+
+    @abstractmethod
+    def read(self) -> Iterator[Dict]:
+        """Записи журнала в порядке записи"""
+
+    @abstractmethod
+    def clear(self):
+        """Очищает журнал после сохранения снимка"""
+
+    @abstractmethod
+    def size(self) -> int:
+        """Примерный объем журнала в байтах"""
+
+class FilePreferenceJournal(PreferenceJournal):
+    """Журнал в файле JSON Lines"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def append(self, entries: List[Dict]):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            # Недописанная строка после аварийного завершения не должна склеиться с новой записью
+            if f.tell() and _last_byte(self.path) != b"\n":
+                f.write("\n")
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> Iterator[Dict]:
+        if os.path.exists(self.path):
+            yield from _read_json_lines(self.path, "предпочтений")
+
+    def clear(self):
+        open(self.path, 'w', encoding='utf-8').close()
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        except OSError:
+            return 0
+
+class SQLitePreferenceJournal(PreferenceJournal):
+    """Журнал в таблице preference_journal базы SQLite"""
+
+    def __init__(self, path: str = SQLITE_DB_FILE):
+        self._connection = connect_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(user_id) + LENGTH(meme_id) + LENGTH(keywords) + 32), 0) "
+                "FROM preference_journal"
+            ).fetchone()
+        self._bytes = row[0]
+
+    def append(self, entries: List[Dict]):
+        rows = [
+            (entry["seq"], entry["user_id"], entry["meme_id"], json.dumps(entry["keywords"], ensure_ascii=False),
+             entry["rating"], entry["timestamp"])
+            for entry in entries
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO preference_journal (seq, user_id, meme_id, keywords, rating, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+        self._bytes += sum(len(row[1]) + len(row[2]) + len(row[3]) + 32 for row in rows)
+
+    def read(self) -> Iterator[Dict]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT seq, user_id, meme_id, keywords, rating, timestamp FROM preference_journal ORDER BY seq"
+            ).fetchall()
+        for seq, user_id, meme_id, keywords, rating, timestamp in rows:
+            yield {"seq": seq, "user_id": user_id, "meme_id": meme_id, "keywords": json.loads(keywords),
+                   "rating": rating, "timestamp": timestamp}
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM preference_journal")
+        self._bytes = 0
+
+    def size(self) -> int:
+        return self._bytes
+
+def create_preference_journal(journal_file: str) -> PreferenceJournal:
+    """Создает журнал оценок предпочтений выбранного бэкенда"""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLitePreferenceJournal(SQLITE_DB_FILE)
+    return FilePreferenceJournal(journal_file)
+
+# --- Данные аналитики ---
+
+def _copy_state(state: Dict) -> Dict:
+    """
+    Структурная копия состояния аналитики для записи без блокировки: словари счетчиков
+    копируются, записи истории оценок не меняются после добавления и не копируются
+    """
+    return {
+        "popular_memes": {meme_id: dict(data) for meme_id, data in state["popular_memes"].items()},
+        "trending_memes": {
+            day: {meme_id: dict(data) for meme_id, data in memes.items()}
+            for day, memes in state["trending_memes"].items()
+        },
+        "rating_history": list(state["rating_history"]),
+        "user_activity": {user_id: dict(data) for user_id, data in state["user_activity"].items()},
+        "session_stats": dict(state["session_stats"])
+    }
+
+class AnalyticsStorage(ABC):
+    """
+    Хранилище событий и агрегатов аналитики.
+    Состояние аналитики - словарь с ключами popular_memes, trending_memes,
+    rating_history, user_activity, session_stats (как в meme_analytics).
+    """
+    # Хранит ли хранилище полную историю оценок (иначе только последние оценки в памяти)
+    keeps_full_history = False
+
+    @abstractmethod
+    def load(self, history_limit: int) -> Tuple[Optional[Dict], List[Dict]]:
+        """
+        Returns:
+            Tuple[Optional[Dict], List[Dict]]: сохраненное состояние (None, если его нет)
+            и события, которые нужно применить к нему
+        """
+
+    @abstractmethod
+    def append(self, event: Dict):
+        """Добавляет событие в очередь записи за O(1) (вызывается под блокировкой данных аналитики)"""
+
+    @abstractmethod
+    def has_pending(self) -> bool:
+        """Есть ли события, которые еще не записаны на диск"""
+
+    def flush(self):
+        """Записывает накопленные события, если для этого не нужны данные аналитики"""
+
+    @abstractmethod
+    def should_save(self) -> bool:
+        """Нужно ли сохранение (проверяется планировщиком после flush)"""
+
+    @abstractmethod
+    def prepare_save(self, state: Dict):
+        """Готовит данные для сохранения (под блокировкой данных аналитики)"""
+
+    @abstractmethod
+    def write_save(self, prepared):
+        """Записывает подготовленные данные (без блокировки данных аналитики)"""
+
+    def complete_save(self, prepared):
+        """Завершает сохранение (под блокировкой данных аналитики)"""
+
+    def import_state(self, state: Dict):
+        """Сохраняет состояние, перенесенное из другого хранилища"""
+
+    def rating_history(self, user_id: Optional[int] = None, meme_id: Optional[str] = None,
+                       since: Optional[int] = None, limit: Optional[int] = None) -> List[Dict]:
+        """
+        Оценки из полной истории. Хранилища без полной истории (keeps_full_history=False)
+        ее не хранят: последние оценки ведет в памяти meme_analytics
+        """
+        return []
+
+    def close(self):
+        """Закрывает хранилище"""
+
+class JsonAnalyticsStorage(AnalyticsStorage):
+    """
+    Снимок всех данных аналитики в JSON с номером последнего учтенного события
+    и журнал событий после снимка (JSON Lines). Накопленные события дописываются
+    в журнал одной записью при flush; снимок сохраняется, когда журнал вырос
+    или давно не сохранялся, после чего учтенная часть журнала удаляется.
+    """
+
+    def __init__(self, snapshot_file: str, log_file: str, compact_interval: float, compact_log_bytes: int):
+        self.snapshot_file = snapshot_file
+        self.log_file = log_file
+        self.compact_interval = compact_interval
+        self.compact_log_bytes = compact_log_bytes
+        self._log = None            # Открытый на дозапись журнал событий
+        self._lock = threading.Lock()   # Журнал и очередь строк
+        self._pending: List[bytes] = []     # Строки событий, еще не записанные в журнал
+        self._seq = 0               # Номер последнего события
+        self._snapshot_seq = 0      # Номер последнего события, учтенного в снимке
+        self._last_save = time.time()
+
+    def load(self, history_limit: int) -> Tuple[Optional[Dict], List[Dict]]:
+        self.close()
+        self._pending = []
+        state = None
+        self._snapshot_seq = 0
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self._snapshot_seq = state.pop("log_seq")
+        self._seq = self._snapshot_seq
+        events = []
+        if os.path.exists(self.log_file):
+            for event in _read_json_lines(self.log_file, "аналитики"):
+                if event["seq"] > self._snapshot_seq:
+                    events.append(event)
+                    self._seq = max(self._seq, event["seq"])
+        return state, events
+
+    def append(self, event: Dict):
+        self._seq += 1
+        event["seq"] = self._seq
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8')
+        with self._lock:
+            self._pending.append(line)
+
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Дописывает накопленные строки в журнал одной записью (вызывается под self._lock)"""
+        if not self._pending:
+            return
+        if self._log is None:
+            self._log = open(self.log_file, 'ab')
+            # Недописанная строка после аварийного завершения не должна склеиться с новым событием
+            if self._log.tell() and _last_byte(self.log_file) != b"\n":
+                self._log.write(b"\n")
+        self._log.write(b"".join(self._pending))
+        self._log.flush()
+        self._pending = []
+
+    def should_save(self) -> bool:
+        if self._log is not None:
+            log_size = self._log.tell()
+        else:
+            try:
+                log_size = os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0
+            except OSError:
+                log_size = 0
+        return bool(log_size) and (log_size >= self.compact_log_bytes or
+                                   time.time() - self._last_save >= self.compact_interval)
+
+    def prepare_save(self, state: Dict):
+        # Под блокировкой данных аналитики только копия; сериализация - в write_save
+        snapshot = dict(_copy_state(state), log_seq=self._seq)
+        with self._lock:
+            # Накопленные события учтены в снимке, но пишутся в журнал до места отсечения,
+            # чтобы не потеряться при сбое до записи снимка
+            self._write_pending()
+            # События, записанные после этого места журнала, в снимок не попадут
+            log_offset = self._log.tell() if self._log else 0
+        return self._seq, snapshot, log_offset
+
+    def write_save(self, prepared):
+        seq, snapshot, _ = prepared
+        data = json.dumps(snapshot, ensure_ascii=False)
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        logger.debug(f"Снимок аналитики сохранен ({len(data)} байт, событие {seq})")
+
+    def complete_save(self, prepared):
+        seq, _, log_offset = prepared
+        self._snapshot_seq = seq
+        with self._lock:
+            self._truncate_log(log_offset)
+        self._last_save = time.time()
+
+    def _truncate_log(self, offset: int):
+        """Удаляет из журнала события до смещения offset (вызывается под self._lock)"""
+        tail = b""
+        if self._log is not None:
+            self._log.flush()
+            if self._log.tell() > offset:
+                with open(self.log_file, 'rb') as f:
+                    f.seek(offset)
+                    tail = f.read()
+            self._close_log()
+        tmp_file = f"{self.log_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(tail)
+        os.replace(tmp_file, self.log_file)
+
+    def close(self):
+        with self._lock:
+            try:
+                self._write_pending()
+            except OSError as e:
+                logger.error(f"Ошибка при записи журнала аналитики: {e}")
+            self._close_log()
+
+    def _close_log(self):
+        """Закрывает журнал (вызывается под self._lock)"""
+        if self._log is not None:
+            try:
+                self._log.close()
+            except OSError as e:
+                logger.error(f"Ошибка при закрытии журнала аналитики: {e}")
+            self._log = None
+
+class SQLiteAnalyticsStorage(AnalyticsStorage):
+    """
+    Данные аналитики в базе SQLite: каждое событие - одна строка в таблице ratings
+    или views, счетчики мемов, активность пользователей и тренды хранятся в своих
+    таблицах. События копятся в памяти и записываются пакетом при сохранении в одной
+    транзакции вместе с изменившимися счетчиками, поэтому после сбоя база согласована.
+    """
+    keeps_full_history = True
+
+    def __init__(self, path: str = SQLITE_DB_FILE):
+        self.path = path
+        self._connection = connect_sqlite(path)
+        self._lock = threading.Lock()       # Соединение и очередь событий
+        self._pending: List[Dict] = []
+
+    def load(self, history_limit: int) -> Tuple[Optional[Dict], List[Dict]]:
+        with self._lock:
+            execute = self._connection.execute
+            session_stats = execute("SELECT value FROM meta WHERE key = 'session_stats'").fetchone()
+            if session_stats is None:
+                return None, []
+            popular = {
+                meme_id: {"views": views, "likes": likes, "dislikes": dislikes, "last_interaction": last_interaction}
+                for meme_id, views, likes, dislikes, last_interaction in execute(
+                    "SELECT meme_id, views, likes, dislikes, last_interaction FROM meme_counters")
+            }
+            activity = {
+                user_id: {"ratings": ratings, "last_active": last_active, "sessions": sessions}
+                for user_id, ratings, sessions, last_active in execute(
+                    "SELECT user_id, ratings, sessions, last_active FROM user_activity")
+            }
+            # Тренды хранятся за неделю, старые дни в памяти не нужны
+            oldest_day = _day_of(time.time() - 8 * 86400)
+            trending = {}
+            for day, meme_id, score, likes, dislikes in execute(
+                    "SELECT day, meme_id, score, likes, dislikes FROM trending WHERE day >= ?", (oldest_day,)):
+                trending.setdefault(day, {})[meme_id] = {"score": score, "likes": likes, "dislikes": dislikes}
+            history = self._query_history("", (), history_limit)
+        return {
+            "popular_memes": popular,
+            "trending_memes": trending,
+            "rating_history": history,
+            "user_activity": activity,
+            "session_stats": json.loads(session_stats[0])
+        }, []
+
+    def append(self, event: Dict):
+        with self._lock:
+            self._pending.append(event)
+
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def should_save(self) -> bool:
+        # Событиям для записи нужны счетчики из памяти, поэтому их записывает сохранение
+        return bool(self._pending)
+
+    def prepare_save(self, state: Dict):
+        with self._lock:
+            events, self._pending = self._pending, []
+        # Строки счетчиков только для мемов, пользователей и дней, затронутых событиями
+        popular = state["popular_memes"]
+        activity = state["user_activity"]
+        trending = state["trending_memes"]
+        meme_rows = {}
+        user_rows = {}
+        trending_rows = {}
+        for event in events:
+            meme_id = event.get("meme_id")
+            if meme_id in popular:
+                data = popular[meme_id]
+                meme_rows[meme_id] = (meme_id, data["views"], data["likes"], data["dislikes"], data["last_interaction"])
+            data = activity.get(event["user_id"])
+            if data is not None:
+                user_rows[event["user_id"]] = (event["user_id"], data["ratings"], data["sessions"], data["last_active"])
+            if event["type"] == "rating":
+                day = _day_of(event["timestamp"])
+                data = trending.get(day, {}).get(meme_id)
+                if data is not None:
+                    trending_rows[(day, meme_id)] = (day, meme_id, data["score"], data["likes"], data["dislikes"])
+        return events, meme_rows, user_rows, trending_rows, json.dumps(state["session_stats"])
+
+    def write_save(self, prepared):
+        events, meme_rows, user_rows, trending_rows, session_stats = prepared
+        ratings = [(e["meme_id"], e["user_id"], e["rating"], e["timestamp"]) for e in events if e["type"] == "rating"]
+        views = [(e["meme_id"], e["user_id"], e["timestamp"]) for e in events if e["type"] == "view"]
+        try:
+            with self._lock, self._connection:
+                self._write_rows(ratings, views, meme_rows.values(), user_rows.values(), trending_rows.values(),
+                                 session_stats)
+        except Exception:
+            # Возвращаем события в очередь; счетчики будут взяты заново при следующей записи
+            with self._lock:
+                self._pending = events + self._pending
+            raise
+        logger.debug(f"В базу аналитики записано {len(events)} событий")
+
+    def import_state(self, state: Dict):
+        """Переносит состояние (например, из снимка JSON) в базу"""
+        meme_rows = [
+            (meme_id, data.get("views", 0), data.get("likes", 0), data.get("dislikes", 0), data.get("last_interaction", 0))
+            for meme_id, data in state["popular_memes"].items()
+        ]
+        user_rows = [
+            (int(user_id), data.get("ratings", 0), data.get("sessions", 0), data.get("last_active", 0))
+            for user_id, data in state["user_activity"].items()
+        ]
+        trending_rows = [
+            (day, meme_id, data.get("score", 0), data.get("likes", 0), data.get("dislikes", 0))
+            for day, memes in state["trending_memes"].items() for meme_id, data in memes.items()
+        ]
+        ratings = [
+            (entry["meme_id"], entry["user_id"], entry["rating"], entry["timestamp"])
+            for entry in state["rating_history"]
+        ]
+        with self._lock, self._connection:
+            self._write_rows(ratings, [], meme_rows, user_rows, trending_rows, json.dumps(state["session_stats"]))
+        logger.info(f"В базу аналитики перенесено {len(meme_rows)} мемов, {len(user_rows)} пользователей, "
+                    f"{len(ratings)} оценок")
+
+    def _write_rows(self, ratings, views, meme_rows, user_rows, trending_rows, session_stats: str):
+        """Записывает строки всех таблиц (вызывается внутри транзакции)"""
+        executemany = self._connection.executemany
+        executemany("INSERT INTO ratings (meme_id, user_id, rating, timestamp) VALUES (?, ?, ?, ?)", ratings)
+        executemany("INSERT INTO views (meme_id, user_id, timestamp) VALUES (?, ?, ?)", views)
+        executemany("INSERT OR REPLACE INTO meme_counters (meme_id, views, likes, dislikes, last_interaction) "
+                    "VALUES (?, ?, ?, ?, ?)", meme_rows)
+        executemany("INSERT OR REPLACE INTO user_activity (user_id, ratings, sessions, last_active) "
+                    "VALUES (?, ?, ?, ?)", user_rows)
+        executemany("INSERT OR REPLACE INTO trending (day, meme_id, score, likes, dislikes) VALUES (?, ?, ?, ?, ?)",
+                    trending_rows)
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('session_stats', ?)",
+                                 (session_stats,))
+
+    def rating_history(self, user_id: Optional[int] = None, meme_id: Optional[str] = None,
+                       since: Optional[int] = None, limit: Optional[int] = None) -> List[Dict]:
+        conditions = []
+        params = []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if meme_id is not None:
+            conditions.append("meme_id = ?")
+            params.append(meme_id)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            return self._query_history(where, tuple(params), limit)
+
+    def _query_history(self, where: str, params: Tuple, limit: Optional[int]) -> List[Dict]:
+        """
+        Последние оценки по условию в порядке времени (вызывается под блокировкой).
+        Порядок (timestamp, id) совпадает с порядком индексов, поэтому сортировки нет
+        """
+        query = f"SELECT meme_id, user_id, rating, timestamp FROM ratings {where} ORDER BY timestamp DESC, id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params = params + (limit,)
+        rows = self._connection.execute(query, params).fetchall()
+        return [
+            {"meme_id": meme_id, "user_id": user_id, "rating": rating, "timestamp": timestamp}
+            for meme_id, user_id, rating, timestamp in reversed(rows)
+        ]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
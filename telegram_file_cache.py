@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Модуль кэширования file_id изображений, загруженных в Telegram.
+После первой отправки мема Telegram возвращает file_id фотографии, который
+можно использовать повторно: мем отправляется без скачивания из VK и без
+повторной загрузки в Telegram.
+"""
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Файл для сохранения соответствия meme_id -> file_id
+FILE_IDS_CACHE_FILE = "telegram_file_ids.json"
+
+# Словарь meme_id -> file_id загруженной в Telegram фотографии
+telegram_file_ids: Dict[str, str] = {}
+
+# Флаг несохраненных изменений
+_file_ids_dirty = False
+
+def load_file_ids():
+    """Загружает сохраненные file_id из файла"""
+    global telegram_file_ids
+    try:
+        if os.path.exists(FILE_IDS_CACHE_FILE):
+            with open(FILE_IDS_CACHE_FILE, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+                if isinstance(loaded, dict):
+                    telegram_file_ids = loaded
+                    logger.info(f"Загружено {len(telegram_file_ids)} file_id из кэша Telegram")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке кэша file_id: {e}")
+
+def save_file_ids(force: bool = False):
+    """
+    Сохраняет file_id в файл, если есть несохраненные изменения.
+    Запись атомарная: сначала во временный файл, затем замена.
+    """
+    global _file_ids_dirty
+    if not _file_ids_dirty and not force:
+        return
+    try:
+        snapshot = dict(telegram_file_ids)
+        tmp_file = f"{FILE_IDS_CACHE_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_file, FILE_IDS_CACHE_FILE)
+        _file_ids_dirty = False
+        logger.info(f"Сохранено {len(snapshot)} file_id в кэш Telegram")
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении кэша file_id: {e}")
+
+def get_file_id(meme_id: str) -> Optional[str]:
+    """Возвращает сохраненный file_id мема или None"""
+    return telegram_file_ids.get(meme_id)
+
+def remember_file_id(meme_id: str, message) -> Optional[str]:
+    """
+    Запоминает file_id из сообщения, которое вернул send_photo.
+
+    Args:
+        meme_id (str): Идентификатор мема
+        message (telegram.Message): Отправленное сообщение с фотографией
+
+    Returns:
+        Optional[str]: Сохраненный file_id или None, если фото в сообщении нет
+    """
+    global _file_ids_dirty
+    if message is None or not message.photo:
+        return None
+    # Последний элемент - фотография в максимальном размере
+    file_id = message.photo[-1].file_id
+    if telegram_file_ids.get(meme_id) != file_id:
+        telegram_file_ids[meme_id] = file_id
+        _file_ids_dirty = True
+    return file_id
+
+def forget_file_id(meme_id: str):
+    """Удаляет file_id мема (устаревший или мем удален из коллекции)"""
+    global _file_ids_dirty
+    if telegram_file_ids.pop(meme_id, None) is not None:
+        _file_ids_dirty = True
+
+# Инициализация модуля при импорте
+load_file_ids()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Тесты загрузки мемов из VK на заглушке API из benchmarks/common.py:
+упаковка wall.get в execute, частичные ошибки и инкрементальная загрузка по курсорам.
+Запуск: python -m pytest -q tests
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VK_TOKEN", "test")
+
+import vk_api  # noqa: E402
+
+import vk_utils  # noqa: E402
+from benchmarks.common import FakeVkApi, FakeVkSession, make_vk_posts  # noqa: E402
+
+class FailingVkApi(FakeVkApi):
+    """Заглушка VK API с ошибками: false для отдельных групп и ApiError для всего execute"""
+
+    def __init__(self, posts_by_group, failed_groups=(), failed_requests=()):
+        super().__init__(posts_by_group)
+        self.failed_groups = set(failed_groups)
+        self.failed_requests = set(failed_requests)
+
+    def execute(self, code: str):
+        response = super().execute(code)
+        if self.execute_calls in self.failed_requests:
+            raise vk_api.exceptions.ApiError(None, "execute", {}, {}, {"error_code": 10, "error_msg": "Internal error"})
+        calls = [json.loads(call) for call in re.findall(r"API\.wall\.get\((\{.*?\})\)", code)]
+        return [
+            False if -call["owner_id"] in self.failed_groups else result
+            for call, result in zip(calls, response)
+        ]
+
+class FailingVkSession(FakeVkSession):
+    def __init__(self, api: FakeVkApi):
+        self.api = api
+
+class VkFetchTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="memebot_test_")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        self.original_state = (vk_utils.VK_SYNC_STATE_FILE, vk_utils.group_cursors, vk_utils.vk_rate_limiter)
+        vk_utils.VK_SYNC_STATE_FILE = os.path.join(self.workdir, "vk_sync_state.json")
+        vk_utils.group_cursors = {}
+        vk_utils.vk_rate_limiter = vk_utils.TokenBucket(rate=1e9, capacity=1e9)
+
+    def tearDown(self):
+        vk_utils.VK_SYNC_STATE_FILE, vk_utils.group_cursors, vk_utils.vk_rate_limiter = self.original_state
+
+    @staticmethod
+    def make_groups(groups, posts, start_post_id=0):
+        return {
+            group_id: make_vk_posts(posts, group_id=group_id, seed=group_id,
+                                    duplicate_ratio=0, start_post_id=start_post_id)
+            for group_id in range(1, groups + 1)
+        }
+
+    def test_execute_packs_25_calls_per_request(self):
+        session = FakeVkSession(self.make_groups(30, 10))
+        memes = list(vk_utils.iter_vk_memes_batched(list(range(1, 31)), 10, session))
+        self.assertEqual(len(memes), 300)
+        # 30 групп по одной странице: 25 вызовов в первом execute и 5 во втором
+        self.assertEqual(session.api.execute_calls, 2)
+        self.assertEqual(session.api.wall.calls, 30)
+
+    def test_batched_yields_after_each_execute_response(self):
+        session = FakeVkSession(self.make_groups(30, 10))
+        source = vk_utils.iter_vk_memes_batched(list(range(1, 31)), 10, session)
+        next(source)
+        self.assertEqual(session.api.execute_calls, 1)
+        source.close()
+
+    def test_batched_paginates_up_to_count(self):
+        session = FakeVkSession(self.make_groups(2, 250))
+        memes = list(vk_utils.iter_vk_memes_batched([1, 2], 220, session))
+        self.assertEqual(len(memes), 440)
+        # Страницы по 100, 100 и 20 постов для обеих групп в одном execute
+        self.assertEqual(session.api.execute_calls, 3)
+
+    def test_partial_errors_skip_only_failed_groups(self):
+        api = FailingVkApi(self.make_groups(30, 10), failed_groups=[3], failed_requests=[2])
+        memes = list(vk_utils.iter_vk_memes_batched(list(range(1, 31)), 10, FailingVkSession(api)))
+        groups = {group_id for group_id, _ in memes}
+        # Группа 3 вернула false внутри execute, второй execute (группы 26-30) упал с ApiError
+        self.assertEqual(groups, set(range(1, 26)) - {3})
+        self.assertEqual(len(memes), 240)
+
+    def test_incremental_stops_at_cursor(self):
+        session = FakeVkSession(self.make_groups(1, 300))
+        vk_utils.commit_group_cursors({1: {"last_post_id": 290, "last_date": 0}})
+        updates = {}
+        memes = list(vk_utils.iter_vk_memes_batched([1], 100, session, incremental=True, cursor_updates=updates))
+        self.assertEqual([meme["post_id"] for _, meme in memes], list(range(300, 290, -1)))
+        self.assertEqual(session.api.execute_calls, 1)
+        self.assertEqual(updates, {1: {"last_post_id": 300, "last_date": 1700000300, "resume_offset": 0}})
+
+    def test_cursor_is_committed_only_by_caller(self):
+        session = FakeVkSession(self.make_groups(1, 50))
+        updates = {}
+        list(vk_utils.iter_vk_memes_batched([1], 100, session, incremental=True, cursor_updates=updates))
+        self.assertIsNone(vk_utils.get_group_cursor(1))
+        vk_utils.commit_group_cursors(updates)
+        self.assertEqual(vk_utils.get_group_cursor(1), 50)
+
+    def test_cursor_does_not_skip_posts_beyond_count(self):
+        session = FakeVkSession(self.make_groups(1, 300))
+        vk_utils.commit_group_cursors({1: {"last_post_id": 100, "last_date": 0}})
+        seen = []
+        for _ in range(10):
+            updates = {}
+            memes = list(vk_utils.iter_vk_memes_batched([1], 20, session, incremental=True, cursor_updates=updates))
+            seen.extend(meme["post_id"] for _, meme in memes)
+            vk_utils.commit_group_cursors(updates)
+        # Лимит count не теряет посты 101-300: они выдаются по 20, от старых к новым
+        self.assertEqual(sorted(seen), list(range(101, 301)))
+        self.assertEqual(vk_utils.get_group_cursor(1), 300)
+
+    def refresh_until_done(self, session, count, refreshes):
+        seen = []
+        for _ in range(refreshes):
+            updates = {}
+            memes = list(vk_utils.iter_vk_memes_batched([1], count, session, incremental=True, cursor_updates=updates))
+            seen.extend(meme["post_id"] for _, meme in memes)
+            vk_utils.commit_group_cursors(updates)
+        return seen
+
+    def test_cursor_does_not_skip_posts_beyond_page_window(self):
+        # 990 новых постов - больше, чем окно из WALL_MAX_PAGES страниц по 100
+        session = FakeVkSession(self.make_groups(1, 1000))
+        vk_utils.commit_group_cursors({1: {"last_post_id": 10, "last_date": 0}})
+        seen = self.refresh_until_done(session, 100, 20)
+        self.assertEqual(sorted(seen), list(range(11, 1001)))
+        self.assertEqual(vk_utils.get_group_cursor(1), 1000)
+
+    def test_cursor_resumes_when_posts_are_published_between_refreshes(self):
+        posts = self.make_groups(1, 1000)
+        session = FakeVkSession(posts)
+        vk_utils.commit_group_cursors({1: {"last_post_id": 10, "last_date": 0}})
+        seen = self.refresh_until_done(session, 100, 3)
+        # Между обновлениями вышло 150 новых постов: смещения старых постов выросли
+        posts[1][:0] = make_vk_posts(150, group_id=1, seed=99, duplicate_ratio=0, start_post_id=1000)
+        seen += self.refresh_until_done(session, 100, 20)
+        self.assertEqual(sorted(seen), list(range(11, 1151)))
+
+    def test_non_incremental_does_not_touch_cursors(self):
+        session = FakeVkSession(self.make_groups(2, 10))
+        updates = {}
+        list(vk_utils.iter_vk_memes_batched([1, 2], 10, session, cursor_updates=updates))
+        vk_utils.fetch_vk_memes(1, 10, session, cursor_updates=updates)
+        self.assertEqual(updates, {})
+        self.assertEqual(vk_utils.group_cursors, {})
+
+    def test_fetch_vk_memes_cursor_matches_batched(self):
+        posts = self.make_groups(1, 300)
+        for count in (20, 100, 500):
+            vk_utils.group_cursors = {1: {"last_post_id": 150, "last_date": 0}}
+            single, batched = {}, {}
+            memes = vk_utils.fetch_vk_memes(1, count, FakeVkSession(posts), incremental=True,
+                                            cursor_updates=single)
+            batch_memes = list(vk_utils.iter_vk_memes_batched([1], count, FakeVkSession(posts), incremental=True,
+                                                              cursor_updates=batched))
+            self.assertEqual(memes, [meme for _, meme in batch_memes])
+            self.assertEqual(single, batched)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,141 @@
+import json
 import logging
+import os
+import queue
+import threading
 import vk_api
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterator, Optional, Tuple
 import time
-import random
 
 logger = logging.getLogger(__name__)
 
+# Лимит VK API: не более 3 запросов в секунду на один токен
+VK_REQUESTS_PER_SECOND = 3
+INGEST_WORKERS = 4         # Количество групп, загружаемых параллельно
+INGEST_QUEUE_SIZE = 200    # Размер очереди мемов-кандидатов
+VK_EXECUTE_MAX_CALLS = 25  # Максимум вызовов API внутри одного execute
+WALL_GET_MAX_COUNT = 100   # Максимум постов за один вызов wall.get
+WALL_MAX_PAGES = 5         # Сколько страниц стены одной группы листается за загрузку
+WALL_RESUME_MARGIN = 100   # Запас окна догрузки на посты, опубликованные между обновлениями
+
+class TokenBucket:
+    """Потокобезопасный ограничитель частоты запросов по алгоритму token bucket"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        """Блокирует поток, пока в ведре не наберется нужное количество токенов"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Общий ограничитель для всех запросов к VK API из процесса
+vk_rate_limiter = TokenBucket(VK_REQUESTS_PER_SECOND)
+
+# Файл с курсорами синхронизации: последний просмотренный пост каждой группы
+VK_SYNC_STATE_FILE = "vk_sync_state.json"
+
+# Курсоры по группам: {group_id: {"last_post_id": int, "last_date": int}}
+group_cursors: Dict[int, Dict[str, int]] = {}
+_cursors_lock = threading.Lock()
+_cursors_dirty = False
+
+def load_sync_state():
+    """Загружает курсоры синхронизации групп из файла"""
+    global group_cursors
+    try:
+        if os.path.exists(VK_SYNC_STATE_FILE):
+            with open(VK_SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            with _cursors_lock:
+                group_cursors = {int(group_id): cursor for group_id, cursor in loaded.items()}
+            logger.info(f"Загружены курсоры синхронизации для {len(group_cursors)} групп")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке курсоров синхронизации VK: {e}")
+
+def save_sync_state():
+    """Атомарно сохраняет курсоры синхронизации групп, если они изменились"""
+    global _cursors_dirty
+    with _cursors_lock:
+        if not _cursors_dirty:
+            return
+        snapshot = {str(group_id): dict(cursor) for group_id, cursor in group_cursors.items()}
+        _cursors_dirty = False
+    try:
+        tmp_file = f"{VK_SYNC_STATE_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_file, VK_SYNC_STATE_FILE)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении курсоров синхронизации VK: {e}")
+
+def get_group_cursor(group_id: int) -> Optional[int]:
+    """Возвращает ID последнего просмотренного поста группы или None"""
+    with _cursors_lock:
+        cursor = group_cursors.get(group_id)
+        return cursor["last_post_id"] if cursor else None
+
+def _get_cursor_state(group_id: int) -> Optional[Dict[str, int]]:
+    """Копия курсора группы (last_post_id, last_date и resume_offset) или None"""
+    with _cursors_lock:
+        cursor = group_cursors.get(group_id)
+        return dict(cursor) if cursor else None
+
+def commit_group_cursors(cursor_updates: Dict[int, Dict[str, int]]):
+    """
+    Фиксирует курсоры групп, полученные при инкрементальной загрузке.
+    Вызывается после того, как загруженные мемы обработаны; курсор не сдвигается назад
+    (при том же посте обновляется только позиция догрузки resume_offset).
+    """
+    global _cursors_dirty
+    with _cursors_lock:
+        for group_id, update in cursor_updates.items():
+            cursor = group_cursors.get(group_id)
+            if cursor is None or update["last_post_id"] >= cursor["last_post_id"]:
+                group_cursors[group_id] = dict(update)
+                _cursors_dirty = True
+
+def _newest_post(items: List[Dict], newest: Optional[Dict] = None) -> Optional[Dict]:
+    """Самый новый незакреплённый пост среди items и newest"""
+    for item in items:
+        if item.get("is_pinned"):
+            continue
+        if newest is None or item.get("id", 0) > newest.get("id", 0):
+            newest = item
+    return newest
+
+def _split_new_items(items: List[Dict], since_post_id: Optional[int]) -> Tuple[List[Dict], bool]:
+    """
+    Отделяет новые посты от уже просмотренных.
+    Посты на стене идут от новых к старым (кроме закреплённого), поэтому
+    первый старый незакреплённый пост означает, что дальше листать не нужно.
+
+    Returns:
+        Tuple[List[Dict], bool]: Новые посты и признак достижения уже просмотренных
+    """
+    if since_post_id is None:
+        return items, False
+    new_items = []
+    for item in items:
+        if item.get("id", 0) > since_post_id:
+            new_items.append(item)
+        elif not item.get("is_pinned"):
+            return new_items, True
+    return new_items, False
+
 # Список групп VK (ID публичных групп с мемами)
 VK_GROUP_IDS = [
     29534144,  # Оставляем старую группу
@@ -21,56 +151,300 @@ VK_GROUP_IDS = [
 
 ]
 
-def fetch_vk_memes(group_id: int, count: int, vk_session: vk_api.VkApi) -> List[Dict]:
+def _extract_memes(items: List[Dict], limit: int) -> List[Dict]:
+    """Извлекает мемы (картинка + текст) из постов стены, не больше limit штук"""
+    memes = []
+    for item in items:
+        if "attachments" in item:
+            for attachment in item["attachments"]:
+                if attachment["type"] == "photo":
+                    photo = attachment["photo"]
+                    sizes = photo.get("sizes", [])
+                    if sizes:
+                        image_url = max(sizes, key=lambda x: x.get("width", 0)).get("url", "")
+                        text = item.get("text", "").strip()
+                        if image_url and text:
+                            memes.append({
+                                "image_url": image_url,
+                                "text": text,
+                                "tags": [],
+                                # Идентификаторы VK для стабильного ID мема (см. meme_data.make_meme_id)
+                                "owner_id": item.get("owner_id"),
+                                "post_id": item.get("id"),
+                                "photo_id": photo.get("id")
+                            })
+                            if len(memes) >= limit:
+                                break
+        if len(memes) >= limit:
+            break
+    return memes
+
+class _GroupScan:
+    """
+    Состояние постраничной загрузки стены одной группы.
+    Без курсора мемы берутся с самых новых постов. С курсором листается окно
+    из WALL_MAX_PAGES страниц, которое заканчивается сразу за постом курсора
+    (его примерное смещение на стене хранится в resume_offset), и возвращаются
+    count самых старых из новых мемов: курсор встает на самый новый возвращенный
+    пост, поэтому выданные посты всегда идут подряд от курсора и ничего не теряется.
+    Если окно не дошло до курсора (новых постов больше, чем помещается в окно),
+    мемы не возвращаются, а resume_offset сдвигается глубже, и следующее
+    обновление продолжает листать с того места, где остановилось это.
+    """
+
+    def __init__(self, group_id: int, count: int, cursor: Optional[Dict[str, int]]):
+        self.group_id = group_id
+        self.count = count
+        self.cursor = cursor
+        self.since_post_id = cursor["last_post_id"] if cursor else None
+        self.offset = 0
+        if cursor and cursor.get("resume_offset"):
+            self.offset = max(0, cursor["resume_offset"] - (self._window() - WALL_RESUME_MARGIN))
+        self.pages = 0
+        self.found = 0
+        self.finished = False           # Пролистаны все новые посты (до просмотренных или до конца стены)
+        self.truncated = False          # Часть новых мемов не вошла в результат из-за лимита count
+        self.newest_scanned = None      # Самый новый пролистанный пост
+        self.newest_returned = None     # Самый новый пост, мемы из которого вошли в результат
+        self._new_items = []            # Новые посты, накопленные до достижения курсора
+        self._post_offsets = {}         # Смещения на стене пролистанных постов
+
+    @staticmethod
+    def _window() -> int:
+        return WALL_MAX_PAGES * WALL_GET_MAX_COUNT
+
+    @property
+    def buffering(self) -> bool:
+        return self.since_post_id is not None
+
+    def page_size(self) -> int:
+        if self.buffering:
+            return WALL_GET_MAX_COUNT
+        return min(WALL_GET_MAX_COUNT, self.count - self.found)
+
+    def consume(self, items: List[Dict], page_size: int) -> List[Dict]:
+        """Обрабатывает страницу стены и возвращает мемы, готовые к выдаче"""
+        self.pages += 1
+        if not items:
+            logger.info(f"Больше постов не найдено в группе {self.group_id} на offset={self.offset}")
+            self.finished = True
+        else:
+            for index, item in enumerate(items):
+                self._post_offsets[item.get("id")] = self.offset + index
+            self.newest_scanned = _newest_post(items, self.newest_scanned)
+            new_items, reached_known = _split_new_items(items, self.since_post_id)
+            if reached_known:
+                logger.info(f"Достигнуты уже просмотренные посты группы {self.group_id} на offset={self.offset}")
+            self.offset += len(items)
+            if reached_known or len(items) < page_size:
+                self.finished = True
+            if not self.buffering:
+                return self._take(new_items)
+            self._new_items.extend(new_items)
+        if self.buffering and self.finished:
+            # Самые старые из новых мемов, в исходном порядке стены (от новых к старым)
+            memes = self._take(self._new_items[::-1])[::-1]
+            self._new_items = []
+            return memes
+        if self.buffering and not self.wants_more():
+            logger.info(f"Окно из {self.pages} страниц группы {self.group_id} не дошло до курсора, "
+                        f"догрузка продолжится с offset={self.offset}")
+            self._new_items = []
+        return []
+
+    def _take(self, items: List[Dict]) -> List[Dict]:
+        memes = _extract_memes(items, self.count - self.found)
+        self.found += len(memes)
+        if self.found >= self.count:
+            self.truncated = True
+        returned_posts = {meme["post_id"] for meme in memes}
+        self.newest_returned = _newest_post(
+            [item for item in items if item.get("id") in returned_posts], self.newest_returned
+        )
+        return memes
+
+    def wants_more(self) -> bool:
+        if self.finished or self.pages >= WALL_MAX_PAGES:
+            return False
+        return self.buffering or self.found < self.count
+
+    def cursor_update(self) -> Optional[Dict[str, int]]:
+        """
+        Новый курсор группы. Если все новые посты пролистаны и выданы, курсор встает
+        на самый новый из них; если загрузку остановил лимит count - на самый новый
+        пост, вошедший в результат. Если окно не дошло до курсора, пост курсора
+        не меняется, а resume_offset указывает, откуда продолжить. После ошибки
+        загрузки курсор не меняется.
+        """
+        if self.buffering and not self.finished:
+            if self.pages < WALL_MAX_PAGES:
+                return None
+            # Следующее окно начнется там, где закончилось это
+            return dict(self.cursor, resume_offset=self.offset + self._window() - WALL_RESUME_MARGIN)
+        complete = self.finished and not self.truncated
+        newest = self.newest_scanned if complete else self.newest_returned
+        if newest is None:
+            return None
+        return {"last_post_id": newest["id"], "last_date": newest.get("date", 0),
+                "resume_offset": self._post_offsets.get(newest["id"], 0)}
+
+def fetch_vk_memes(group_id: int, count: int, vk_session: vk_api.VkApi, incremental: bool = False,
+                   cursor_updates: Optional[Dict[int, Dict[str, int]]] = None) -> List[Dict]:
     """
     Получает мемы из указанной VK группы.
+    При incremental=True загрузка останавливается на уже просмотренных постах
+    (по курсору группы), так что обычное обновление получает только новые посты.
+    Новый курсор группы кладется в cursor_updates и фиксируется вызывающим кодом
+    через commit_group_cursors после обработки мемов.
     """
+    scan = _GroupScan(group_id, count, _get_cursor_state(group_id) if incremental else None)
+    since_post_id = scan.since_post_id
+    memes = []
     try:
         vk = vk_session.get_api()
-        memes = []
-        offset = 0
-        max_attempts = 5
-        attempt = 0
-
-        logger.info(f"Начало загрузки мемов из группы {group_id}, count={count}")
-        while len(memes) < count and attempt < max_attempts:
-            response = vk.wall.get(
-                owner_id=-group_id,
-                count=min(100, count - len(memes)),  # Максимум 100 постов за запрос
-                offset=offset,
-                filter="owner"
-            )
-            items = response.get("items", [])
-            if not items:
-                logger.info(f"Больше постов не найдено в группе {group_id} на offset={offset}")
-                break
-
-            for item in items:
-                if "attachments" in item:
-                    for attachment in item["attachments"]:
-                        if attachment["type"] == "photo":
-                            photo = attachment["photo"]
-                            sizes = photo.get("sizes", [])
-                            if sizes:
-                                image_url = max(sizes, key=lambda x: x.get("width", 0)).get("url", "")
-                                text = item.get("text", "").strip()
-                                if image_url and text:
-                                    memes.append({"image_url": image_url, "text": text, "tags": []})
-                                    if len(memes) >= count:
-                                        break
-                if len(memes) >= count:
-                    break
-            offset += len(items)
-            attempt += 1
-            if attempt < max_attempts:
-                time.sleep(random.uniform(1.0, 2.0))  # Увеличена задержка
-
+        logger.info(f"Начало загрузки мемов из группы {group_id}, count={count}, since={since_post_id}")
+        while scan.wants_more():
+            page_size = scan.page_size()
+            vk_rate_limiter.acquire()
+            response = vk.wall.get(owner_id=-group_id, count=page_size, offset=scan.offset, filter="owner")
+            memes.extend(scan.consume(response.get("items", []), page_size))
         logger.info(f"Получено {len(memes)} мемов из группы {group_id}")
-        return memes
-
     except vk_api.exceptions.ApiError as e:
         logger.error(f"Ошибка VK API при загрузке мемов из группы {group_id}: {e}")
         return []
     except Exception as e:
         logger.error(f"Неожиданная ошибка при загрузке мемов из группы {group_id}: {e}")
         return []
+    if incremental and cursor_updates is not None:
+        update = scan.cursor_update()
+        if update:
+            cursor_updates[group_id] = update
+    return memes
+
+def iter_vk_memes_parallel(group_ids: List[int], count: int, vk_session: vk_api.VkApi,
+                           incremental: bool = False,
+                           cursor_updates: Optional[Dict[int, Dict[str, int]]] = None,
+                           max_workers: int = INGEST_WORKERS,
+                           queue_size: int = INGEST_QUEUE_SIZE) -> Iterator[Tuple[int, Dict]]:
+    """
+    Загружает мемы из нескольких VK групп параллельно.
+    Частота запросов ограничивается общим vk_rate_limiter, а найденные мемы
+    передаются через ограниченную очередь, поэтому потребитель может проверять
+    кандидатов, пока остальные группы еще загружаются. Курсор группы попадает
+    в cursor_updates, только когда потребитель получил все ее мемы.
+
+    Yields:
+        Tuple[int, Dict]: ID группы и данные мема
+    """
+    candidates = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+
+    def put(item):
+        # Ждем места в очереди, но не блокируемся навсегда, если потребитель остановился
+        while not stop_event.is_set():
+            try:
+                candidates.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def worker(group_id: int):
+        updates = {}
+        try:
+            for meme in fetch_vk_memes(group_id, count, vk_session, incremental, updates):
+                if stop_event.is_set():
+                    return
+                put((group_id, meme))
+        finally:
+            put((group_id, None, updates.get(group_id)))  # Маркер завершения группы с ее курсором
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vk-ingest")
+    try:
+        for group_id in group_ids:
+            executor.submit(worker, group_id)
+        finished = 0
+        while finished < len(group_ids):
+            item = candidates.get()
+            if item[1] is None:
+                finished += 1
+                if item[2] and cursor_updates is not None:
+                    cursor_updates[item[0]] = item[2]
+                continue
+            yield item
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=False)
+
+def _build_wall_get_code(calls: List[Tuple[int, int, int]]) -> str:
+    """Формирует код VKScript для execute из списка вызовов (group_id, count, offset)"""
+    requests_code = ",".join(
+        f'API.wall.get({{"owner_id":{-group_id},"count":{count},"offset":{offset},"filter":"owner"}})'
+        for group_id, count, offset in calls
+    )
+    return f"return [{requests_code}];"
+
+def iter_vk_memes_batched(group_ids: List[int], count: int, vk_session: vk_api.VkApi,
+                          incremental: bool = False,
+                          cursor_updates: Optional[Dict[int, Dict[str, int]]] = None) -> Iterator[Tuple[int, Dict]]:
+    """
+    Загружает мемы из нескольких VK групп, упаковывая вызовы wall.get в запросы execute
+    (до VK_EXECUTE_MAX_CALLS вызовов за один запрос). Мемы отдаются сразу после
+    каждого ответа execute, поэтому потребитель проверяет кандидатов, пока
+    загружаются следующие пакеты групп.
+    При incremental=True каждая группа листается только до уже просмотренных постов,
+    а новые курсоры групп попадают в cursor_updates после того, как потребитель
+    получил все мемы.
+
+    Yields:
+        Tuple[int, Dict]: ID группы и данные мема в том же формате, что и fetch_vk_memes
+    """
+    vk = vk_session.get_api()
+    scans = {
+        group_id: _GroupScan(group_id, count, _get_cursor_state(group_id) if incremental else None)
+        for group_id in dict.fromkeys(group_ids)
+    }
+    pending = list(scans)
+    requests_made = 0
+    found = 0
+
+    logger.info(f"Пакетная загрузка мемов из {len(pending)} групп, count={count}")
+    while pending:
+        next_pending = []
+        for start in range(0, len(pending), VK_EXECUTE_MAX_CALLS):
+            calls = [
+                (group_id, scans[group_id].page_size(), scans[group_id].offset)
+                for group_id in pending[start:start + VK_EXECUTE_MAX_CALLS]
+            ]
+            try:
+                vk_rate_limiter.acquire()
+                response = vk.execute(code=_build_wall_get_code(calls))
+                requests_made += 1
+            except vk_api.exceptions.ApiError as e:
+                logger.error(f"Ошибка VK API при пакетной загрузке групп {[call[0] for call in calls]}: {e}")
+                continue
+            except Exception as e:
+                logger.error(f"Неожиданная ошибка при пакетной загрузке групп {[call[0] for call in calls]}: {e}")
+                continue
+
+            for (group_id, page_size, _), group_response in zip(calls, response or []):
+                # Неудачный вызов внутри execute возвращает false
+                if not group_response:
+                    logger.error(f"Ошибка VK API при загрузке мемов из группы {group_id} внутри execute")
+                    continue
+                scan = scans[group_id]
+                for meme in scan.consume(group_response.get("items", []), page_size):
+                    found += 1
+                    yield group_id, meme
+                if scan.wants_more():
+                    next_pending.append(group_id)
+        pending = next_pending
+
+    if incremental and cursor_updates is not None:
+        for group_id, scan in scans.items():
+            update = scan.cursor_update()
+            if update:
+                cursor_updates[group_id] = update
+    logger.info(f"Пакетно получено {found} мемов из {len(scans)} групп за {requests_made} запросов")
+
+# Инициализация модуля при импорте
+load_sync_state()